@@ -13,6 +13,16 @@ class Configuration(object):
         self.config = ConfigParser.ConfigParser()
         self.config.read(self.config_path)
 
+    def get_or_default(self, section, option, default):
+        if not self.config.has_option(section, option):
+            return default
+        return self.config.get(section, option)
+
+    def getboolean_or_default(self, section, option, default):
+        if not self.config.has_option(section, option):
+            return default
+        return self.config.getboolean(section, option)
+
     def host(self):
         return self.config.get('Rome', 'host')
 
@@ -28,6 +38,33 @@ class Configuration(object):
     def cluster_nodes(self):
         return self.config.get('Cluster', 'nodes').split(",")
 
+    def codec(self):
+        return self.get_or_default('Rome', 'codec', "json")
+
+    def read_legacy_values(self):
+        return self.getboolean_or_default('Rome', 'read_legacy_values', True)
+
+    def batch_size(self):
+        return int(self.get_or_default('Rome', 'batch_size', 1000))
+
+    def columnar(self):
+        return self.getboolean_or_default('Rome', 'columnar', False)
+
+    def request_caches_budget(self):
+        return int(self.get_or_default('Rome', 'request_caches_budget', 100000))
+
+    def id_block_size(self):
+        return int(self.get_or_default('Rome', 'id_block_size', 1))
+
+    def cache_enabled(self):
+        return self.getboolean_or_default('Cache', 'enabled', False)
+
+    def cache_memory_budget(self):
+        return int(self.get_or_default('Cache', 'memory_budget', 64 * 1024 * 1024))
+
+    def cache_invalidation(self):
+        return self.getboolean_or_default('Cache', 'invalidation', False)
+
 config = None
 
 def build_config():
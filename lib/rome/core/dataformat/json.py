@@ -7,19 +7,38 @@ simplification of objects, before storing them into the JSON database.
 
 import lib.rome.core.utils as utils
 import uuid
-from lib.rome.utils.LimitedSizeDictionnary import LimitedSizeDictionnary
 import datetime
 import netaddr
 import uuid
 import pytz
 import lib.rome.core.models as models
 import lib.rome.core.lazy as lazy_reference
-from lib.rome.utils.LimitedSizeDictionnary import LimitedSizeDictionnary
+from lib.rome.conf.Configuration import get_config
+from lib.rome.utils.LRUCache import LRUCache
 
-CACHES = LimitedSizeDictionnary(size_limit=20)
-SIMPLE_CACHES = LimitedSizeDictionnary(size_limit=20)
-COMPLEX_CACHES = LimitedSizeDictionnary(size_limit=20)
-TARGET_CACHES = LimitedSizeDictionnary(size_limit=20)
+
+def request_cache_size(cache):
+    return 1 + len(cache)
+
+
+def build_request_caches():
+    """Caches of objects, per request: the number of objects they contain is
+    bounded, and caches of requests that are being processed (i.e. used by an
+    encoder or a decoder) are never evicted."""
+    return LRUCache(get_config().request_caches_budget(), sizer=request_cache_size, dynamic_sizes=True)
+
+
+CACHES = build_request_caches()
+SIMPLE_CACHES = build_request_caches()
+COMPLEX_CACHES = build_request_caches()
+TARGET_CACHES = build_request_caches()
+
+
+def get_request_cache(caches, request_uuid, owner):
+    """Return the cache of a request, which is pinned as long as the owner
+    (encoder or decoder) is alive."""
+    caches.pin_while_alive(request_uuid, owner)
+    return caches.setdefault(request_uuid, {})
 
 
 def extract_adress(obj):
@@ -45,16 +64,9 @@ class Encoder(object):
         self.request_uuid = (request_uuid if request_uuid is not None
                              else uuid.uuid1()
                              )
-        if not SIMPLE_CACHES.has_key(self.request_uuid):
-            SIMPLE_CACHES[self.request_uuid] = {}
-        if not COMPLEX_CACHES.has_key(self.request_uuid):
-            COMPLEX_CACHES[self.request_uuid] = {}
-        if not TARGET_CACHES.has_key(self.request_uuid):
-            TARGET_CACHES[self.request_uuid] = {}
-
-        self.simple_cache = SIMPLE_CACHES[self.request_uuid]
-        self.complex_cache = COMPLEX_CACHES[self.request_uuid]
-        self.target_cache = TARGET_CACHES[self.request_uuid]
+        self.simple_cache = get_request_cache(SIMPLE_CACHES, self.request_uuid, self)
+        self.complex_cache = get_request_cache(COMPLEX_CACHES, self.request_uuid, self)
+        self.target_cache = get_request_cache(TARGET_CACHES, self.request_uuid, self)
 
         self.reset()
 
@@ -298,9 +310,7 @@ class Decoder(object):
         self.request_uuid = (request_uuid if request_uuid is not None
                              else uuid.uuid1()
                              )
-        if not CACHES.has_key(self.request_uuid):
-            CACHES[self.request_uuid] = {}
-        self.cache = CACHES[self.request_uuid]
+        self.cache = get_request_cache(CACHES, self.request_uuid, self)
 
     def get_key(self, obj):
         """Returns a unique key for the given object."""
@@ -1,13 +1,18 @@
 __author__ = 'jonathan'
 
 import datetime
+import itertools
+import operator
 import pytz
 from lib.rome.core.dataformat import get_decoder
 import re
 import uuid
+from sqlalchemy.sql import operators
 from sqlalchemy.sql.expression import BinaryExpression
 
 from lib.rome.core.rows.rows import get_attribute, has_attribute
+from lib.rome.core.rows.planner import UnsupportedExpression, clause_shape, parameter_count
+from lib.rome.utils.LRUCache import LRUCache
 
 def uncapitalize(s):
     return s[:1].lower() + s[1:] if s else ''
@@ -57,11 +62,15 @@ class LazyDictionnary:
 
 boolean_expression_str_memory = {}
 
-class BooleanExpression(object):
+class EvalExpression(object):
+    """Former evaluation strategy: the expression is converted into a python
+    string, which is evaluated for each row. It is only used for expressions
+    that cannot be compiled."""
+
     def __init__(self, operator, *exps):
         def transform_exp(exp):
-            if type(exp) is not BooleanExpression and self.operator != "NORMAL":
-                return BooleanExpression("NORMAL", exp)
+            if type(exp) is not EvalExpression and self.operator != "NORMAL":
+                return EvalExpression("NORMAL", exp)
             else:
                 return exp
         self.operator = operator
@@ -74,13 +83,10 @@ class BooleanExpression(object):
         self.default_value_dict = {}
         self.prepare_expression()
 
-    def is_boolean_expression(self):
-        return True
-
     def prepare_expression(self):
 
         def collect_expressions(exp):
-            if type(exp) is BooleanExpression:
+            if type(exp) is EvalExpression:
                 return exp.compiled_expression
             if type(exp) is BinaryExpression:
                 return self.prepare_criterion(exp)
@@ -123,7 +129,7 @@ class BooleanExpression(object):
         joined_compiled_expressions = joined_compiled_expressions.replace(":", "")
 
         for exp in self.exps:
-            if type(exp) is BooleanExpression:
+            if type(exp) is EvalExpression:
                 for default_value_key in exp.default_value_dict:
                     self.default_value_dict[default_value_key] = exp.default_value_dict[default_value_key]
 
@@ -212,4 +218,242 @@ class BooleanExpression(object):
             else:
                 return True
             pass
-        return result
\ No newline at end of file
+        return result
+
+
+def regexp_search(value, pattern):
+    return re.search(pattern, value) is not None
+
+
+def in_values(value, values):
+    return value in values
+
+
+def not_in_values(value, values):
+    return value not in values
+
+
+COMPARATORS = {
+    operators.eq: operator.eq,
+    operators.ne: operator.ne,
+    operators.lt: operator.lt,
+    operators.le: operator.le,
+    operators.gt: operator.gt,
+    operators.ge: operator.ge,
+    operators.is_: operator.is_,
+    operators.isnot: operator.is_not,
+    operators.in_op: in_values,
+    operators.notin_op: not_in_values
+}
+
+
+def get_comparator(operator):
+    if operator == "REGEXP":
+        return regexp_search
+    return COMPARATORS[operator]
+
+
+def conjunction(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def evaluate(row):
+        for predicate in predicates:
+            if not predicate(row):
+                return False
+        return True
+    return evaluate
+
+
+def disjunction(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def evaluate(row):
+        for predicate in predicates:
+            if predicate(row):
+                return True
+        return False
+    return evaluate
+
+
+def negation(predicate):
+    return lambda row: not predicate(row)
+
+
+def guarded(predicate):
+    def evaluate(row):
+        try:
+            return predicate(row)
+        except Exception:
+            return False
+    return evaluate
+
+
+# builders of predicates, keyed by the shapes of the expressions
+COMPILED_SHAPES = LRUCache(10000)
+
+
+def compile_shape(shape):
+    """Compile the shape of an expression (see planner.clause_shape) into a
+    builder: a function that takes an iterator on the parameter vector of an
+    expression of this shape and the BooleanExpression being built, and
+    returns a predicate on rows in which the values of the parameters are
+    constants."""
+    kind = shape[0]
+    if kind in ["and", "or"]:
+        builders = map(lambda x: compile_shape(x), shape[1])
+        combine = conjunction if kind == "and" else disjunction
+        return lambda parameters, expression: combine(map(lambda x: x(parameters, expression), builders))
+    if kind == "not":
+        builder = compile_shape(shape[1])
+        return lambda parameters, expression: negation(builder(parameters, expression))
+    if kind == "expression":
+        builder = compile_shape(shape[1])
+        return lambda parameters, expression: guarded(builder(parameters, expression))
+    if kind == "comparison":
+        return compile_comparison(shape)
+    if kind == "child":
+        (index, count) = (shape[1], parameter_count(shape[2]))
+
+        def build_child(parameters, expression):
+            list(itertools.islice(parameters, count))
+            return expression.exps[index].evaluate
+        return build_child
+    if kind == "eval":
+        index = shape[1]
+        return lambda parameters, expression: EvalExpression("NORMAL", expression.exps[index]).evaluate
+    raise UnsupportedExpression(shape)
+
+
+def compile_comparison(shape):
+    (_, operator, left_shape, right_shape) = shape
+    comparator = get_comparator(operator)
+    (left_is_constant, build_left) = compile_operand(left_shape)
+    (right_is_constant, build_right) = compile_operand(right_shape)
+
+    def build(parameters, expression):
+        left = build_left(parameters, expression)
+        right = build_right(parameters, expression)
+        if not right_is_constant:
+            if left_is_constant:
+                return lambda row: comparator(left, right(row))
+            return lambda row: comparator(left(row), right(row))
+        constant = right
+        if comparator in [in_values, not_in_values]:
+            try:
+                constant = frozenset(constant)
+            except TypeError:
+                pass
+        if left_is_constant:
+            result = comparator(left, constant)
+            return lambda row: result
+        if comparator is regexp_search and isinstance(constant, basestring):
+            pattern = re.compile(constant)
+            return lambda row: pattern.search(left(row)) is not None
+        return lambda row: comparator(left(row), constant)
+    return build
+
+
+def compile_operand(shape):
+    """Return an (is_constant, builder) pair: the builder returns the value
+    of a constant operand, or a function that reads the value of a column in
+    a row."""
+    kind = shape[0]
+    if kind == "constant":
+        value = shape[1]
+        return (True, lambda parameters, expression: value)
+    if kind in ["parameter", "parameters"]:
+        return (True, lambda parameters, expression: next(parameters))
+    if kind == "list":
+        builders = map(lambda x: compile_operand(x)[1], shape[1])
+        return (True, lambda parameters, expression: map(lambda x: x(parameters, expression), builders))
+    if kind == "column":
+        (tablename, attribute) = (shape[1], shape[2])
+        return (False, lambda parameters, expression: compile_column(tablename, attribute, expression))
+    raise UnsupportedExpression(shape)
+
+
+def compile_column(tablename, attribute, expression):
+    def read(row):
+        obj = row[tablename] if type(row) is dict else getattr(row, tablename)
+        value = obj[attribute] if type(obj) is dict else getattr(obj, attribute)
+        if isinstance(value, (dict, list)):
+            value = expression.deconverter.desimplify(value)
+        return value
+    return read
+
+
+class BooleanExpression(object):
+    """A boolean expression on rows. The expression is compiled once, when it
+    is created, into a tree of python functions that read values directly from
+    rows (tuples of objects as stored in database).
+
+    Compilation is shared by the expressions that have the same shape: the
+    shape of the expression is computed with its parameter vector, and the
+    builder compiled for this shape is looked up in a cache, then called with
+    the parameter vector. Expressions containing parts that cannot be compiled
+    are compiled without the cache."""
+
+    def __init__(self, operator, *exps):
+        def transform_exp(exp):
+            if type(exp) is not BooleanExpression and self.operator != "NORMAL":
+                return BooleanExpression("NORMAL", exp)
+            else:
+                return exp
+        self.operator = operator
+        self.exps = map(lambda x: transform_exp(x), exps)
+        self._deconverter = None
+        self.parameters = []
+        (self.shape, self.cacheable) = self.analyse()
+        self.predicate = self.builder()(iter(self.parameters), self)
+
+    @property
+    def deconverter(self):
+        if self._deconverter is None:
+            self._deconverter = get_decoder()
+        return self._deconverter
+
+    def is_boolean_expression(self):
+        return True
+
+    def analyse(self):
+        """Compute the shape of this expression and collect its parameter
+        vector. Parts that cannot be compiled (and subexpressions containing
+        such parts) are referred to by their position in the shape, which
+        then cannot be shared."""
+        shapes = []
+        cacheable = True
+        for (index, exp) in enumerate(self.exps):
+            if type(exp) is BooleanExpression:
+                self.parameters += exp.parameters
+                if exp.cacheable:
+                    shapes += [("expression", exp.shape)]
+                else:
+                    shapes += [("child", index, exp.shape)]
+                    cacheable = False
+                continue
+            parameters = []
+            try:
+                shapes += [clause_shape(exp, parameters)]
+                self.parameters += parameters
+            except UnsupportedExpression:
+                shapes += [("eval", index)]
+                cacheable = False
+        kind = "and" if self.operator == "AND" else "or"
+        return ((kind, tuple(shapes)), cacheable)
+
+    def builder(self):
+        if not self.cacheable:
+            return compile_shape(self.shape)
+        builder = COMPILED_SHAPES.get(self.shape)
+        if builder is None:
+            builder = compile_shape(self.shape)
+            COMPILED_SHAPES.put(self.shape, builder)
+        return builder
+
+    def evaluate(self, value):
+        try:
+            return self.predicate(value)
+        except Exception:
+            return False
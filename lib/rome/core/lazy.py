@@ -75,43 +75,8 @@ class LazyValue:
         return self.deconverter.desimplify(x)
 
     def get_relationships(self):
-        from utils import RelationshipModel
-        result = []
-
-        obj = self.wrapped_value.get_complex_ref()
-
-        state = obj._sa_instance_state
-
-        for field in obj._sa_class_manager:
-            field_object = obj._sa_class_manager[field]
-            field_column = state.mapper._props[field]
-
-            contain_comparator = hasattr(field_object, "comparator")
-            is_relationship = ("relationship" in str(field_object.comparator)
-                               if contain_comparator else False
-                               )
-            if is_relationship:
-                remote_local_pair = field_object.property.local_remote_pairs[0]
-
-                local_fk_field = remote_local_pair[0].name
-                local_fk_value = getattr(obj, local_fk_field)
-                local_object_field = field
-                local_object_value = getattr(obj, local_object_field)
-                remote_object_field = remote_local_pair[1].name
-                remote_object_tablename = str(remote_local_pair[1].table)
-                is_list = field_object.property.uselist
-
-                result += [RelationshipModel(
-                    local_fk_field,
-                    local_fk_value,
-                    local_object_field,
-                    local_object_value,
-                    remote_object_field,
-                    remote_object_tablename,
-                    is_list
-                )]
-
-        return result
+        from utils import get_relationships
+        return get_relationships(self.wrapped_value.get_complex_ref())
 
     def load_relationships(self, request_uuid=uuid.uuid1()):
         """Update foreign keys according to local fields' values."""
@@ -146,6 +111,16 @@ class LazyValue:
             self.load_relationships()
         return getattr(self.wrapped_value, attr)
 
+    def __setattr__(self, name, value):
+        """Affectations are made on the wrapped object, so that they are
+        tracked (see Entity.save) and stored when the object is saved."""
+        if name in ["deconverter", "wrapped_dict", "wrapped_value", "request_uuid"]:
+            self.__dict__[name] = value
+        else:
+            if self.wrapped_value is None:
+                self.wrapped_value = self.deconverter.desimplify(self.wrapped_dict)
+            setattr(self.wrapped_value, name, value)
+
 
 class LazyReference:
     """Class that references a remote object stored in database. This aims
@@ -162,9 +137,7 @@ class LazyReference:
         self.version = -1
         self.lazy_backref_buffer = LazyBackrefBuffer()
         self.request_uuid = request_uuid if request_uuid is not None else uuid.uuid1()
-        if self.request_uuid not in caches:
-            caches[self.request_uuid] = {}
-        self.cache = caches[self.request_uuid]
+        self.cache = json_module.get_request_cache(caches, self.request_uuid, self)
         if deconverter is None:
             from lib.rome.core.dataformat import get_decoder
             self.deconverter = get_decoder(request_uuid=request_uuid)
@@ -252,6 +225,8 @@ class LazyReference:
         if first_load:
             self.load_relationships()
             self.update_nova_model(data)
+        if data is not None and not "simplify_strategy" in data and hasattr(self.cache[key], "mark_as_loaded"):
+            self.cache[key].mark_as_loaded(data)
         if self._session is not None:
             self.cache[key]._session = self._session
         return self.cache[key]
@@ -15,6 +15,10 @@ import lib.rome.driver.database_driver as database_driver
 from oslo.db.sqlalchemy import models
 import utils
 
+# number of times an object modified by another process is merged with the
+# stored version and compared and set again, before its storage is aborted
+SAVE_CONFLICT_RETRIES = 10
+
 
 
 def starts_with_uppercase(name):
@@ -35,22 +39,56 @@ def convert_to_model_name(name):
     return result
 
 
+class ModelRegistry(object):
+    """Index of the models registered with global_scope: it maps table names
+    and class names to model classes, and memoizes the resolution of names
+    (plural or lowercase forms). It is rebuilt when models are registered."""
+
+    def __init__(self):
+        self.size = -1
+        self.classes_by_tablename = {}
+        self.classes_by_name = {}
+
+    def refresh(self):
+        scope = getattr(sys, "rome_global_scope", [])
+        if len(scope) == self.size:
+            return
+        self.classes_by_tablename = {}
+        for klass in scope:
+            self.classes_by_tablename.setdefault(klass.__tablename__, klass)
+        self.classes_by_name = {}
+        self.size = len(scope)
+
+    def get_class_from_tablename(self, tablename):
+        self.refresh()
+        return self.classes_by_tablename.get(tablename, None)
+
+    def get_class_from_name(self, name):
+        self.refresh()
+        if name not in self.classes_by_name:
+            corrected_name = convert_to_model_name(name)
+            result = None
+            for klass in getattr(sys, "rome_global_scope", []):
+                if klass.__name__ == corrected_name or klass.__name__ == name:
+                    result = klass
+                    break
+            self.classes_by_name[name] = result
+        return self.classes_by_name[name]
+
+
+model_registry = ModelRegistry()
+
+
 def get_model_classname_from_tablename(tablename):
-    for klass in sys.rome_global_scope:
-        if klass.__tablename__ == tablename:
-            return klass.__name__
-    return None
+    klass = model_registry.get_class_from_tablename(tablename)
+    return klass.__name__ if klass is not None else None
 
 def get_model_tablename_from_classname(classname):
     return get_model_class_from_name(classname).__tablename__
 
 
 def get_model_class_from_name(name):
-    corrected_name = convert_to_model_name(name)
-    for klass in sys.rome_global_scope:
-        if klass.__name__ == corrected_name or klass.__name__ == name:
-            return klass
-    return None
+    return model_registry.get_class_from_name(name)
 
 
 def get_tablename_from_name(name):
@@ -84,8 +122,18 @@ def global_scope(cls):
     if not hasattr(sys, "rome_global_scope"):
         setattr(sys, "rome_global_scope", [])
     sys.rome_global_scope += [cls]
+    model_registry.refresh()
     return cls
 
+BASIC_TYPES = (basestring, int, long, float, bool, type(None), datetime.datetime)
+
+
+def same_value(a, b):
+    """Check if two values are equal, without comparing complex objects (whose
+    comparison may load them from the database)."""
+    return a is b or (isinstance(a, BASIC_TYPES) and isinstance(b, BASIC_TYPES) and a == b)
+
+
 class IterableModel(object):
     def __setitem__(self, key, value):
         setattr(self, key, value)
@@ -109,6 +157,61 @@ class Entity(models.ModelBase, IterableModel, utils.ReloadableRelationMixin):
         self._session = None
         self.rome_version_number = -1
 
+    def __setattr__(self, name, value):
+        """Keep track of the fields that are modified, so that saving an
+        object only writes its modified fields (see save)."""
+        if not name.startswith("_") and not same_value(self.__dict__.get(name, None), value):
+            metadata = utils.get_model_metadata(self.__class__)
+            if name in metadata.columns or name in metadata.relationship_fields:
+                dirty_fields = self.__dict__.get("_rome_dirty_fields", None)
+                if dirty_fields is None:
+                    dirty_fields = self.__dict__["_rome_dirty_fields"] = set()
+                dirty_fields.add(name)
+        super(Entity, self).__setattr__(name, value)
+
+    def mark_as_loaded(self, row):
+        """Remember the row that corresponds to the current state of the
+        object in the database."""
+        self.__dict__["_rome_loaded_row"] = dict(row)
+        self.__dict__["_rome_dirty_fields"] = set()
+
+    def dirty_fields(self):
+        return self.__dict__.get("_rome_dirty_fields", None) or set()
+
+    def mutated_fields(self, loaded_row, request_uuid=uuid.uuid1()):
+        """Return the columns holding containers (dicts, lists, sets) whose
+        values differ from the loaded row: containers may be modified in
+        place, which is not detected by __setattr__."""
+        object_converter = get_encoder(request_uuid)
+        result = set()
+        for field in utils.get_model_metadata(self.__class__).columns:
+            value = self.__dict__.get(field, None)
+            if isinstance(value, (dict, list, set)) and object_converter.simplify(value) != loaded_row.get(field, None):
+                result.add(field)
+        return result
+
+    def has_loaded_collections(self):
+        """Check if a relationship list of the current object has been loaded:
+        items may have been added to or removed from the list in place."""
+        for relationship in utils.get_model_metadata(self.__class__).relationships:
+            if isinstance(self.__dict__.get(relationship.local_object_field, None), list):
+                return True
+        return False
+
+    def has_dirty_related_objects(self):
+        """Check if an object already loaded in a relationship of the current
+        object has been modified or has not been stored yet. Relationships
+        that are not loaded are not loaded by this method."""
+        from lib.rome.core.lazy import LazyReference
+        for relationship in utils.get_model_metadata(self.__class__).relationships:
+            value = self.__dict__.get(relationship.local_object_field, None)
+            for item in (value if isinstance(value, list) else [value]):
+                if isinstance(item, LazyReference):
+                    item = item.cache.get(item.get_key(), None)
+                if isinstance(item, Entity) and (not item.already_in_database() or len(item.dirty_fields()) > 0):
+                    return True
+        return False
+
     def already_in_database(self):
         return hasattr(self, "id") and (self.id is not None)
 
@@ -134,19 +237,11 @@ class Entity(models.ModelBase, IterableModel, utils.ReloadableRelationMixin):
     def update(self, values, synchronize_session='evaluate', request_uuid=uuid.uuid1(), do_save=True, skip_session=False):
         """Set default values"""
         try:
-            for field in self._sa_class_manager:
-                instance_state = self._sa_instance_state
-                field_value = getattr(self, field)
-                if field_value is None:
-                    try:
-                        field_column = instance_state.mapper._props[field].columns[0]
-                        field_name = field_column.name
-                        field_default_value = field_column.default.arg
-
-                        if not "function" in str(type(field_default_value)):
-                            setattr(self, field_name, field_default_value)
-                    except:
-                        pass
+            default_values = utils.get_model_metadata(self.__class__).default_values
+            for field in default_values:
+                if getattr(self, field) is None:
+                    (field_name, field_default_value) = default_values[field]
+                    setattr(self, field_name, field_default_value)
         except:
             pass
         for key in values:
@@ -171,14 +266,31 @@ class Entity(models.ModelBase, IterableModel, utils.ReloadableRelationMixin):
 
         self.update_foreign_keys()
 
+        """When the object has been loaded from the database and only some of
+        its columns have been modified, only these columns are simplified and
+        written on top of the loaded row (with a compare and set on its
+        version). Other saves simplify the object and its related objects:
+        when a related object has been modified, or when a relationship list
+        has been loaded, the whole graph of loaded objects is saved."""
+        loaded_row = self.__dict__.get("_rome_loaded_row", None)
+        if (loaded_row is not None and self.already_in_database() and not self.has_dirty_related_objects() and
+                not self.has_loaded_collections()):
+            dirty_fields = self.dirty_fields() | self.mutated_fields(loaded_row, request_uuid)
+            if len(dirty_fields) == 0:
+                return self
+            if dirty_fields <= utils.get_model_metadata(self.__class__).columns:
+                if self.save_dirty_fields(loaded_row, dirty_fields, request_uuid, increase_version):
+                    return self
+
         target = self
         table_name = self.__tablename__
 
         """Check if the current object has an value associated with the "id" 
         field. If this is not the case, following code will generate an unique
         value, and store it in the "id" field."""
-        if not self.already_in_database():
-            self.id = database_driver.get_driver().next_key(table_name)
+        is_new = not self.already_in_database()
+        if is_new:
+            self.id = database_driver.get_key_allocator().next_key(table_name)
             logging.debug("booking the id %s in table %s" % (self.id, self.__tablename__))
 
         """Before keeping the object in database, we simplify it: the object is
@@ -209,7 +321,7 @@ class Entity(models.ModelBase, IterableModel, utils.ReloadableRelationMixin):
                 continue
 
             """Find a new_id for this object"""
-            new_id = database_driver.get_driver().next_key(table_name)
+            new_id = database_driver.get_key_allocator().next_key(table_name)
 
             """Assign this id to the object"""
             simplified_object["id"] = new_id
@@ -218,20 +330,48 @@ class Entity(models.ModelBase, IterableModel, utils.ReloadableRelationMixin):
 
             pass
 
+        """Existing versions of the saving candidates are fetched with a
+        single batched request, and the candidates are then stored with a
+        single batched request. The version of the current object is known
+        when it has just been created or when it has been loaded from the
+        database: it is then stored with a compare and set, without fetching
+        its existing version first."""
+        driver = database_driver.get_driver()
+        candidates_classnames = {}
+        candidates_tablenames = {}
         for key in saving_candidates:
-
             classname = "_".join(key.split("_")[0:-1])
-            table_name = get_model_tablename_from_classname(classname)
+            candidates_classnames[key] = classname
+            candidates_tablenames[key] = get_model_tablename_from_classname(classname)
+
+        target_key = object_converter.get_cache_key(self)
+        expected_version = -1 if is_new else getattr(self, "rome_version_number", -1)
+        if target_key not in saving_candidates or (not is_new and expected_version < 0):
+            target_key = None
+
+        stored_candidates = [key for key in saving_candidates
+                             if key != target_key and object_converter.complex_cache[key].get("id", None) is not None]
+        existing_objects = dict(zip(stored_candidates, driver.get_many(
+            map(lambda key: (candidates_tablenames[key], object_converter.complex_cache[key]["id"]), stored_candidates)
+        ))) if len(stored_candidates) > 0 else {}
+
+        writes = []
+        for key in saving_candidates:
+
+            classname = candidates_classnames[key]
+            table_name = candidates_tablenames[key]
+            model_class = get_model_class_from_name(classname)
 
             current_object = object_converter.complex_cache[key]
 
             current_object["nova_classname"] = table_name
 
-            if not "id" in current_object or current_object["id"] is None:
-                current_object["id"] = self.next_key(table_name)
+            if key == target_key:
+                pass
+            elif not "id" in current_object or current_object["id"] is None:
+                current_object["id"] = database_driver.get_key_allocator().next_key(table_name)
             else:
-                model_class = get_model_class_from_name(classname)
-                existing_object = database_driver.get_driver().get(table_name, current_object["id"])
+                existing_object = existing_objects[key]
 
                 if not same_version(existing_object, current_object, model_class):
                     current_object = merge_dict(existing_object, current_object)
@@ -251,11 +391,46 @@ class Entity(models.ModelBase, IterableModel, utils.ReloadableRelationMixin):
 
             logging.debug("starting the storage of %s" % (current_object))
 
+            corrected_object = None
             try:
                 local_object_converter = get_encoder(request_uuid)
                 corrected_object = local_object_converter.simplify(current_object)
                 if target.__tablename__ == corrected_object["nova_classname"] and target.id == corrected_object["id"]:
                     corrected_object["session"] = getattr(target, "session", None)
+                secondary_indexes = utils.get_model_metadata(model_class).driver_indexes
+                if key == target_key:
+                    self.rome_version_number = expected_version + 1 if increase_version else expected_version
+                    corrected_object["rome_version_number"] = self.rome_version_number
+                    if driver.put_if_version(table_name, current_object["id"], corrected_object, expected_version,
+                                             secondary_indexes=secondary_indexes):
+                        driver.add_key(table_name, current_object["id"])
+                        self.mark_as_loaded(corrected_object)
+                        logging.debug("finished the storage of %s" % (corrected_object))
+                        continue
+                    """Another process has modified the object: it is merged
+                    with the existing version, and stored if the existing
+                    version has not been modified in the meantime."""
+                    loaded_version = expected_version
+                    for attempt in range(SAVE_CONFLICT_RETRIES):
+                        logging.debug("version conflict while storing %s" % (corrected_object))
+                        existing_object = driver.get(table_name, current_object["id"])
+                        expected_version = database_driver.get_version(existing_object)
+                        corrected_object = merge_dict(existing_object, corrected_object)
+                        corrected_object["rome_version_number"] = (expected_version + 1 if increase_version
+                                                                   else expected_version)
+                        if driver.put_if_version(table_name, current_object["id"], corrected_object,
+                                                 expected_version, secondary_indexes=secondary_indexes):
+                            break
+                    else:
+                        logging.error("failed to store %s after %s version conflicts" % (corrected_object,
+                                                                                         SAVE_CONFLICT_RETRIES))
+                        self.rome_version_number = loaded_version
+                        continue
+                    self.rome_version_number = corrected_object["rome_version_number"]
+                    driver.add_key(table_name, current_object["id"])
+                    self.mark_as_loaded(corrected_object)
+                    logging.debug("finished the storage of %s" % (corrected_object))
+                    continue
                 if increase_version:
                     if "rome_version_number" in corrected_object:
                         self.rome_version_number = corrected_object["rome_version_number"]
@@ -264,14 +439,111 @@ class Entity(models.ModelBase, IterableModel, utils.ReloadableRelationMixin):
                     else:
                         self.rome_version_number = 0
                 corrected_object["rome_version_number"] = self.rome_version_number
-                database_driver.get_driver().put(table_name, current_object["id"], corrected_object, secondary_indexes=getattr(model_class, "_secondary_indexes", []))
-                database_driver.get_driver().add_key(table_name, current_object["id"])
+                writes += [(table_name, current_object["id"], corrected_object, secondary_indexes)]
             except Exception as e:
                 import traceback
                 traceback.print_exc()
                 logging.error("Failed to store following object: %s because of %s, becoming %s" % (
                 current_object, e, corrected_object))
                 pass
-            logging.debug("finished the storage of %s" % (current_object))
+
+        if len(writes) > 0:
+            try:
+                driver.put_many(writes)
+                for (table_name, key, value, secondary_indexes) in writes:
+                    driver.add_key(table_name, key)
+                    if table_name == self.__tablename__ and key == self.id:
+                        self.mark_as_loaded(value)
+                    logging.debug("finished the storage of %s" % (value))
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                logging.error("Failed to store following objects: %s because of %s" % (
+                map(lambda x: x[2], writes), e))
         # self.load_relationships()
         return self
+
+    def save_dirty_fields(self, loaded_row, dirty_fields, request_uuid=uuid.uuid1(), increase_version=True):
+        """Write the modified columns of the object on top of the row it has
+        been loaded from. It returns False if the object has been modified by
+        another process in the meantime."""
+        object_converter = get_encoder(request_uuid)
+        row = dict(loaded_row)
+        for field in dirty_fields:
+            row[field] = object_converter.simplify(getattr(self, field))
+        row["updated_at"] = object_converter.simplify(datetime.datetime.utcnow())
+        expected_version = database_driver.get_version(loaded_row)
+        row["rome_version_number"] = expected_version + 1 if increase_version else expected_version
+        secondary_indexes = utils.get_model_metadata(self.__class__).driver_indexes
+        logging.debug("starting the storage of fields %s of %s" % (list(dirty_fields), row))
+        if not database_driver.get_driver().put_if_version(self.__tablename__, self.id, row, expected_version,
+                                                           secondary_indexes=secondary_indexes):
+            logging.debug("version conflict while storing %s" % (row))
+            return False
+        self.rome_version_number = row["rome_version_number"]
+        self.mark_as_loaded(row)
+        return True
+
+
+def bulk_save(objects, request_uuid=None, batch_size=1000):
+    """Store several new objects at once: their ids are reserved with a
+    single request per table, objects are simplified in a single pass, and
+    they are written by batches of batch_size objects. Contrary to
+    Entity.save, new objects are written with version 0 without a compare
+    and set, and their related objects are not stored. Objects that already
+    have an id are stored with Entity.save, so that their versions are
+    checked."""
+    driver = database_driver.get_driver()
+    key_allocator = database_driver.get_key_allocator()
+    request_uuid = request_uuid if request_uuid is not None else uuid.uuid1()
+    objects = list(objects)
+    existing_objects = filter(lambda x: x.already_in_database(), objects)
+    new_objects = filter(lambda x: not x.already_in_database(), objects)
+
+    """Reserve the ids of new objects."""
+    objects_without_id = {}
+    for obj in new_objects:
+        obj.update_foreign_keys()
+        objects_without_id.setdefault(obj.__tablename__, []).append(obj)
+    for table_name in objects_without_id:
+        table_objects = objects_without_id[table_name]
+        for (obj, key) in zip(table_objects, key_allocator.next_keys(table_name, len(table_objects))):
+            obj.id = key
+        logging.debug("booked %s ids in table %s" % (len(table_objects), table_name))
+
+    object_converter = get_encoder(request_uuid)
+    now = object_converter.simplify(datetime.datetime.utcnow())
+    writes = []
+    for obj in new_objects:
+        table_name = obj.__tablename__
+        object_converter.simplify(obj)
+        current_object = object_converter.complex_cache[object_converter.get_cache_key(obj)]
+        current_object["nova_classname"] = table_name
+        if current_object.get("created_at", None) is None:
+            current_object["created_at"] = now
+        current_object["updated_at"] = now
+        current_object["rome_version_number"] = 0
+        obj.rome_version_number = 0
+        writes += [(table_name, obj.id, current_object,
+                    utils.get_model_metadata(obj.__class__).driver_indexes)]
+
+    for i in range(0, len(writes), batch_size):
+        batch = writes[i:i + batch_size]
+        driver.put_many(batch)
+        for (table_name, key, value, secondary_indexes) in batch:
+            driver.add_key(table_name, key)
+        for (obj, (table_name, key, value, secondary_indexes)) in zip(new_objects[i:i + batch_size], batch):
+            obj.mark_as_loaded(value)
+
+    for obj in existing_objects:
+        obj.save(request_uuid=request_uuid)
+    return objects
+
+
+def rebuild_indexes(model_class):
+    """Rebuild the secondary indexes of the table of a model class. Indexes
+    written by previous versions of ROME may contain objects whose value has
+    changed since: objects found with indexes are filtered again until the
+    indexes of their table have been rebuilt."""
+    metadata = utils.get_model_metadata(model_class)
+    database_driver.get_driver().rebuild_indexes(model_class.__tablename__, metadata.driver_indexes)
@@ -2,17 +2,29 @@
 
 This module contains a definition of object queries.
 
+Queries are immutable: methods that refine a query (filter, order_by...)
+return a new query that shares the arguments of the former one. Arguments
+are classified once, when they are given, and criterions and hints are kept
+in persistent lists, so that chaining a call does not depend on the number
+of arguments of the query.
+
 """
 
+import copy
 import traceback
 import inspect
-import re
 import logging
 
 from lib.rome.core.terms.terms import *
 from sqlalchemy.sql.expression import BinaryExpression
+from sqlalchemy.sql.elements import Label
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql import operators
 import lib.rome.driver.database_driver as database_driver
-from lib.rome.core.rows.rows import construct_rows, find_table_name, all_selectable_are_functions
+from lib.rome.conf.Configuration import get_config
+from lib.rome.core.rows.rows import construct_rows, count_rows, find_table_name, all_selectable_are_functions
+from lib.rome.core.rows.ordering import extract_ordering
+from lib.rome.utils.PersistentList import EMPTY_LIST
 
 try:
     from lib.rome.core.dataformat import get_decoder
@@ -21,76 +33,111 @@ except:
     pass
 import uuid
 
+
+def sql_function(arg):
+    """Convert a sqlalchemy function (func.count, func.sum, possibly
+    labelled) into a Function, or return None."""
+    element = arg.element if isinstance(arg, Label) else arg
+    if not isinstance(element, FunctionElement) or element.name not in ["count", "sum"]:
+        return None
+    clauses = element.clauses.clauses
+    if len(clauses) == 0:
+        field_id = "*"
+    elif hasattr(clauses[0], "name") and hasattr(getattr(clauses[0], "table", None), "name"):
+        field_id = "%s.%s" % (clauses[0].table.name, clauses[0].name)
+    else:
+        field_id = str(clauses[0])
+    return Function(element.name, field_id)
+
+
 class Query:
 
     def __init__(self, *args, **kwargs):
         self._models = []
         self._initial_models = []
-        self._criterions = []
+        self._criterions = EMPTY_LIST
         self._funcs = []
-        self._hints = []
+        self._hints = EMPTY_LIST
         self._session = None
+        # (tablename, attribute, descending) triples
+        self._ordering = kwargs.get("ordering", [])
+        self._limit = kwargs.get("limit", None)
+        self._offset = kwargs.get("offset", 0)
+        # (tablename, attribute) pairs
+        self._grouping = kwargs.get("grouping", [])
         base_model = None
         if "base_model" in kwargs:
             base_model = kwargs.get("base_model")
         if "session" in kwargs:
             self._session = kwargs.get("session")
         for arg in args:
-            if ("count" in str(arg) or "sum" in str(arg)) and "DeclarativeMeta" not in str(type(arg)):
-                function_name = re.sub("\(.*\)", "", str(arg))
-                field_id = re.sub("\)", "", re.sub(".*\(", "", str(arg)))
-                self._models += [Selection(None, None, is_function=True, function=Function(function_name, field_id))]
-            elif find_table_name(arg) != "none":
-                arg_as_text = "%s" % (arg)
-                attribute_name = "*"
-                if not hasattr(arg, "_sa_class_manager"):
-                    if (len(arg_as_text.split(".")) > 1):
-                        attribute_name = arg_as_text.split(".")[-1]
-                    if hasattr(arg, "_sa_class_manager"):
-                        self._models += [Selection(arg, attribute_name)]
-                    elif hasattr(arg, "class_"):
-                        self._models += [Selection(arg.class_, attribute_name)]
-                else:
-                    self._models += [Selection(arg, "*")]
-                    pass
-            elif isinstance(arg, Selection):
-                self._models += [arg]
-            elif isinstance(arg, Hint):
-                self._hints += [arg]
-            elif isinstance(arg, Function):
-                self._models += [Selection(None, None, True, arg)]
-                self._funcs += [arg]
-            elif isinstance(arg, BinaryExpression):
-                self._criterions += [BooleanExpression("NORMAL", arg)]
-            elif hasattr(arg, "is_boolean_expression"):
-                self._criterions += [arg]
-            else:
-                pass
+            self._add_argument(arg)
         if all_selectable_are_functions(self._models):
             if base_model:
-                self._models += [Selection(base_model, "*", is_hidden=True)]
+                self._models = self._models + [Selection(base_model, "*", is_hidden=True)]
+
+    def _add_argument(self, arg):
+        """Classify an argument of the query. This query must not be shared
+        yet: lists of models are replaced rather than modified, as they are
+        shared with the queries derived from this query."""
+        function = sql_function(arg)
+        if function is not None:
+            self._models = self._models + [Selection(None, None, is_function=True, function=function)]
+        elif isinstance(arg, Selection):
+            self._models = self._models + [arg]
+        elif isinstance(arg, Hint):
+            self._hints = self._hints.append(arg)
+        elif isinstance(arg, Function):
+            self._models = self._models + [Selection(None, None, True, arg)]
+            self._funcs = self._funcs + [arg]
+        elif isinstance(arg, BinaryExpression):
+            self._criterions = self._criterions.append(BooleanExpression("NORMAL", arg))
+        elif hasattr(arg, "is_boolean_expression"):
+            self._criterions = self._criterions.append(arg)
+        elif find_table_name(arg) != "none":
+            arg_as_text = "%s" % (arg)
+            attribute_name = "*"
+            if not hasattr(arg, "_sa_class_manager"):
+                if (len(arg_as_text.split(".")) > 1):
+                    attribute_name = arg_as_text.split(".")[-1]
+                if hasattr(arg, "class_"):
+                    self._models = self._models + [Selection(arg.class_, attribute_name)]
+            else:
+                self._models = self._models + [Selection(arg, "*")]
+
+    def _derive(self, **changes):
+        """Return a query that shares the arguments of this query, whose
+        given attributes are replaced."""
+        query = copy.copy(self)
+        query.__dict__.update(changes)
+        return query
+
+    def _rows(self, limit=None, batch_size=None):
+        """Return a generator of the rows of this query."""
+        if limit is None or (self._limit is not None and self._limit < limit):
+            limit = self._limit
+        return construct_rows(self._models, self._criterions.to_list(), self._hints.to_list(), session=self._session,
+                              ordering=self._ordering, limit=limit, offset=self._offset,
+                              grouping=self._grouping, batch_size=batch_size)
 
     def all(self):
-        result_list = construct_rows(self._models, self._criterions, self._hints, session=self._session)
-        result = []
-        for r in result_list:
-            ok = True
-            if ok:
-                result += [r]
-        return result
+        return list(self._rows())
 
     def first(self):
-        rows = self.all()
-        if len(rows) > 0:
-            return rows[0]
-        else:
-            None
+        """Return the first row, or None: rows are produced until one of
+        them satisfies the criterions."""
+        return next(self._rows(limit=1), None)
 
     def exists(self):
         return self.first() is not None
 
     def count(self):
-        return len(self.all())
+        """Count rows without building them: with secondary indexes when
+        possible, in a streaming pass otherwise."""
+        if len(self._grouping) > 0 or not all(x.is_hidden or not x._is_function for x in self._models):
+            return len(self.all())
+        return count_rows(self._models, self._criterions.to_list(), self._hints.to_list(), limit=self._limit,
+                          offset=self._offset)
 
     def soft_delete(self, synchronize_session=False):
         return self
@@ -113,59 +160,47 @@ class Query:
     ####################################################################################################################
 
     def _extract_hint(self, criterion):
+        """Extract a hint from an equality criterion: hints are used by drivers
+        to find candidates with their secondary indexes."""
         try:
-            if hasattr(criterion.expression.right, "value"):
+            if criterion.expression.operator is operators.eq and hasattr(criterion.expression.right, "value"):
                 table_name = str(criterion.expression.left.table)
                 attribute_name = str(criterion.expression.left.key)
                 value = "%s" % (criterion.expression.right.value)
-                self._hints += [Hint(table_name, attribute_name, value)]
+                return [Hint(table_name, attribute_name, value)]
         except:
             pass
+        return []
 
     def filter_by(self, **kwargs):
-        _func = self._funcs[:]
-        _criterions = self._criterions[:]
+        query = self._derive()
         for a in kwargs:
             for selectable in self._models:
                 try:
                     column = getattr(selectable._model, a)
                     criterion = column.__eq__(kwargs[a])
-                    self._extract_hint(criterion)
-                    _criterions += [criterion]
+                    query._hints = query._hints.extend(self._extract_hint(criterion))
+                    query._add_argument(criterion)
                     break
                 except Exception as e:
                     # create a binary expression
                     # traceback.print_exc()
                     pass
-        _hints = self._hints[:]
-        args = self._models + _func + _criterions + _hints + self._initial_models
-        kwargs = {}
-        if self._session is not None:
-            kwargs["session"] = self._session
-        return Query(*args, **kwargs)
+        return query
 
     def filter_dict(self, filters):
         return self.filter_by(**filters)
 
     # criterions can be a function
     def filter(self, *criterions):
-        _func = self._funcs[:]
-        _criterions = self._criterions[:]
+        query = self._derive()
         for criterion in criterions:
-            self._extract_hint(criterion)
-            _criterions += [criterion]
-        _hints = self._hints[:]
-        args = self._models + _func + _criterions + _hints + self._initial_models
-        kwargs = {}
-        if self._session is not None:
-            kwargs["session"] = self._session
-        return Query(*args, **kwargs)
+            query._hints = query._hints.extend(self._extract_hint(criterion))
+            query._add_argument(criterion)
+        return query
 
     def join(self, *args, **kwargs):
-        _func = self._funcs[:]
-        _models = self._models[:]
-        _criterions = self._criterions[:]
-        _hints = self._hints[:]
+        query = self._derive()
         for arg in args:
 
             if not isinstance(arg, list) and not isinstance(arg, tuple):
@@ -175,68 +210,58 @@ class Query:
 
             for item in tuples:
                 is_class = inspect.isclass(item)
-                is_expression = (
-                    "BinaryExpression" in "%s" % (item) or
-                    "BooleanExpression" in "%s" % (item) or
-                    "BinaryExpression" in "%s" % (type(item)) or
-                    "BooleanExpression" in "%s" % (type(item))
-                )
+                is_expression = isinstance(item, BinaryExpression) or hasattr(item, "is_boolean_expression")
                 if is_class:
-                    _models = _models + [Selection(item, "*")]
+                    query._models = query._models + [Selection(item, "*")]
                 elif is_expression:
-                    _criterions += [item]
+                    query._add_argument(item)
                 else:
                     pass
-        args = _models + _func + _criterions + _hints + self._initial_models
-        kwargs = {}
-        if self._session is not None:
-            kwargs["session"] = self._session
-        return Query(*args, **kwargs)
+        return query
 
     def outerjoin(self, *args, **kwargs):
         return self.join(*args, **kwargs)
 
     def options(self, *args):
-        _func = self._funcs[:]
-        _models = self._models[:]
-        _criterions = self._criterions[:]
-        _initial_models = self._initial_models[:]
-        _hints = self._hints[:]
-        args = _models + _func + _criterions + _hints + _initial_models
-        kwargs = {}
-        if self._session is not None:
-            kwargs["session"] = self._session
-        return Query(*args, **kwargs)
+        return self._derive()
 
     def order_by(self, *criterion):
-        _func = self._funcs[:]
-        _models = self._models[:]
-        _criterions = self._criterions[:]
-        _initial_models = self._initial_models[:]
-        _hints = self._hints[:]
-        args = _models + _func + _criterions + _hints + _initial_models
-        kwargs = {}
-        if self._session is not None:
-            kwargs["session"] = self._session
-        return Query(*args, **kwargs)
+        """Order rows by the given columns (or column.desc()): orderings are
+        appended to the ones of this query, order_by(None) removes them."""
+        if len(criterion) == 1 and criterion[0] is None:
+            _ordering = []
+        else:
+            _ordering = self._ordering + filter(lambda x: x is not None, map(extract_ordering, criterion))
+        return self._derive(_ordering=_ordering)
+
+    def group_by(self, *criterion):
+        """Group rows by the given columns: the selected functions (count,
+        sum) are computed for each group."""
+        _grouping = self._grouping + map(lambda x: x[0:2], filter(lambda x: x is not None,
+                                                                  map(extract_ordering, criterion)))
+        return self._derive(_grouping=_grouping)
+
+    def limit(self, limit):
+        """Only return the first rows: when rows are ordered, only the
+        first offset + limit rows are kept in memory while they are sorted."""
+        return self._derive(_limit=limit)
+
+    def offset(self, offset):
+        return self._derive(_offset=offset if offset is not None else 0)
 
     def with_lockmode(self, mode):
         return self
 
     def subquery(self):
-        _func = self._funcs[:]
-        _models = self._models[:]
-        _criterions = self._criterions[:]
-        _initial_models = self._initial_models[:]
-        _hints = self._hints[:]
-        args = _models + _func + _criterions + _hints + _initial_models
-        kwargs = {}
-        if self._session is not None:
-            kwargs["session"] = self._session
-        return Query(*args, **kwargs).all()
+        return self.all()
 
     def __iter__(self):
-        return iter(self.all())
+        """Rows are streamed: objects are fetched by batches (see the
+        "batch_size" option) while rows are consumed, and rows of different
+        batches do not share the objects cached for their request. Joined
+        tables are loaded at once, and sorted rows are all selected before
+        the first one is produced."""
+        return self._rows(batch_size=get_config().batch_size())
 
     def __repr__(self):
         return """{\\"models\\": \\"%s\\", \\"criterions\\": \\"%s\\", \\"hints\\": \\"%s\\"}""" % (self._models, self._criterions, self._hints)
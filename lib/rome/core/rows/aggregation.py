@@ -0,0 +1,58 @@
+"""Aggregation module.
+
+This module computes the functions (count/sum) selected by a query in a
+single streaming pass over the rows: rows are neither kept in memory nor
+converted into model objects. Rows may be grouped (GROUP BY), in which case
+one result row is produced for each group.
+
+"""
+
+from lib.rome.core.rows.ordering import row_value
+
+
+def aggregate_rows(rows, functions):
+    """Compute the given functions on rows (given by an iterable)."""
+    values = map(lambda x: x.initial_value(), functions)
+    for row in rows:
+        values = map(lambda (function, value): function.accumulate(value, row), zip(functions, values))
+    return values
+
+
+def group_key(value):
+    """Values used as keys of groups have to be hashable (simplified dates
+    are dicts)."""
+    if isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def group_rows(rows, labels, grouping, selections):
+    """Group rows by the given (tablename, attribute) pairs, and compute the
+    selected functions for each group. Other selections take the value of
+    the first row of their group. It returns a list of (selection, value)
+    lists, groups being sorted by their first row."""
+    groups = {}
+    groups_order = []
+    functions = [x._function for x in selections if x._is_function]
+    for row in rows:
+        key = tuple(map(lambda x: group_key(row_value(row, labels, x[0], x[1])), grouping))
+        if key not in groups:
+            groups[key] = (row, map(lambda x: x.initial_value(), functions))
+            groups_order += [key]
+        (first_row, values) = groups[key]
+        values = map(lambda (function, value): function.accumulate(value, row), zip(functions, values))
+        groups[key] = (first_row, values)
+    result = []
+    for key in groups_order:
+        (first_row, values) = groups[key]
+        final_values = iter(values)
+        group_row = []
+        for selection in selections:
+            if selection._is_function:
+                group_row += [(selection, next(final_values))]
+            else:
+                group_row += [(selection, first_row)]
+        result += [group_row]
+    return result
@@ -0,0 +1,235 @@
+"""Columnar module.
+
+This module contains an optional columnar execution mode: the objects of a
+table are converted into NumPy arrays (one array per column, with a mask of
+null values), so that the predicates pushed down by the planner, the joins of
+two tables on numeric columns and the count/sum aggregates (without GROUP BY)
+on a single table are evaluated in a vectorised way. Residual criterions and
+grouped aggregates are still evaluated on rows. It is enabled with the
+"columnar" option of the configuration, and requires NumPy.
+
+Converting objects into columns costs more than filtering them once: tables
+are only worth it when they are kept across queries. Tables loaded without
+hints are kept (in COLUMNAR_TABLES) while the driver reports that they have
+not been modified, which requires the cache with invalidation (see
+CachedDriver.table_generation). Otherwise, they are rebuilt for each query.
+
+"""
+
+import logging
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.conf.Configuration import get_config
+from lib.rome.driver.cache import copy_value
+from lib.rome.utils.LRUCache import LRUCache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# columnar tables kept across queries, keyed by their name: each entry holds
+# the generation of the table when its objects were loaded, and the table
+COLUMNAR_TABLES = LRUCache(16)
+
+
+def columnar_enabled():
+    config = get_config()
+    if not config.columnar():
+        return False
+    if numpy is None:
+        logging.warning("columnar mode requires numpy, falling back to the default mode")
+        return False
+    return True
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def is_scalar(value):
+    return isinstance(value, (basestring, int, long, float))
+
+
+class Column(object):
+    """Values of an attribute of the objects of a table: "present" indicates
+    objects that have the attribute, and "nulls" objects whose value is None."""
+
+    def __init__(self, objects, attribute):
+        size = len(objects)
+        self.present = numpy.fromiter((attribute in x for x in objects), dtype=bool, count=size)
+        values = [x.get(attribute, None) for x in objects]
+        self.nulls = numpy.fromiter((x is None for x in values), dtype=bool, count=size)
+        self.numeric = all(is_number(x) for x in values if x is not None)
+        self.values = None
+        if self.numeric:
+            try:
+                self.values = numpy.array([0 if x is None else x for x in values])
+            except OverflowError:
+                self.numeric = False
+        if self.values is None:
+            self.values = numpy.empty(size, dtype=object)
+            self.values[:] = values
+
+    def equals(self, value):
+        """Compare values as Predicate.match does, with python equality (so
+        that 0 == False and 1 == 1.0). Arrays of objects are compared to
+        scalar values element by element by NumPy, with python equality."""
+        if value is None:
+            return self.nulls.copy()
+        if self.numeric and isinstance(value, (int, long, float)):
+            return numpy.asarray(self.values == value, dtype=bool) & ~self.nulls
+        if not self.numeric and is_scalar(value):
+            return numpy.asarray(self.values == value, dtype=bool)
+        return numpy.fromiter((x == value for x in self.values), dtype=bool, count=len(self.values))
+
+    def contains(self, values):
+        if self.numeric and all(is_number(x) for x in values):
+            return numpy.in1d(self.values, values) & ~self.nulls
+        if len(values) <= 32 and all(is_scalar(x) or x is None for x in values):
+            result = numpy.zeros(len(self.values), dtype=bool)
+            for value in values:
+                result |= self.equals(value)
+            return result
+        return numpy.fromiter((x in values for x in self.values), dtype=bool, count=len(self.values))
+
+
+class ColumnarTable(object):
+    """Objects of a table, stored by columns. Columns are built lazily. The
+    objects of tables kept across queries are copied when they are
+    selected, so that callers cannot modify them."""
+
+    def __init__(self, tablename, objects, kept=False):
+        self.tablename = tablename
+        self.objects = list(objects)
+        self.columns = {}
+        self.kept = kept
+
+    def __len__(self):
+        return len(self.objects)
+
+    def column(self, attribute):
+        if attribute not in self.columns:
+            self.columns[attribute] = Column(self.objects, attribute)
+        return self.columns[attribute]
+
+    def mask(self, predicates):
+        """Compute the mask of objects that satisfy all the given predicates
+        (see lib.rome.core.rows.planner.Predicate)."""
+        result = numpy.ones(len(self.objects), dtype=bool)
+        for predicate in predicates:
+            column = self.column(predicate.attribute)
+            if predicate.operator == "eq":
+                selection = column.equals(predicate.value)
+            elif predicate.operator == "in":
+                selection = column.contains(predicate.value)
+            elif predicate.operator == "is_null":
+                selection = column.nulls
+            elif predicate.operator == "is_not_null":
+                selection = ~column.nulls
+            else:
+                selection = numpy.fromiter((predicate.match(x) for x in self.objects), dtype=bool,
+                                           count=len(self.objects))
+            result &= selection & column.present
+        return result
+
+    def select(self, mask):
+        return self.objects_at(numpy.flatnonzero(mask))
+
+    def objects_at(self, indexes):
+        if self.kept:
+            return [copy_value(self.objects[i]) for i in indexes]
+        return [self.objects[i] for i in indexes]
+
+    def count(self, mask):
+        return int(numpy.count_nonzero(mask))
+
+    def sum(self, mask, attribute):
+        """Sum the values of an attribute, as Function.accumulate does: NULL
+        values (and values that cannot be summed) are ignored, as in SQL."""
+        column = self.column(attribute)
+        selected = mask & column.present & ~column.nulls
+        if not numpy.any(selected):
+            return 0
+        if column.numeric:
+            return numpy.sum(column.values[selected]).item()
+        result = 0
+        for value in column.values[selected]:
+            try:
+                result = result + value
+            except TypeError:
+                pass
+        return result
+
+
+def load_table(tablename, load_objects, complete=True):
+    """Return a columnar table of the objects of a table: the kept table if
+    the table has not been modified since it was loaded, and otherwise the
+    objects returned by load_objects(). Tables are only kept when complete is
+    True (load_objects then returns every object of the table)."""
+    generation = database_driver.get_driver().table_generation(tablename)
+    if generation is not None:
+        entry = COLUMNAR_TABLES.get(tablename)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+    keep = complete and generation is not None
+    table = ColumnarTable(tablename, load_objects(), kept=keep)
+    if keep:
+        COLUMNAR_TABLES.put(tablename, (generation, table))
+    return table
+
+
+def join(left, left_mask, left_attribute, right, right_mask, right_attribute):
+    """Join the selected objects of two tables on the equality of two numeric
+    columns (null values never match). It returns the indexes of the left
+    objects and the indexes of the right objects of the joined pairs, or None
+    if one of the columns is not numeric."""
+    left_column = left.column(left_attribute)
+    right_column = right.column(right_attribute)
+    if not left_column.numeric or not right_column.numeric:
+        return None
+    left_indexes = numpy.flatnonzero(left_mask & left_column.present & ~left_column.nulls)
+    right_indexes = numpy.flatnonzero(right_mask & right_column.present & ~right_column.nulls)
+    order = numpy.argsort(right_column.values[right_indexes], kind="mergesort")
+    sorted_values = right_column.values[right_indexes][order]
+    left_values = left_column.values[left_indexes]
+    starts = numpy.searchsorted(sorted_values, left_values, side="left")
+    counts = numpy.searchsorted(sorted_values, left_values, side="right") - starts
+    # each left object is paired with the counts[i] right objects that follow starts[i]
+    offsets = numpy.arange(numpy.sum(counts)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return (numpy.repeat(left_indexes, counts), right_indexes[order[numpy.repeat(starts, counts) + offsets]])
+
+
+def join_tuples(tables, edge):
+    """Build the pairs of objects of two tables (given as (table, mask)
+    pairs) joined by an edge (see rows_experimental.JoinEdge). It returns
+    None if the join cannot be vectorised."""
+    ((left, left_mask), (right, right_mask)) = tables
+    pairs = join(left, left_mask, edge.column(left.tablename), right, right_mask, edge.column(right.tablename))
+    if pairs is None:
+        return None
+    (left_indexes, right_indexes) = pairs
+    # objects are selected once, even if they belong to several pairs
+    selected_left = numpy.unique(left_indexes)
+    left_objects = dict(zip(selected_left, left.objects_at(selected_left)))
+    selected_right = numpy.unique(right_indexes)
+    right_objects = dict(zip(selected_right, right.objects_at(selected_right)))
+    return [[left_objects[i], right_objects[j]] for (i, j) in zip(left_indexes, right_indexes)]
+
+
+def aggregate(table, mask, functions):
+    """Compute the given functions (count/sum) on the selected objects of a
+    table. It returns None if one of the functions is not supported."""
+    result = []
+    for function in functions:
+        field = function._field.split(".")
+        if len(field) < 2 or field[-2] != table.tablename:
+            return None
+        if function._name == "count":
+            result += [table.count(mask)]
+        elif function._name == "sum":
+            result += [table.sum(mask, field[-1])]
+        else:
+            return None
+    return result
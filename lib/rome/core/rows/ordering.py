@@ -0,0 +1,89 @@
+"""Ordering module.
+
+This module sorts and slices the rows of a query (ORDER BY, LIMIT and
+OFFSET). Stored values are compared as they are stored, except dates, which
+are compared by their scores (see database_driver.index_score). As with
+MySQL, NULL values come first in ascending order.
+
+When only the first rows of an ordered query are needed, rows are selected
+with a bounded heap (top-k), so that only offset + limit rows are kept in
+memory while the other rows are streamed.
+
+"""
+
+import heapq
+import itertools
+import logging
+
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression
+
+from lib.rome.driver.database_driver import index_score
+
+
+def extract_ordering(criterion):
+    """Convert an argument of Query.order_by (a column, or the result of
+    column.asc() or column.desc()) into a (tablename, attribute, descending)
+    triple, or return None if it is not supported."""
+    descending = False
+    element = criterion
+    if hasattr(element, "__clause_element__"):
+        element = element.__clause_element__()
+    if isinstance(element, UnaryExpression) and element.modifier in [operators.asc_op, operators.desc_op]:
+        descending = element.modifier is operators.desc_op
+        element = element.element
+        if hasattr(element, "__clause_element__"):
+            element = element.__clause_element__()
+    if not hasattr(element, "table") or not hasattr(element.table, "name") or not hasattr(element, "key"):
+        logging.warning("%s is not a column" % (criterion))
+        return None
+    return (element.table.name, element.key, descending)
+
+
+def sortable_value(value):
+    score = index_score(value) if isinstance(value, dict) else None
+    return score if score is not None else value
+
+
+class OrderingKey(object):
+    """Key of a row, whose values are compared in ascending or descending
+    order."""
+
+    __slots__ = ["values", "descending"]
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __lt__(self, other):
+        for (value, other_value, descending) in zip(self.values, other.values, self.descending):
+            if value == other_value:
+                continue
+            return value > other_value if descending else value < other_value
+        return False
+
+
+def row_value(row, labels, tablename, attribute):
+    obj = row if len(labels) == 1 else row[labels.index(tablename)]
+    return obj.get(attribute, None) if isinstance(obj, dict) else getattr(obj, attribute, None)
+
+
+def sort_rows(rows, labels, ordering, offset=0, limit=None):
+    """Sort (with the given (tablename, attribute, descending) triples) and
+    slice the given rows. Rows are KeyedTuples of objects (or objects when
+    there is a single label), rows may be given by a generator. Rows that do
+    not have to be sorted are sliced lazily."""
+    ordering = filter(lambda x: x[0] in labels, ordering)
+    end = offset + limit if limit is not None else None
+    if len(ordering) > 0:
+        descending = map(lambda x: x[2], ordering)
+        key = lambda row: OrderingKey(map(lambda x: sortable_value(row_value(row, labels, x[0], x[1])), ordering),
+                                      descending)
+        if end is not None:
+            rows = heapq.nsmallest(end, rows, key=key)
+        else:
+            rows = sorted(rows, key=key)
+    return itertools.islice(rows, offset, end)
@@ -0,0 +1,342 @@
+"""Planner module.
+
+This module analyses the criterions of a query, in order to find simple
+predicates (equality, IN, IS NULL) that involve a single column of a single
+table. These predicates are pushed down to the loading of objects: they are
+converted into hints when the column is indexed, and they filter the objects
+of each table before tuples are built.
+
+Comparisons (<, <=, >, >=) of a column with a number or a date are converted
+into hints when the column has a range index. As they do not compare values
+exactly as criterions do (dates are compared as scores), the criterions they
+come from are still evaluated on rows.
+
+Criterions are analysed through their shapes: the shape of an expression is
+its structure (columns, operators, constants and types of bound parameters),
+without the values of its bound parameters, which are collected separately
+in a parameter vector. Queries that only differ by the values they compare
+have the same shapes: the predicates that can be pushed down are computed
+once for each shape, as templates whose values are taken from the parameter
+vectors of the criterions (see build_plan). Shapes are also the keys of the
+compiled criterions (see BooleanExpression).
+
+"""
+
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import BinaryExpression
+from sqlalchemy.sql.elements import BindParameter, BooleanClauseList, ClauseList, False_, Grouping, Null, True_, \
+    UnaryExpression
+
+from lib.rome.driver.database_driver import RangeHint, index_score
+from lib.rome.utils.LRUCache import LRUCache
+
+
+SCALAR_TYPES = (int, long, float, bool, basestring)
+
+RANGE_OPERATORS = {
+    operators.gt: "gt",
+    operators.ge: "ge",
+    operators.lt: "lt",
+    operators.le: "le"
+}
+
+COMPARISON_OPERATORS = frozenset([operators.eq, operators.ne, operators.lt, operators.le, operators.gt,
+                                  operators.ge, operators.is_, operators.isnot, operators.in_op, operators.notin_op])
+
+# shapes of operands whose values do not depend on rows
+CONSTANT_SHAPES = ["constant", "parameter", "parameters", "list"]
+
+# pushdown decisions of the criterions of queries, keyed by their shapes
+PLAN_TEMPLATES = LRUCache(10000)
+
+
+class UnsupportedExpression(Exception):
+    pass
+
+
+def convert_bound_value(parameter):
+    """Return the value of a bound parameter, as the evaluation of criterions
+    does: values of parameters that target an "id" are converted to integers."""
+    value = parameter.value
+    orig_key = getattr(parameter, "_orig_key", "")
+    if orig_key == "id" or orig_key.startswith("id_"):
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+def is_scalar(value):
+    return value is None or isinstance(value, SCALAR_TYPES)
+
+
+def is_scalar_type(value_type):
+    return value_type is type(None) or issubclass(value_type, SCALAR_TYPES)
+
+
+def comparison_operator(exp):
+    """Return the operator of a comparison, or "REGEXP" for regular
+    expressions (custom operators are created for each expression)."""
+    if exp.operator in COMPARISON_OPERATORS:
+        return exp.operator
+    if getattr(exp.operator, "opstring", None) == "REGEXP":
+        return "REGEXP"
+    raise UnsupportedExpression(exp)
+
+
+def operand_shape(operand, parameters):
+    """Return the shape of an operand of a comparison, and append the values
+    of its bound parameters to the given parameter vector. The values of a
+    list of bound parameters (IN) are a single parameter."""
+    if isinstance(operand, Null):
+        return ("constant", None)
+    if isinstance(operand, True_):
+        return ("constant", True)
+    if isinstance(operand, False_):
+        return ("constant", False)
+    if isinstance(operand, BindParameter):
+        value = convert_bound_value(operand)
+        parameters.append(value)
+        return ("parameter", type(value))
+    if isinstance(operand, Grouping) and isinstance(operand.element, ClauseList):
+        values = []
+        shapes = tuple(operand_shape(x, values) for x in operand.element.clauses)
+        if any(x[0] not in CONSTANT_SHAPES for x in shapes):
+            raise UnsupportedExpression(operand)
+        if all(x[0] == "parameter" for x in shapes):
+            parameters.append(values)
+            return ("parameters", frozenset(x[1] for x in shapes))
+        parameters.extend(values)
+        return ("list", shapes)
+    if hasattr(operand, "key") and hasattr(getattr(operand, "table", None), "name"):
+        return ("column", operand.table.name, operand.key)
+    raise UnsupportedExpression(operand)
+
+
+def clause_shape(exp, parameters):
+    """Return the shape of a sqlalchemy clause, and append the values of its
+    bound parameters to the given parameter vector. UnsupportedExpression is
+    raised if the clause contains something else than comparisons of columns
+    and constants, combined with AND, OR and NOT."""
+    if type(exp) is BinaryExpression:
+        operator = comparison_operator(exp)
+        left = operand_shape(exp.left, parameters)
+        right = operand_shape(exp.right, parameters)
+        return ("comparison", operator, left, right)
+    if type(exp) is BooleanClauseList and exp.operator in [operators.and_, operators.or_]:
+        kind = "and" if exp.operator is operators.and_ else "or"
+        return (kind, tuple(clause_shape(x, parameters) for x in exp.clauses))
+    if type(exp) is UnaryExpression and exp.operator is operators.inv:
+        return ("not", clause_shape(exp.element, parameters))
+    if type(exp) is Grouping:
+        return clause_shape(exp.element, parameters)
+    raise UnsupportedExpression(exp)
+
+
+def criterion_shape(criterion):
+    """Return the (shape, parameter vector) pair of a criterion."""
+    if hasattr(criterion, "shape"):
+        return (criterion.shape, criterion.parameters)
+    parameters = []
+    try:
+        return (clause_shape(criterion, parameters), parameters)
+    except UnsupportedExpression:
+        return (("eval", None), [])
+
+
+def parameter_count(shape):
+    """Return the number of values of the parameter vector of a shape."""
+    kind = shape[0]
+    if kind in ["parameter", "parameters"]:
+        return 1
+    if kind == "comparison":
+        return parameter_count(shape[2]) + parameter_count(shape[3])
+    if kind in ["list", "and", "or"]:
+        return sum(parameter_count(x) for x in shape[1])
+    if kind in ["not", "expression", "child"]:
+        return parameter_count(shape[-1])
+    return 0
+
+
+class Predicate(object):
+    """A predicate on a single column of a single table."""
+
+    def __init__(self, tablename, attribute, operator, value=None):
+        self.tablename = tablename
+        self.attribute = attribute
+        self.operator = operator
+        self.value = value
+
+    def match(self, obj):
+        """Check if the given object (as stored in database) satisfies the
+        predicate."""
+        if self.attribute not in obj:
+            return False
+        value = obj[self.attribute]
+        if self.operator == "eq":
+            return value == self.value
+        if self.operator == "in":
+            return value in self.value
+        if self.operator == "is_null":
+            return value is None
+        if self.operator == "is_not_null":
+            return value is not None
+        return False
+
+    def to_hint(self):
+        """Return a hint that can be used to find candidates with a secondary
+        index, or None if the predicate cannot be used with an index."""
+        if self.operator == "eq" and self.value is not None:
+            return (self.attribute, "%s" % (self.value))
+        if self.operator == "in":
+            return (self.attribute, map(lambda x: "%s" % (x), self.value))
+        return None
+
+    def to_range_hint(self):
+        """Return a hint that can be used to find candidates with a range
+        index (the value of a range predicate is a score)."""
+        if self.operator in ["gt", "ge"]:
+            return (self.attribute, RangeHint(self.value, None, self.operator == "gt", False))
+        return (self.attribute, RangeHint(None, self.value, False, self.operator == "lt"))
+
+    def is_enforced_by_index(self):
+        """Check if the objects found with the hint of this predicate in an
+        exact index satisfy the predicate: indexed values are strings, which
+        only compare as the stored values when these are strings."""
+        if self.operator == "eq":
+            return isinstance(self.value, basestring)
+        if self.operator == "in":
+            return all(isinstance(x, basestring) for x in self.value)
+        return False
+
+    def __repr__(self):
+        return "Predicate(%s.%s %s %s)" % (self.tablename, self.attribute, self.operator, self.value)
+
+
+def conjunction_terms(shape, offset=0):
+    """Return the terms of the conjunction described by a shape, as (shape,
+    offset of its parameters in the parameter vector) pairs."""
+    kind = shape[0]
+    if kind in ["expression", "child"]:
+        return conjunction_terms(shape[-1], offset)
+    if kind == "and" or (kind == "or" and len(shape[1]) == 1):
+        result = []
+        for term in shape[1]:
+            result += conjunction_terms(term, offset)
+            offset += parameter_count(term)
+        return result
+    return [(shape, offset)]
+
+
+def predicate_template(shape, offset):
+    """Convert the shape of a comparison into a (tablename, attribute,
+    operator, parameter index) template of predicate, or return None if the
+    comparison is not a simple predicate."""
+    if shape[0] != "comparison" or shape[2][0] != "column":
+        return None
+    (_, operator, (_, tablename, attribute), right) = shape
+    if operator is operators.eq and right[0] == "parameter" and is_scalar_type(right[1]):
+        return (tablename, attribute, "eq", offset)
+    if operator is operators.in_op and right[0] == "parameters" and all(is_scalar_type(x) for x in right[1]):
+        return (tablename, attribute, "in", offset)
+    if operator is operators.is_ and right == ("constant", None):
+        return (tablename, attribute, "is_null", None)
+    if operator is operators.isnot and right == ("constant", None):
+        return (tablename, attribute, "is_not_null", None)
+    return None
+
+
+def range_predicate_template(shape, offset):
+    """Convert the shape of a comparison of a column with a parameter into a
+    template of range predicate, or return None. Whether the value of the
+    parameter has a score is checked when the template is instantiated."""
+    if shape[0] != "comparison" or shape[2][0] != "column" or shape[3][0] != "parameter":
+        return None
+    (_, operator, (_, tablename, attribute), _) = shape
+    if operator not in RANGE_OPERATORS:
+        return None
+    return (tablename, attribute, RANGE_OPERATORS[operator], offset)
+
+
+def criterion_template(tablenames, shape):
+    """Return the pushdown decisions of a criterion: the templates of the
+    predicates equivalent to the criterion (None if the criterion cannot be
+    fully converted into predicates of the given tables), and the templates
+    of the range predicates it implies."""
+    terms = conjunction_terms(shape)
+    range_predicates = filter(lambda x: x is not None and x[0] in tablenames,
+                              map(lambda (term, offset): range_predicate_template(term, offset), terms))
+    predicates = map(lambda (term, offset): predicate_template(term, offset), terms)
+    if len(predicates) == 0 or any(x is None or x[0] not in tablenames for x in predicates):
+        predicates = None
+    return (predicates, range_predicates)
+
+
+def plan_template(tablenames, shapes):
+    """Return the pushdown decisions of criterions of the given shapes, which
+    are computed once for each combination of tables and shapes."""
+    key = (tuple(tablenames), tuple(shapes))
+    template = PLAN_TEMPLATES.get(key)
+    if template is None:
+        template = map(lambda x: criterion_template(tablenames, x), shapes)
+        PLAN_TEMPLATES.put(key, template)
+    return template
+
+
+class QueryPlan(object):
+    """Result of the analysis of the criterions of a query: predicates pushed
+    down to each table, and criterions that remain to be evaluated on rows."""
+
+    def __init__(self, tablenames):
+        self.predicates = dict((tablename, []) for tablename in tablenames)
+        self.range_predicates = dict((tablename, []) for tablename in tablenames)
+        self.residual_criterions = []
+
+    def hints(self, tablename, indexed_attributes):
+        """Hints that can be given to the driver to load the objects of the
+        given table."""
+        result = []
+        for predicate in self.predicates.get(tablename, []):
+            if predicate.attribute == "id" or predicate.attribute in indexed_attributes:
+                hint = predicate.to_hint()
+                if hint is not None:
+                    result += [hint]
+        return result
+
+    def range_hints(self, tablename, range_indexed_attributes):
+        """Hints that can be given to the driver to load the objects of the
+        given table with its range indexes."""
+        return [x.to_range_hint() for x in self.range_predicates.get(tablename, [])
+                if x.attribute in range_indexed_attributes]
+
+    def filter(self, tablename, objects, exact_indexes=[]):
+        """Lazily filter the objects of the given table with the predicates
+        pushed down to this table. Predicates enforced by the exact indexes
+        used to load the objects are not evaluated again."""
+        predicates = filter(lambda x: not (x.attribute in exact_indexes and x.is_enforced_by_index()),
+                            self.predicates.get(tablename, []))
+        if len(predicates) == 0:
+            return objects
+        return (x for x in objects if all(predicate.match(x) for predicate in predicates))
+
+
+def build_plan(tablenames, criterions):
+    """Push down the predicates found in the criterions to the given tables:
+    the templates of predicates of the shapes of the criterions are
+    instantiated with their parameter vectors."""
+    plan = QueryPlan(tablenames)
+    shapes = map(criterion_shape, criterions)
+    template = plan_template(tablenames, map(lambda x: x[0], shapes))
+    for (criterion, (_, parameters), (predicates, range_predicates)) in zip(criterions, shapes, template):
+        for (tablename, attribute, operator, index) in range_predicates:
+            score = index_score(parameters[index])
+            if score is not None:
+                plan.range_predicates[tablename] += [Predicate(tablename, attribute, operator, score)]
+        if predicates is None:
+            plan.residual_criterions += [criterion]
+            continue
+        for (tablename, attribute, operator, index) in predicates:
+            value = parameters[index] if index is not None else None
+            plan.predicates[tablename] += [Predicate(tablename, attribute, operator, value)]
+    return plan
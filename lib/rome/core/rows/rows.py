@@ -8,10 +8,17 @@ import time
 from sqlalchemy.util._collections import KeyedTuple
 
 import uuid
-from lib.rome.core.utils import get_objects, is_novabase
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.utils import get_objects, is_novabase, get_model_metadata
+from lib.rome.conf.Configuration import get_config
 
 from lib.rome.core.models import get_model_classname_from_tablename, get_model_class_from_name
-from lib.rome.core.rows.rows_experimental import building_tuples as building_tuples_experimental
+from lib.rome.core.rows.rows_experimental import building_tuples as building_tuples_experimental, object_key, \
+    join_template
+from lib.rome.core.rows.planner import build_plan
+from lib.rome.core.rows.ordering import sort_rows
+from lib.rome.core.rows.aggregation import aggregate_rows, group_rows
+from lib.rome.core.rows.columnar import columnar_enabled, load_table, aggregate, join_tuples
 
 from lib.rome.core.lazy import LazyValue
 
@@ -176,10 +183,21 @@ def building_tuples(list_results, labels, criterions, hints=[]):
                 results += [tuple(ordered_t)]
         return results
 
-def construct_rows(models, criterions, hints, session=None):
+def construct_rows(models, criterions, hints, session=None, ordering=[], limit=None, offset=0, grouping=[],
+                   batch_size=None):
 
     """This function constructs the rows that corresponds to the current orm.
-    :return: a list of row, according to sqlalchemy expectation
+    Rows are produced by a generator: objects are fetched, and criterions
+    evaluated, only as long as rows are consumed (except when rows have to be
+    sorted or aggregated, or when several tables are joined).
+    :param ordering: a list of (tablename, attribute, descending) triples
+    :param grouping: a list of (tablename, attribute) pairs (GROUP BY)
+    :param batch_size: when given, rows are produced by batches of batch_size
+    rows that belong to different requests, so that the objects cached for a
+    request (see get_request_cache) can be freed once its rows are consumed
+    :param limit: maximum number of rows (None for no limit)
+    :param offset: number of rows skipped
+    :return: a generator of rows, according to sqlalchemy expectation
     """
 
     current_milli_time = lambda: int(round(time.time() * 1000))
@@ -216,20 +234,82 @@ def construct_rows(models, criterions, hints, session=None):
                 columns.add(attribute)
     part2_starttime = current_milli_time()
 
+    # pushing down simple predicates to the loading of objects
+    plan = build_plan(labels, criterions)
+
     # loading objects (from database)
+    columnar = columnar_enabled()
+    columnar_tables = []
     list_results = []
+    # rows are produced in the requested order when the objects of a single
+    # table are read with the range index of the (only) ordering attribute.
+    presorted = False
+    end = offset + limit if limit is not None else None
     for selectable in model_set:
         tablename = find_table_name(selectable._model)
-        authorized_secondary_indexes = get_attribute(selectable._model, "_secondary_indexes", [])
+        metadata = get_model_metadata(selectable._model)
+        if (end is not None and not columnar and len(model_set) == 1 and len(ordering) == 1 and
+                ordering[0][0] == tablename and ordering[0][1] in metadata.range_indexes):
+            objects = database_driver.get_driver().iter_by_range_index(
+                tablename, ordering[0][1], descending=ordering[0][2], batch_size=get_config().batch_size(),
+                first_batch_size=max(1, end))
+            if objects is not None:
+                presorted = True
+                list_results += [plan.filter(tablename, objects)]
+                continue
+        authorized_secondary_indexes = metadata.secondary_indexes
         selected_hints = filter(lambda x: x.table_name == tablename and (x.attribute == "id" or x.attribute in authorized_secondary_indexes), hints)
         reduced_hints = map(lambda x:(x.attribute, x.value), selected_hints)
-        objects = get_objects(tablename, request_uuid=request_uuid, skip_loading=False, hints=reduced_hints)
-        list_results += [objects]
+        for hint in plan.hints(tablename, authorized_secondary_indexes) + plan.range_hints(tablename, metadata.range_indexes):
+            if hint not in reduced_hints:
+                reduced_hints += [hint]
+        if columnar:
+            # objects are selected once the aggregates and joins that can be
+            # vectorised are known
+            load_objects = lambda: get_objects(tablename, request_uuid=request_uuid, skip_loading=False,
+                                               hints=reduced_hints)
+            table = load_table(tablename, load_objects, complete=len(reduced_hints) == 0)
+            columnar_tables += [(table, table.mask(plan.predicates[tablename]))]
+            continue
+        # objects selected with exact indexes satisfy the predicates of their hints
+        exact = False
+        if len(reduced_hints) > 0:
+            (objects, exact) = database_driver.get_driver().getall_exact(tablename, hints=reduced_hints)
+        else:
+            objects = get_objects(tablename, request_uuid=request_uuid, skip_loading=False, hints=reduced_hints)
+        exact_indexes = authorized_secondary_indexes if exact else []
+        list_results += [plan.filter(tablename, objects, exact_indexes=exact_indexes)]
     part3_starttime = current_milli_time()
 
+    # aggregates on a single table are computed on columns (grouped
+    # aggregates are computed on rows)
+    if (columnar and len(columnar_tables) == 1 and len(plan.residual_criterions) == 0 and len(grouping) == 0 and
+            all_selectable_are_functions(models)):
+        (table, mask) = columnar_tables[0]
+        functions = [x._function for x in models if (not x.is_hidden) or x._is_function]
+        final_row = aggregate(table, mask, functions)
+        if final_row is not None:
+            yield final_row
+            return
+
+    # pairs of objects of two tables joined on numeric columns are computed
+    # on columns
+    tuples = None
+    if columnar and len(columnar_tables) == 2 and labels[0] != labels[1]:
+        (edges, components) = join_template(labels, criterions)
+        if len(edges) == 1:
+            tuples = join_tuples(columnar_tables, edges[0])
+    if columnar and tuples is None:
+        list_results = map(lambda x: x[0].select(x[1]), columnar_tables)
+
     # construct the cartesian product
     # tuples = building_tuples(list_results, labels, criterions)
-    tuples = building_tuples_experimental(list_results, labels, criterions, hints)
+    if tuples is None and len(list_results) == 1:
+        # objects of a single table are filtered while they are fetched
+        tuples = ([x] for x in list_results[0])
+    elif tuples is None:
+        list_results = map(lambda x: list(x), list_results)
+        tuples = building_tuples_experimental(list_results, labels, criterions, hints)
     part4_starttime = current_milli_time()
 
     # # filtering tuples (cartesian product)
@@ -240,64 +320,87 @@ def construct_rows(models, criterions, hints, session=None):
     # #     criterion
     # #     pass
     #
-    indexed_rows = {}
-    for product in tuples:
-        if len(product) > 0:
-            row = KeyedTuple(product, labels=labels)
-            row_index_key = "%s" % (str(row))
-
-            if row_index_key in indexed_rows:
-                continue
-
-            all_criterions_satisfied = True
-
-            for criterion in criterions:
-                if not criterion.evaluate(row):
-                    all_criterions_satisfied = False
-            if all_criterions_satisfied:
-                indexed_rows[row_index_key] = True
-                rows += [extract_sub_row(row, model_set)]
+    def filter_tuples():
+        indexed_rows = {}
+        for product in tuples:
+            if len(product) > 0:
+                row = KeyedTuple(product, labels=labels)
+                row_index_key = tuple(map(lambda x: object_key(x), product))
+
+                if row_index_key in indexed_rows:
+                    continue
+
+                all_criterions_satisfied = True
+
+                for criterion in plan.residual_criterions:
+                    if not criterion.evaluate(row):
+                        all_criterions_satisfied = False
+                if all_criterions_satisfied:
+                    indexed_rows[row_index_key] = True
+                    yield extract_sub_row(row, model_set)
+    showable_selection = [x for x in models if (not x.is_hidden) or x._is_function]
+    if all_selectable_are_functions(models) or (len(grouping) > 0 and any(x._is_function for x in showable_selection)):
+        # aggregates are computed while rows are streamed
+        rows = filter_tuples()
+    elif any(x._is_function for x in showable_selection):
+        rows = list(filter_tuples())
+    elif presorted:
+        rows = sort_rows(filter_tuples(), labels, [], offset=offset, limit=limit)
+    else:
+        rows = sort_rows(filter_tuples(), labels, ordering, offset=offset, limit=limit)
     part5_starttime = current_milli_time()
     deconverter = get_decoder(request_uuid=request_uuid)
     # reordering tuples (+ selecting attributes)
-    final_rows = []
-    showable_selection = [x for x in models if (not x.is_hidden) or x._is_function]
     part6_starttime = current_milli_time()
-    # selecting attributes
-    if all_selectable_are_functions(models):
-        final_row = []
-        for selection in showable_selection:
-            value = selection._function._function(rows)
-            final_row += [value]
+    def selected_values(row, selection):
+        current_table_name = find_table_name(selection._model)
+        key = current_table_name
+        if not is_novabase(row) and has_attribute(row, key):
+            value = get_attribute(row, key)
+        else:
+            value = row
+        if value is None:
+            return []
+        if selection._attributes != "*":
+            return [LazyValue(get_attribute(value, selection._attributes), request_uuid)]
+        return [LazyValue(value, request_uuid)]
+    # selecting attributes (rows are logged once they have all been consumed)
+    if len(grouping) > 0 and any(x._is_function for x in showable_selection):
+        final_rows = []
+        for group in group_rows(rows, labels, grouping, showable_selection):
+            final_row = []
+            for (selection, value) in group:
+                if selection._is_function:
+                    final_row += [deconverter.desimplify(value)]
+                else:
+                    final_row += selected_values(value, selection)
+            final_rows += [final_row]
+        for final_row in final_rows[offset:end]:
+            yield final_row
+    elif all_selectable_are_functions(models):
+        functions = map(lambda x: x._function, showable_selection)
+        final_row = aggregate_rows(rows, functions)
         final_row = map(lambda x: deconverter.desimplify(x), final_row)
-        return [final_row]
+        yield final_row
     else:
-        for row in rows:
+        for (index, row) in enumerate(rows):
+            if batch_size is not None and index > 0 and index % batch_size == 0:
+                request_uuid = uuid.uuid1()
             final_row = []
             for selection in showable_selection:
                 if selection._is_function:
                     value = selection._function._function(rows)
-                    final_row += [value]
+                    final_row += [LazyValue(value, request_uuid)]
                 else:
-                    current_table_name = find_table_name(selection._model)
-                    key = current_table_name
-                    if not is_novabase(row) and has_attribute(row, key):
-                        value = get_attribute(row, key)
-                    else:
-                        value = row
-                    if value is not None:
-                        if selection._attributes != "*":
-                            final_row += [get_attribute(value, selection._attributes)]
-                        else:
-                            final_row += [value]
+                    final_row += selected_values(row, selection)
 
             # final_row = map(lambda x: deconverter.desimplify(x), final_row)
-            final_row = map(lambda x: LazyValue(x, request_uuid), final_row)
 
             if len(showable_selection) == 1:
-                final_rows += final_row
+                for value in final_row:
+                    yield value
             else:
-                final_rows += [final_row]
+                yield final_row
     part7_starttime = current_milli_time()
 
     query_information = """{"building_query": %s, "loading_objects": %s, "building_tuples": %s, "filtering_tuples": %s, "reordering_columns": %s, "selecting_attributes": %s, "description": "%s", "timestamp": %i}""" % (
@@ -315,4 +418,34 @@ def construct_rows(models, criterions, hints, session=None):
     if file_logger_enabled:
         file_logger.info(query_information)
 
-    return final_rows
\ No newline at end of file
+def count_with_indexes(model, tablename, plan):
+    """Count the objects of a table matching the predicates of the given plan
+    with the driver, without loading them. It returns None if the driver
+    cannot count them exactly."""
+    driver = database_driver.get_driver()
+    metadata = get_model_metadata(model)
+    predicates = plan.predicates[tablename]
+    if len(plan.residual_criterions) > 0:
+        return None
+    if len(predicates) == 0:
+        return driver.count(tablename)
+    if not all(x.attribute in metadata.secondary_indexes and x.is_enforced_by_index() for x in predicates):
+        return None
+    return driver.count_exact(tablename, hints=plan.hints(tablename, metadata.secondary_indexes))
+
+def count_rows(models, criterions, hints, limit=None, offset=0):
+    """Count the rows of a query. Rows of a single table whose predicates are
+    enforced by indexes are counted by the driver, other rows are counted
+    while they are streamed (without building model objects)."""
+    from lib.rome.core.terms.terms import Function, Selection
+    model_set = extract_models(models)
+    labels = map(lambda x: find_table_name(x._model), model_set)
+    count = None
+    if len(model_set) == 1:
+        count = count_with_indexes(model_set[0]._model, labels[0], build_plan(labels, criterions))
+    if count is None:
+        selections = map(lambda x: Selection(x._model, x._attributes, is_hidden=True), model_set)
+        selections += [Selection(None, None, is_function=True, function=Function("count", "*"))]
+        count = next(construct_rows(selections, criterions, hints))[0]
+    count = max(0, count - offset)
+    return min(count, limit) if limit is not None else count
@@ -3,183 +3,265 @@ __author__ = 'jonathan'
 import itertools
 
 from lib.rome.core.expression.expression import *
+from sqlalchemy.sql import operators
 from sqlalchemy.sql.expression import BinaryExpression
-from lib.rome.core.utils import current_milli_time
-from sqlalchemy.util._collections import KeyedTuple
+from sqlalchemy.sql.elements import BooleanClauseList
 
 from lib.rome.core.models import get_model_classname_from_tablename, get_model_class_from_name
+from lib.rome.core.rows.planner import criterion_shape
+from lib.rome.core.utils import get_model_metadata
+from lib.rome.utils.LRUCache import LRUCache
 
-def intersect(b1, b2):
-    return [val for val in b1 if val in b2]
-
-def flatten(lis):
-    """Given a list, possibly nested to any level, return it flattened."""
-    new_lis = []
-    for item in lis:
-        if type(item) == type([]):
-            new_lis.extend(flatten(item))
-        else:
-            new_lis.append(item)
-    return new_lis
-
-# def flatten(l):
-#     return [item for sublist in l for item in sublist]
-
-def extract_table_data(term):
-    term_value = str(term)
-    if "." in term_value:
-        return {"table": term_value.split(".")[0], "column": term_value.split(".")[1]}
-    else:
-        return None
-
-def extract_joining_criterion(exp):
-    from lib.rome.core.expression.expression import BooleanExpression
-    if type(exp) is BooleanExpression:
-        return map(lambda x:extract_joining_criterion(x), exp.exps)
-    elif type(exp) is BinaryExpression:
-        return [[extract_table_data(exp.left)] + [extract_table_data(exp.right)]]
-    else:
+# joining conditions and connected components of queries, keyed by their
+# tables and the shapes of their criterions
+JOIN_TEMPLATES = LRUCache(10000)
+
+
+class JoinEdge(object):
+    """An equality between a column of a table and a column of another table."""
+
+    def __init__(self, table1, column1, table2, column2):
+        self.table1 = table1
+        self.column1 = column1
+        self.table2 = table2
+        self.column2 = column2
+
+    def tables(self):
+        return (self.table1, self.table2)
+
+    def column(self, tablename):
+        return self.column1 if tablename == self.table1 else self.column2
+
+    def other(self, tablename):
+        return self.table2 if tablename == self.table1 else self.table1
+
+    def __repr__(self):
+        return "JoinEdge(%s.%s = %s.%s)" % (self.table1, self.column1, self.table2, self.column2)
+
+
+def get_column_data(term):
+    if hasattr(term, "key") and hasattr(getattr(term, "table", None), "name"):
+        return (term.table.name, term.key)
+    return None
+
+
+def extract_conjuncts(exp):
+    """Return the expressions that are combined with a logical AND in the
+    given expression: only them can be used as joining conditions."""
+    if hasattr(exp, "is_boolean_expression"):
+        if exp.operator == "AND" or len(exp.exps) == 1:
+            return flatten_conjuncts(exp.exps)
         return []
+    if type(exp) is BooleanClauseList and exp.operator is operators.and_:
+        return flatten_conjuncts(exp.clauses)
+    return [exp]
 
-def extract_joining_criterion_from_relationship(rel, local_table):
-    local_tabledata = {"table": local_table, "column": rel.local_fk_field}
-    remote_tabledata = {"table": rel.remote_object_tablename, "column": rel.remote_object_field}
-    return [local_tabledata, remote_tabledata]
 
-def building_tuples(list_results, labels, criterions, hints=[]):
-    from lib.rome.core.rows.rows import get_attribute, set_attribute, has_attribute
-    mode = "experimental"
-    if mode is "cartesian_product":
-        cartesian_product = []
-        for element in itertools.product(*list_results):
-            cartesian_product += [element]
-        return cartesian_product
-    elif mode is "experimental":
-        steps = zip(list_results, labels)
-        candidates_values = {}
-        candidates_per_table = {}
-        joining_criterions = []
-        non_joining_criterions = {}
-        # Initialising candidates per table
-        for each in labels:
-            candidates_per_table[each] = {}
-        # Collecting joining expressions
-        for criterion in criterions:
-            # if criterion.operator in  "NORMAL":
-            for exp in criterion.exps:
-                for joining_criterion in extract_joining_criterion(exp):
-                    foo = [x for x in joining_criterion if x is not None]
-                    if len(foo) > 1:
-                        joining_criterions += [foo]
-                    else:
-                        # Extract here non joining criterions, and use it to filter objects
-                        # that are located in list_results
-                        exp_criterions = ([x for x in flatten(joining_criterion) if x is not None])
-                        for non_joining_criterion in exp_criterions:
-                            tablename = non_joining_criterion["table"]
-                            column = non_joining_criterion["column"]
-                            if not tablename in non_joining_criterions:
-                                non_joining_criterions[tablename] = []
-                            non_joining_criterions[tablename] += [{
-                                "tablename": tablename,
-                                "column": column,
-                                "exp": exp,
-                                "criterion": criterion
-                            }]
-        # # Filtering list_of_results with non_joining_criterions
-        # corrected_list_results = []
-        # for results in list_results:
-        #     cresults = []
-        #     for each in results:
-        #         tablename = each["nova_classname"]
-        #         if tablename in non_joining_criterions:
-        #             do_add = True
-        #             for criterion in non_joining_criterions[tablename]:
-        #                 if not criterion["criterion"].evaluate(KeyedTuple([each], labels=[tablename])):
-        #                     do_add = False
-        #                     break
-        #             if do_add:
-        #                 cresults += [each]
-        #     corrected_list_results += [cresults]
-        # list_results = corrected_list_results
-        # Consolidating joining criterions with data stored in relationships
-        done_index = {}
-        for step in steps:
-            tablename = step[1]
-            model_classname = get_model_classname_from_tablename(tablename)
-            fake_instance = get_model_class_from_name(model_classname)()
-            relationships = fake_instance.get_relationships()
-            for r in relationships:
-                criterion = extract_joining_criterion_from_relationship(r, tablename)
-                key1 = criterion[0]["table"]+"__"+criterion[1]["table"]
-                key2 = criterion[1]["table"]+"__"+criterion[0]["table"]
-                if key1 not in done_index and key2 not in criterion[0]["table"] in labels and criterion[1]["table"] in labels:
-                    joining_criterions += [criterion]
-                    done_index[key1] = True
-                    done_index[key2] = True
-                pass
-        # Collecting for each of the aforementioned expressions, its values <-> objects
-        if len(joining_criterions) > 0:
-            for criterion in joining_criterions:
-                for each in criterion:
-                    key = "%s.%s" % (each["table"], each["column"])
-                    index_list_results = labels.index(each["table"])
-                    objects = list_results[index_list_results]
-                    if not candidates_values.has_key(key):
-                        candidates_values[key] = {}
-                    for object in objects:
-                        value_key = get_attribute(object, each["column"])
-                        skip = False
-                        for hint in hints:
-                            if each["table"] == hint.table_name and hint.attribute in object and object[hint.attribute] != hint.value:
-                                skip = True
-                                break
-                        if not skip:
-                            if not candidates_values[key].has_key(value_key):
-                                candidates_values[key][value_key] = {}
-                            object_hash = str(object).__hash__()
-                            object_table = object["nova_classname"]
-                            candidates_values[key][value_key][object_hash] = {"value": value_key, "object": object}
-                            candidates_per_table[object_table][object_hash] = object
-        else:
-            for each in steps:
-                for each_object in each[0]:
-                    object_hash = str(each_object).__hash__()
-                    object_table = each_object["nova_classname"]
-                    candidates_per_table[object_table][object_hash] = each_object
-        # Progressively reduce the list of results
-        results = []
-        processed_models = []
-        if len(steps) > 0:
-            step = steps[0]
-            results = map(lambda  x: [candidates_per_table[step[1]][x]], candidates_per_table[step[1]])
-            processed_models += [step[1]]
-        remaining_models = map(lambda x:x[1], steps[1:])
-        for step in steps[1:]:
-            for criterion in joining_criterions:
-                criterion_models = map(lambda x: x["table"], criterion)
-                candidate_models = [step[1]] + processed_models
-                if len(intersect(candidate_models, criterion_models)) > 1:
-                    processed_models += [step[1]]
-                    remaining_models = filter(lambda x: x ==step[1], remaining_models)
-                    # try:
-                    current_criterion_option = filter(lambda x:x["table"]==step[1], criterion)
-                    remote_criterion_option = filter(lambda x:x["table"]!=step[1], criterion)
-                    if not (len(current_criterion_option) > 0 and len(remote_criterion_option) > 0):
-                        continue
-                    current_criterion_part = current_criterion_option[0]
-                    remote_criterion_part = remote_criterion_option[0]
-                    new_results = []
-                    for each in results:
-                        existing_tuple_index = processed_models.index(remote_criterion_part["table"])
-                        existing_value = get_attribute(each[existing_tuple_index], remote_criterion_part["column"])
-                        if existing_value is not None:
-                            key = "%s.%s" % (current_criterion_part["table"], current_criterion_part["column"])
-                            candidates_value_index = candidates_values[key]
-                            candidates = candidates_value_index[existing_value] if existing_value in candidates_value_index else {}
-                            for candidate_key in candidates:
-                                new_results += [each + [candidates[candidate_key]["object"]]]
-                    results = new_results
+def flatten_conjuncts(exps):
+    result = []
+    for exp in exps:
+        result += extract_conjuncts(exp)
+    return result
+
+
+def extract_joining_edges(criterions, labels):
+    """Collect equalities between columns of two tables of the query."""
+    result = []
+    for exp in flatten_conjuncts(criterions):
+        if type(exp) is not BinaryExpression or exp.operator is not operators.eq:
+            continue
+        left = get_column_data(exp.left)
+        right = get_column_data(exp.right)
+        if left is None or right is None or left[0] == right[0]:
+            continue
+        if left[0] in labels and right[0] in labels:
+            result += [JoinEdge(left[0], left[1], right[0], right[1])]
+    return result
+
+
+relationship_edges_memory = {}
+
+
+def get_relationship_edges(tablename):
+    """Joining conditions of the relationships of a model (computed once per
+    table)."""
+    if tablename not in relationship_edges_memory:
+        result = []
+        model_class = get_model_class_from_name(get_model_classname_from_tablename(tablename))
+        if model_class is not None:
+            for r in get_model_metadata(model_class).relationships:
+                result += [JoinEdge(tablename, r.local_fk_field, r.remote_object_tablename, r.remote_object_field)]
+        relationship_edges_memory[tablename] = result
+    return relationship_edges_memory[tablename]
+
+
+def collect_joining_edges(criterions, labels):
+    """Joining conditions of the query: equalities found in criterions, and
+    relationships between tables that are not joined by a criterion."""
+    edges = extract_joining_edges(criterions, labels)
+    joined_pairs = set(map(lambda x: frozenset(x.tables()), edges))
+    for tablename in labels:
+        for edge in get_relationship_edges(tablename):
+            pair = frozenset(edge.tables())
+            if edge.other(tablename) in labels and len(pair) > 1 and pair not in joined_pairs:
+                edges += [edge]
+                joined_pairs.add(pair)
+    return edges
+
+
+def object_key(obj):
+    from lib.rome.core.rows.rows import get_attribute
+    key = get_attribute(obj, "id")
+    return key if key is not None else str(obj)
+
+
+def unique_objects(objects):
+    """Remove duplicated objects (an object may be returned twice by a scan)."""
+    result = []
+    known_keys = set()
+    for obj in objects:
+        key = object_key(obj)
+        if key not in known_keys:
+            known_keys.add(key)
+            result += [obj]
+    return result
+
+
+def plan_join_order(component, tables, edges):
+    """Order the tables of a connected component: the largest table is
+    streamed, and the other tables are joined by increasing cardinality. For
+    each table, it returns the edge used to probe its hash table, and the
+    edges that are checked on matching candidates. The order depends on the
+    number of objects loaded for each table: contrary to the joining
+    conditions (see join_template), it is computed for each query."""
+    start = max(component, key=lambda x: len(tables[x]))
+    order = [(start, None, [])]
+    processed = set([start])
+    while len(processed) < len(component):
+        candidates = [x for x in component if x not in processed and
+                      any(e.other(x) in processed for e in edges if x in e.tables())]
+        tablename = min(candidates, key=lambda x: len(tables[x]))
+        table_edges = [e for e in edges if tablename in e.tables() and e.other(tablename) in processed]
+        order += [(tablename, table_edges[0], table_edges[1:])]
+        processed.add(tablename)
+    return order
+
+
+def build_hash_table(objects, column):
+    from lib.rome.core.rows.rows import get_attribute
+    result = {}
+    for obj in objects:
+        value = get_attribute(obj, column)
+        if value is not None:
+            result.setdefault(value, []).append(obj)
+    return result
+
+
+def probe(partial_tuples, positions, tablename, edge, other_edges, hash_table):
+    from lib.rome.core.rows.rows import get_attribute
+    remote_table = edge.other(tablename)
+    remote_position = positions[remote_table]
+    remote_column = edge.column(remote_table)
+    for partial_tuple in partial_tuples:
+        value = get_attribute(partial_tuple[remote_position], remote_column)
+        if value is None:
+            continue
+        for candidate in hash_table.get(value, []):
+            satisfied = True
+            for other_edge in other_edges:
+                other_table = other_edge.other(tablename)
+                candidate_value = get_attribute(candidate, other_edge.column(tablename))
+                if candidate_value is None or candidate_value != get_attribute(
+                        partial_tuple[positions[other_table]], other_edge.column(other_table)):
+                    satisfied = False
                     break
-                continue
-        return results
+            if satisfied:
+                yield partial_tuple + [candidate]
+
+
+def join_component(component, tables, edges):
+    """Join the tables of a connected component with hash joins. It returns
+    the ordered list of tables, and the joined tuples."""
+    order = plan_join_order(component, tables, edges)
+    (start, _, _) = order[0]
+    positions = {start: 0}
+    partial_tuples = ([x] for x in tables[start])
+    for (tablename, edge, other_edges) in order[1:]:
+        hash_table = build_hash_table(tables[tablename], edge.column(tablename))
+        partial_tuples = probe(partial_tuples, dict(positions), tablename, edge, other_edges, hash_table)
+        positions[tablename] = len(positions)
+    return (map(lambda x: x[0], order), partial_tuples)
+
+
+def find_components(labels, edges):
+    """Group tables that are connected by joining conditions."""
+    components = []
+    remaining = list(labels)
+    while len(remaining) > 0:
+        component = [remaining.pop(0)]
+        i = 0
+        while i < len(component):
+            for edge in edges:
+                if component[i] in edge.tables():
+                    other = edge.other(component[i])
+                    if other in remaining:
+                        remaining.remove(other)
+                        component += [other]
+            i += 1
+        components += [component]
+    return components
+
+
+def is_cacheable_criterion(criterion, shape):
+    """Check if the joining conditions found in a criterion are determined by
+    its shape: parts that are evaluated without a shape may contain some."""
+    if hasattr(criterion, "cacheable"):
+        return criterion.cacheable
+    return shape[0] != "eval"
+
+
+def join_template(labels, criterions):
+    """Return the joining conditions of a query and the connected components
+    of its tables. They only depend on the tables and on the shapes of the
+    criterions, and are computed once for each combination (when the shapes
+    describe the whole criterions)."""
+    shapes = map(lambda x: criterion_shape(x)[0], criterions)
+    key = None
+    if all(is_cacheable_criterion(x, y) for (x, y) in zip(criterions, shapes)):
+        key = (tuple(labels), tuple(shapes))
+        template = JOIN_TEMPLATES.get(key)
+        if template is not None:
+            return template
+    edges = collect_joining_edges(criterions, labels)
+    template = (edges, find_components(labels, edges))
+    if key is not None:
+        JOIN_TEMPLATES.put(key, template)
+    return template
+
+
+def building_tuples(list_results, labels, criterions, hints=[]):
+    """Build the tuples of objects that satisfy the joining conditions of the
+    query (equalities between columns of different tables, and relationships
+    between tables). Tables that are not connected are combined with a
+    cartesian product. Tuples are ordered according to labels."""
+    tables = dict(zip(labels, map(lambda x: unique_objects(x), list_results)))
+    (edges, components) = join_template(labels, criterions)
+    joined_components = []
+    for component in components:
+        joined_components += [join_component(component, tables, edges)]
+    if len(joined_components) == 1:
+        (component_labels, partial_tuples) = joined_components[0]
+        positions = map(lambda x: component_labels.index(x), labels)
+        for partial_tuple in partial_tuples:
+            yield [partial_tuple[i] for i in positions]
+    else:
+        component_labels = []
+        for (joined_labels, _) in joined_components:
+            component_labels += joined_labels
+        positions = map(lambda x: component_labels.index(x), labels)
+        materialized_components = map(lambda x: list(x[1]), joined_components)
+        for combination in itertools.product(*materialized_components):
+            merged_tuple = []
+            for partial_tuple in combination:
+                merged_tuple += partial_tuple
+            yield [merged_tuple[i] for i in positions]
@@ -54,6 +54,22 @@ class Session(object):
         from lib.rome.core.orm.query import Query
         return Query(*entities, **merge_dicts(kwargs, {"session": self}))
 
+    def bulk_save_objects(self, objects):
+        """Store new objects immediately, with batched requests (see
+        models.bulk_save)."""
+        from lib.rome.core.models import bulk_save
+        return bulk_save(objects, request_uuid=self.session_id)
+
+    def bulk_insert_mappings(self, mapper, mappings):
+        """Create and store objects of the given model class, from a list of
+        dictionnaries of values."""
+        objects = []
+        for mapping in mappings:
+            obj = mapper()
+            obj.update(mapping)
+            objects += [obj]
+        return self.bulk_save_objects(objects)
+
     def begin(self, *args, **kwargs):
         return SessionControlledExecution(session=self)
 
@@ -41,7 +41,7 @@ class Function:
             fieldname = field.split(".")[-1]
         filtered_rows = []
         for row in rows:
-            if not type(row) is list:
+            if not isinstance(row, (list, tuple)):
                 row = [row]
             for subrow in row:
                 table = get_attribute(subrow, "__tablename__", get_attribute(subrow, "nova_classname", None))
@@ -51,17 +51,31 @@ class Function:
         return result
 
     def count(self, rows):
-        collected_field_values = self.collect_field(rows, self._field)
-        return len(collected_field_values)
+        return reduce(self.accumulate, rows or [], self.initial_value())
 
     def sum(self, rows):
-        result = 0
-        collected_field_values = self.collect_field(rows, self._field)
-        try:
-            result = sum(collected_field_values)
-        except:
-            pass
-        return result
+        return reduce(self.accumulate, rows or [], self.initial_value())
+
+    # Functions are computed incrementally: value = accumulate(value, row)
+    # is called for each row, starting from initial_value().
+
+    def initial_value(self):
+        return 0
+
+    def accumulate(self, value, row):
+        if self._name == "count" and not "." in self._field:
+            # count(*)
+            return value + 1
+        collected_field_values = self.collect_field([row], self._field)
+        if self._name == "count":
+            return value + len(collected_field_values)
+        # NULL values (and values that cannot be summed) are ignored, as in SQL
+        for field_value in collected_field_values:
+            try:
+                value = value + field_value
+            except TypeError:
+                pass
+        return value
 
 class Hint():
 
@@ -11,8 +11,10 @@ import datetime as timeutils
 import logging
 from sqlalchemy import Column, Integer
 from sqlalchemy import DateTime
+from sqlalchemy.orm import configure_mappers
 
 import lib.rome.driver.database_driver as database_driver
+from lib.rome.conf.Configuration import get_config
 import time
 
 
@@ -103,16 +105,30 @@ def transform(data, deconverter, skip_loading):
     return result
 
 
-def get_objects(tablename, desimplify=True, request_uuid=None, skip_loading=False, hints=[]):
-    data = database_driver.get_driver().getall(tablename, hints=hints)
-    # if skip_loading:
-    #     return data
-    # else:
-    #     # from lib.rome.core.dataformat.deconverter import JsonDeconverter
-    #     # object_deconverter = JsonDeconverter(request_uuid=request_uuid)
-    #     # result = map(lambda x: transform(x, object_deconverter, skip_loading), data)
-    #     return result
-    return data
+def unique_objects(objects):
+    """Skip the objects whose id has already been produced: drivers that scan
+    tables by batches may return an object twice. The ids produced are kept
+    in a set, whose size grows with the number of objects (contrary to the
+    objects, which are not kept)."""
+    ids = set()
+    for obj in objects:
+        key = obj.get("id", None) if isinstance(obj, dict) else None
+        if key is not None:
+            if key in ids:
+                continue
+            ids.add(key)
+        yield obj
+
+
+def get_objects(tablename, desimplify=True, request_uuid=None, skip_loading=False, hints=[], batch_size=None):
+    """Return the objects of the given table. When no hint is given, objects
+    are returned by a generator that fetches them by batches."""
+    driver = database_driver.get_driver()
+    if len(hints) == 0:
+        if batch_size is None:
+            batch_size = get_config().batch_size()
+        return unique_objects(driver.iter_all(tablename, batch_size=batch_size))
+    return driver.getall(tablename, hints=hints)
 
 
 
@@ -159,6 +175,103 @@ class RelationshipModel(object):
         self.deleted_at = timeutils.utcnow()
         self.save(session=session)
 
+class RelationshipMetadata(object):
+    """Description of a relationship of a model class, independent from the
+    values of its instances."""
+
+    def __init__(self, local_fk_field, local_object_field, remote_object_field, remote_object_tablename, is_list):
+        self.local_fk_field = local_fk_field
+        self.local_object_field = local_object_field
+        self.remote_object_field = remote_object_field
+        self.remote_object_tablename = remote_object_tablename
+        self.is_list = is_list
+
+
+class ModelMetadata(object):
+    """Metadata of a model class: columns, relationships, foreign keys, default
+    values and secondary indexes (by equality and by range). It is computed
+    once per class, the first time it is needed, as relationships can only be
+    resolved once all the models have been declared."""
+
+    def __init__(self, model_class):
+        self.columns = set()
+        self.relationships = []
+        self.foreign_keys = []
+        self.default_values = {}
+        self.secondary_indexes = list(getattr(model_class, "_secondary_indexes", []))
+        self.range_indexes = list(getattr(model_class, "_range_indexes", []))
+        # indexes given to the driver when objects are stored
+        self.driver_indexes = self.secondary_indexes + map(database_driver.RangeIndex, self.range_indexes)
+
+        # relationships (and backrefs) are only known once mappers are configured
+        configure_mappers()
+        class_manager = model_class._sa_class_manager
+        mapper = model_class.__mapper__
+        for field in class_manager:
+            field_object = class_manager[field]
+            contain_comparator = hasattr(field_object, "comparator")
+            is_relationship = ("relationship" in str(field_object.comparator)
+                               if contain_comparator else False
+                               )
+            if is_relationship:
+                remote_local_pair = field_object.property.local_remote_pairs[0]
+                self.relationships += [RelationshipMetadata(
+                    remote_local_pair[0].name,
+                    field,
+                    remote_local_pair[1].name,
+                    str(remote_local_pair[1].table),
+                    field_object.property.uselist
+                )]
+            else:
+                self.columns.add(field)
+                try:
+                    field_column = mapper._props[field].columns[0]
+                    field_default_value = field_column.default.arg
+                    if not "function" in str(type(field_default_value)):
+                        self.default_values[field] = (field_column.name, field_default_value)
+                except:
+                    pass
+
+        table = getattr(model_class, "__table__", None)
+        if table is not None:
+            for fk in table.foreign_keys:
+                local_field_name = str(fk.parent).split(".")[-1]
+                remote_table_name = fk._colspec.split(".")[-2]
+                remote_field_name = fk._colspec.split(".")[-1]
+                self.foreign_keys += [(local_field_name, remote_table_name, remote_field_name)]
+        self.relationship_fields = set(map(lambda x: x.local_object_field, self.relationships))
+
+
+model_metadata_memory = {}
+
+
+def get_model_metadata(model_class):
+    if model_class not in model_metadata_memory:
+        model_metadata_memory[model_class] = ModelMetadata(model_class)
+    return model_metadata_memory[model_class]
+
+
+def invalidate_model_metadata(model_class):
+    model_metadata_memory.pop(model_class, None)
+
+
+def get_relationships(obj):
+    """Return the relationships of an object, with the values of its foreign
+    keys and of its related objects."""
+    result = []
+    for relationship in get_model_metadata(obj.__class__).relationships:
+        result += [RelationshipModel(
+            relationship.local_fk_field,
+            getattr(obj, relationship.local_fk_field),
+            relationship.local_object_field,
+            getattr(obj, relationship.local_object_field),
+            relationship.remote_object_field,
+            relationship.remote_object_tablename,
+            relationship.is_list
+        )]
+    return result
+
+
 class ModelBase(object):
     def get(self, key, default=None):
         pass
@@ -196,72 +309,30 @@ class ReloadableRelationMixin(TimestampMixin, SoftDeleteMixin, ModelBase):
                     pass
 
     def get_relationships(obj):
-        result = []
-
-        state = obj._sa_instance_state
-
-        for field in obj._sa_class_manager:
-            field_object = obj._sa_class_manager[field]
-            field_column = state.mapper._props[field]
-
-            contain_comparator = hasattr(field_object, "comparator")
-            is_relationship = ("relationship" in str(field_object.comparator)
-                               if contain_comparator else False
-                               )
-            if is_relationship:
-                remote_local_pair = field_object.property.local_remote_pairs[0]
-
-                local_fk_field = remote_local_pair[0].name
-                local_fk_value = getattr(obj, local_fk_field)
-                local_object_field = field
-                local_object_value = getattr(obj, local_object_field)
-                remote_object_field = remote_local_pair[1].name
-                remote_object_tablename = str(remote_local_pair[1].table)
-                is_list = field_object.property.uselist
-
-                result += [RelationshipModel(
-                    local_fk_field,
-                    local_fk_value,
-                    local_object_field,
-                    local_object_value,
-                    remote_object_field,
-                    remote_object_tablename,
-                    is_list
-                )]
-
-        return result
+        return get_relationships(obj)
 
     def update_foreign_keys(self, request_uuid=uuid.uuid1()):
         """Update foreign keys according to local fields' values."""
         # return
         from lazy import LazyReference
 
-        if hasattr(self, "metadata"):
-            metadata = self.metadata
-            tablename = self.__tablename__
-
-            if metadata and tablename in metadata.tables:
-                for fk in metadata.tables[tablename].foreign_keys:
-                    local_field_name = str(fk.parent).split(".")[-1]
-                    remote_table_name = fk._colspec.split(".")[-2]
-                    remote_field_name = fk._colspec.split(".")[-1]
-
-                    if hasattr(self, remote_table_name):
-                        pass
-                    else:
-                        """Remove the "s" at the end of the tablename"""
-                        remote_table_name = remote_table_name[:-1]
-                        pass
+        for (local_field_name, remote_table_name, remote_field_name) in get_model_metadata(self.__class__).foreign_keys:
+            if hasattr(self, remote_table_name):
+                pass
+            else:
+                """Remove the "s" at the end of the tablename"""
+                remote_table_name = remote_table_name[:-1]
+                pass
 
-                    try:
-                        remote_object = getattr(self, remote_table_name)
-                        remote_field_value = getattr(
-                            remote_object,
-                            remote_field_name
-                        )
-                        setattr(self, local_field_name, remote_field_value)
-                    except Exception as e:
-                        pass
+            try:
+                remote_object = getattr(self, remote_table_name)
+                remote_field_value = getattr(
+                    remote_object,
+                    remote_field_name
+                )
+                setattr(self, local_field_name, remote_field_value)
+            except Exception as e:
+                pass
         try:
             from lib.rome.core.dataformat import get_decoder
         except:
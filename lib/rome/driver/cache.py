@@ -0,0 +1,231 @@
+"""Cache module.
+
+This module contains a decorator of drivers that keeps the objects read from
+(or written to) the database in a process wide cache, keyed by their table and
+their key. Point reads (get, get_many) are served from the cache, while scans
+refresh the cached objects. An object is only replaced by a version whose
+"rome_version_number" is greater or equal to the cached one.
+
+When invalidation is enabled, the cache subscribes to the notifications sent
+by other processes when they modify objects (see
+RedisDriver.subscribe_invalidations): modified objects are evicted, and the
+keys matching secondary index hints are cached as well, until an object of
+their table is modified.
+
+Full scans (getall without hint, iter_all) are always made by the decorated
+driver, as the cache does not know whether it holds every object of a table.
+Scans whose hints are all id hints are made with point reads.
+
+Cached values are copied when they are stored and when they are returned, so
+that callers cannot modify them.
+
+"""
+
+import copy
+import threading
+
+from lib.rome.driver.database_driver import RangeHint
+from lib.rome.utils.LRUCache import LRUCache, approximate_size
+
+
+def get_version(value):
+    return value.get("rome_version_number", -1) if isinstance(value, dict) else -1
+
+
+def copy_value(value):
+    """Copy a cached object: its nested containers are copied as well."""
+    if any(isinstance(x, (dict, list, set)) for x in value.itervalues()):
+        return copy.deepcopy(value)
+    return dict(value)
+
+
+class CachedDriver(object):
+
+    def __init__(self, decorated, memory_budget, invalidation=False, index_results_count=10000):
+        self.decorated = decorated
+        self.cache = LRUCache(memory_budget, sizer=approximate_size)
+        self.index_results = LRUCache(index_results_count)
+        self.generations = {}
+        self.generations_lock = threading.Lock()
+        self.invalidation = invalidation and hasattr(decorated, "subscribe_invalidations")
+        self.subscription = None
+        if self.invalidation:
+            self.subscription = decorated.subscribe_invalidations(self.invalidate)
+
+    def __getattr__(self, attribute_name):
+        return getattr(self.decorated, attribute_name)
+
+    def cache_key(self, tablename, key):
+        return (tablename, "%s" % (key))
+
+    def store(self, tablename, key, value, generation=None):
+        """Keep a value in cache, unless a more recent version is cached. When
+        the value has been read, generation is the generation of its table
+        before the read: the value is not kept if the table has been modified
+        in the meantime, as the value may be outdated."""
+        if not isinstance(value, dict):
+            return
+
+        def can_replace(cached_value):
+            if generation is not None and generation != self.generation(tablename):
+                return False
+            return cached_value is None or get_version(cached_value) <= get_version(value)
+        self.cache.put_if(self.cache_key(tablename, key), copy_value(value), can_replace)
+
+    def store_all(self, tablename, values, generation=None):
+        for value in values:
+            if isinstance(value, dict) and "id" in value:
+                self.store(tablename, value["id"], value, generation=generation)
+
+    def evict(self, tablename, key):
+        self.cache.pop(self.cache_key(tablename, key))
+        self.increment_generation(tablename)
+
+    def generation(self, tablename):
+        return self.generations.get(tablename, 0)
+
+    def increment_generation(self, tablename):
+        """Results of secondary index hints are only valid while no object of
+        their table has been modified."""
+        with self.generations_lock:
+            self.generations[tablename] = self.generations.get(tablename, 0) + 1
+
+    def table_generation(self, tablename):
+        """Generations only change with the modifications made by other
+        processes when they are notified (see invalidation)."""
+        if not self.invalidation:
+            return None
+        with self.generations_lock:
+            # registered, so that invalidate(None, None) changes it
+            return self.generations.setdefault(tablename, 0)
+
+    def invalidate(self, tablename, key):
+        """Called when another process has modified an object (or when some
+        notifications may have been missed, in which case tablename is None)."""
+        if tablename is None:
+            with self.generations_lock:
+                for each in self.generations:
+                    self.generations[each] += 1
+                self.cache.clear()
+                self.index_results.clear()
+        else:
+            self.evict(tablename, key)
+
+    def stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        """Stop listening to invalidations: the cache is not used anymore."""
+        if self.subscription is not None:
+            self.subscription.stop()
+            self.subscription = None
+
+    def remove_key(self, tablename, key):
+        result = self.decorated.remove_key(tablename, key)
+        self.evict(tablename, key)
+        return result
+
+    def put(self, tablename, key, value, secondary_indexes=[]):
+        result = self.decorated.put(tablename, key, value, secondary_indexes=secondary_indexes)
+        self.store(tablename, key, value)
+        self.increment_generation(tablename)
+        return result
+
+    def put_many(self, items):
+        result = self.decorated.put_many(items)
+        for (tablename, key, value, _) in items:
+            self.store(tablename, key, value)
+        for tablename in set(map(lambda x: x[0], items)):
+            self.increment_generation(tablename)
+        return result
+
+    def put_if_version(self, tablename, key, value, expected_version, secondary_indexes=[]):
+        stored = self.decorated.put_if_version(tablename, key, value, expected_version,
+                                               secondary_indexes=secondary_indexes)
+        if stored:
+            self.store(tablename, key, value)
+            self.increment_generation(tablename)
+        else:
+            self.evict(tablename, key)
+        return stored
+
+    def get(self, tablename, key, hint=None):
+        if hint is None:
+            cached_value = self.cache.get(self.cache_key(tablename, key))
+            if cached_value is not None:
+                return copy_value(cached_value)
+        generation = self.generation(tablename)
+        result = self.decorated.get(tablename, key, hint=hint)
+        if result is not None:
+            self.store(tablename, result.get("id", key), result, generation=generation)
+        return result
+
+    def get_many(self, items):
+        result = map(lambda item: self.cache.get(self.cache_key(item[0], item[1])), items)
+        missing_indexes = [i for i in range(len(items)) if result[i] is None]
+        result = map(lambda x: copy_value(x) if x is not None else None, result)
+        if len(missing_indexes) > 0:
+            generations = dict(map(lambda x: (x[0], self.generation(x[0])), items))
+            fetched = self.decorated.get_many([items[i] for i in missing_indexes])
+            for (i, value) in zip(missing_indexes, fetched):
+                result[i] = value
+                if value is not None:
+                    self.store(items[i][0], items[i][1], value, generation=generations[items[i][0]])
+        return result
+
+    def index_result_key(self, tablename, hints):
+        return (tablename, tuple(map(lambda x: (x[0], tuple(x[1]) if isinstance(x[1], list) else x[1]), hints)))
+
+    def get_index_result(self, tablename, hints):
+        """Return the objects matching hints, if the keys of these objects and
+        the objects themselves are cached."""
+        cached_result = self.index_results.get(self.index_result_key(tablename, hints))
+        if cached_result is None or cached_result[0] != self.generation(tablename):
+            return None
+        result = []
+        for key in cached_result[1]:
+            value = self.cache.get(self.cache_key(tablename, key))
+            if value is None:
+                return None
+            result += [copy_value(value)]
+        return result
+
+    def hinted_keys(self, hints):
+        """Return the keys allowed by hints if they are all id hints (None
+        otherwise)."""
+        keys = None
+        for (attribute, value) in hints:
+            if attribute != "id" or isinstance(value, RangeHint):
+                return None
+            values = set(map(lambda x: "%s" % (x), value if isinstance(value, (list, tuple, set)) else [value]))
+            keys = values if keys is None else keys & values
+        return keys
+
+    def getall(self, tablename, hints=[]):
+        return self.getall_exact(tablename, hints=hints)[0]
+
+    def getall_exact(self, tablename, hints=[]):
+        """Objects served from the cache are not considered as selected with
+        exact indexes."""
+        keys = self.hinted_keys(hints)
+        if keys is not None:
+            values = filter(lambda x: x is not None, self.get_many(map(lambda x: (tablename, x), keys)))
+            return (sorted(values, key=lambda x: x.get("id", None)), False)
+        if self.invalidation and len(hints) > 0:
+            result = self.get_index_result(tablename, hints)
+            if result is not None:
+                return (result, False)
+        generation = self.generation(tablename)
+        (result, exact) = self.decorated.getall_exact(tablename, hints=hints)
+        self.store_all(tablename, result, generation=generation)
+        if self.invalidation and len(hints) > 0 and all(isinstance(x, dict) and "id" in x for x in result):
+            keys = map(lambda x: x["id"], result)
+            self.index_results.put(self.index_result_key(tablename, hints), (generation, keys))
+        return (result, exact)
+
+    def iter_all(self, tablename, batch_size=1000):
+        generation = self.generation(tablename)
+        for value in self.decorated.iter_all(tablename, batch_size=batch_size):
+            if isinstance(value, dict) and "id" in value:
+                self.store(tablename, value["id"], value, generation=generation)
+            yield value
@@ -4,6 +4,7 @@ import redis
 
 import lib.rome.driver.database_driver
 from cassandra.cluster import Cluster
+from cassandra.query import SimpleStatement
 from lib.rome.conf.Configuration import get_config
 
 from lib.rome.driver.redis.lock import ClusterLock as ClusterLock
@@ -65,6 +66,11 @@ class CassandraDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
         next_key = self.redis_client.incr("nextkey:%s" % (tablename), 1)
         return next_key
 
+    def next_keys(self, tablename, count):
+        """"""
+        last_key = self.redis_client.incr("nextkey:%s" % (tablename), count)
+        return range(last_key - count + 1, last_key + 1)
+
     def keys(self, tablename):
         """Check if the current table contains keys."""
         keys = self.redis_client.hkeys(tablename)
@@ -136,8 +142,9 @@ class CassandraDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
             pass
         return result
 
-    def put(self, tablename, key, value, secondary_indexes=[]):
-        """"""
+    def _encode_columns(self, tablename, value):
+        """Return the columns of the given value (except the version) and
+        their values encoded in CQL."""
 
         if not tablename in self.table_columns_metadata:
             self._extract_table_metadata(tablename)
@@ -157,9 +164,14 @@ class CassandraDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
 
         string_encoder = StringEncoder()
 
-        columns_name_str = ", ".join(map(lambda x: "%s" % (x), corrected_columns))
         # columns_value_str = ", ".join(map(lambda x: ("%s" % ((("%s") % (value[x])).replace("'", "\""))), corrected_columns))
         encoded_values = map(lambda x: process_column(tablename, x, value), corrected_columns)
+        return (corrected_columns, encoded_values)
+
+    def put(self, tablename, key, value, secondary_indexes=[]):
+        """"""
+        (corrected_columns, encoded_values) = self._encode_columns(tablename, value)
+        columns_name_str = ", ".join(map(lambda x: "%s" % (x), corrected_columns))
         columns_value_str = ", ".join(encoded_values)
 
         columns_name_str += ", rome_version_number"
@@ -171,6 +183,23 @@ class CassandraDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
 
         return result
 
+    def put_if_version(self, tablename, key, value, expected_version, secondary_indexes=[]):
+        """Compare and set with a lightweight transaction: an insert "IF NOT
+        EXISTS" for new objects, and a conditional update otherwise."""
+        (corrected_columns, encoded_values) = self._encode_columns(tablename, value)
+        if expected_version == -1:
+            columns_name_str = ", ".join(corrected_columns + ["rome_version_number"])
+            columns_value_str = ", ".join(encoded_values + ["%s" % (value["rome_version_number"])])
+            cql_request = "insert into %s (%s) values (%s) if not exists" % (tablename, columns_name_str, columns_value_str)
+        else:
+            assignments = filter(lambda x: x[0] != "id", zip(corrected_columns, encoded_values))
+            assignments += [("rome_version_number", "%s" % (value["rome_version_number"]))]
+            assignments_str = ", ".join(map(lambda x: "%s=%s" % (x[0], x[1]), assignments))
+            cql_request = "update %s set %s where id=%s if rome_version_number=%s" % (
+                tablename, assignments_str, key, expected_version)
+        result = self.session.execute(cql_request)
+        return len(result) > 0 and result[0].get("[applied]", False) is True
+
     def get(self, tablename, key, hint=None):
         """"""
         if not self._table_exist(tablename):
@@ -191,3 +220,12 @@ class CassandraDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
         print(cql_request)
         result = self.session.execute(cql_request)
         return result
+
+    def iter_all(self, tablename, batch_size=1000):
+        """Iterate over the objects of a table: rows are fetched by pages of
+        batch_size rows."""
+        if not self._table_exist(tablename):
+            self._table_create(tablename)
+        statement = SimpleStatement("select * from %s" % (tablename), fetch_size=batch_size)
+        for row in self.session.execute(statement):
+            yield row
@@ -0,0 +1,135 @@
+"""Codec module.
+
+This module contains the codecs used by drivers to convert simplified objects
+into the values that are stored in database, and to convert these values back.
+
+Each stored value starts with a header byte that identifies the format (and
+its version) used to encode it. Values written by older versions of ROME (the
+"repr" of a python dict, without header) can still be read when the migration
+mode is enabled: they are parsed with ast.literal_eval, which only accepts
+python literals, instead of eval.
+
+"""
+
+import ast
+import json
+import logging
+
+from lib.rome.conf.Configuration import get_config
+
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_HEADER = "\x01"
+MSGPACK_HEADER = "\x02"
+
+
+def default_serialization(obj):
+    """Convert values that are not natively supported by JSON/msgpack."""
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    return "%s" % (obj)
+
+
+class JsonCodec(object):
+    """Encode values in JSON, decode them with the fastest parser available."""
+
+    name = "json"
+    header = JSON_HEADER
+    binary = False
+
+    def encode(self, value):
+        return self.header + json.dumps(value, separators=(",", ":"), default=default_serialization)
+
+    def decode(self, payload):
+        return fast_json.loads(payload[1:])
+
+
+class MsgpackCodec(object):
+    """Encode values in msgpack, a compact binary format."""
+
+    name = "msgpack"
+    header = MSGPACK_HEADER
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("the msgpack codec requires the 'msgpack' module")
+
+    def encode(self, value):
+        return self.header + msgpack.packb(value, default=default_serialization, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload[1:], raw=False)
+
+
+class ReprCodec(object):
+    """Legacy format: the python representation of the value, without header."""
+
+    name = "repr"
+    header = None
+    binary = False
+
+    def encode(self, value):
+        return "%s" % (value)
+
+    def decode(self, payload):
+        return ast.literal_eval(payload)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "msgpack": MsgpackCodec,
+    "repr": ReprCodec
+}
+
+
+class ValueCodec(object):
+    """Codec used by drivers: values are written with the configured codec,
+    and read with the codec designated by their header byte."""
+
+    def __init__(self, writer, read_legacy_values=True):
+        self.writer = writer
+        self.read_legacy_values = read_legacy_values
+        self.readers = {JSON_HEADER: JsonCodec()}
+        if msgpack is not None:
+            self.readers[MSGPACK_HEADER] = MsgpackCodec()
+        if writer.header is not None:
+            self.readers[writer.header] = writer
+        self.legacy_reader = ReprCodec()
+
+    def encode(self, value):
+        return self.writer.encode(value)
+
+    def decode(self, payload):
+        if payload is None:
+            return None
+        reader = self.readers.get(payload[0:1], None)
+        if reader is not None:
+            return reader.decode(payload)
+        if self.read_legacy_values:
+            return self.legacy_reader.decode(payload)
+        raise ValueError("unknown value format (header=%r)" % (payload[0:1]))
+
+
+def build_codec(allow_binary=True):
+    config = get_config()
+    codec_name = config.codec()
+    if codec_name not in CODECS:
+        raise ValueError("unknown codec '%s'" % (codec_name))
+    writer = CODECS[codec_name]()
+    if writer.binary and not allow_binary:
+        logging.warning("codec '%s' cannot be used with this driver, falling back to 'json'" % (codec_name))
+        writer = JsonCodec()
+    return ValueCodec(writer, read_legacy_values=config.read_legacy_values())
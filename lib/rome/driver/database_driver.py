@@ -1,8 +1,56 @@
+import calendar
+import collections
+import datetime
+
 from lib.rome.utils.MemoizationDecorator import memoization_decorator
 from lib.rome.conf.Configuration import get_config
 
+# An attribute indexed by a range index (see secondary_index_decorator): such
+# indexes are given to drivers along with the names of the attributes indexed
+# by equality.
+RangeIndex = collections.namedtuple("RangeIndex", ["attribute"])
+
+# Value of a hint on a range indexed attribute: bounds are scores (see
+# index_score), None when the range is not bounded.
+RangeHint = collections.namedtuple("RangeHint", ["minimum", "maximum", "minimum_excluded", "maximum_excluded"])
+
+def index_score(value):
+    """Return the score of a value in a range index: numbers and dates
+    (simplified or not) are converted to floats, dates being converted to
+    seconds since the epoch. Other values cannot be indexed (None)."""
+    if isinstance(value, (int, long, float)):
+        return float(value)
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.timetuple()) + value.microsecond / 1000000.0
+    if isinstance(value, dict) and value.get("simplify_strategy", None) == "datetime":
+        try:
+            return index_score(datetime.datetime.strptime(value["value"], '%b %d %Y %H:%M:%S'))
+        except (KeyError, ValueError):
+            return None
+    return None
+
+def split_indexes(secondary_indexes):
+    """Split the indexes given to a driver into the attributes indexed by
+    equality and the attributes indexed by range."""
+    ranges = [x.attribute for x in secondary_indexes if isinstance(x, RangeIndex)]
+    return ([x for x in secondary_indexes if not isinstance(x, RangeIndex)], ranges)
+
+def get_version(value):
+    """Return the version of a stored object (-1 if there is no object)."""
+    if not isinstance(value, dict):
+        return -1
+    version = value.get("rome_version_number", None)
+    return version if version is not None else -1
+
+
 class DatabaseDriverInterface(object):
 
+    # True when the driver maintains secondary indexes that only contain the
+    # objects whose current indexed value is the one of the index: objects
+    # found with an index do not have to be filtered again (see
+    # has_exact_indexes).
+    exact_secondary_indexes = False
+
     def add_key(self, tablename, key):
         raise NotImplementedError
 
@@ -12,9 +60,24 @@ class DatabaseDriverInterface(object):
     def next_key(self, tablename):
         raise NotImplementedError
 
+    def next_keys(self, tablename, count):
+        """Reserve count keys at once. Drivers that can increment their
+        counters by more than one should override this method, so that the
+        keys are reserved with a single request."""
+        return map(lambda i: self.next_key(tablename), range(count))
+
     def keys(self, tablename):
         raise NotImplementedError
 
+    def has_exact_indexes(self, tablename):
+        """Check if the secondary indexes of a table are exact (see
+        exact_secondary_indexes)."""
+        return self.exact_secondary_indexes
+
+    def rebuild_indexes(self, tablename, secondary_indexes):
+        """Rebuild the secondary indexes of a table from its objects."""
+        raise NotImplementedError
+
     def put(self, tablename, key, value, secondary_indexes=[]):
         raise NotImplementedError
 
@@ -22,10 +85,80 @@ class DatabaseDriverInterface(object):
         raise NotImplementedError
 
     def getall(self, tablename, hints=[]):
+        """Return the objects of a table. Hints are (attribute, value) pairs
+        that objects should match: values may be lists (IN), or RangeHint for
+        range indexed attributes. Hints only narrow the objects loaded, which
+        are filtered again: drivers may ignore the hints they cannot use."""
         raise NotImplementedError
 
+    def getall_exact(self, tablename, hints=[]):
+        """Return the objects of a table that match hints (see getall), and
+        whether they have been selected with exact indexes: the objects then
+        satisfy the hints, and do not have to be filtered again. Drivers whose
+        indexes may become exact should override this method, so that the
+        objects and their exactness are read at once."""
+        return (self.getall(tablename, hints=hints), len(hints) > 0 and self.has_exact_indexes(tablename))
+
+    def count(self, tablename, hints=[]):
+        """Return the number of objects of a table that match hints. As drivers
+        may ignore hints (see getall), the result only takes hints into account
+        when the secondary indexes of the driver are exact."""
+        return len(self.getall(tablename, hints=hints))
+
+    def table_generation(self, tablename):
+        """Return a value that changes each time an object of a table is
+        modified, or None when the driver cannot tell (for instance when the
+        modifications made by other processes are not notified)."""
+        return None
+
+    def count_exact(self, tablename, hints=[]):
+        """Return the number of objects of a table that match hints, or None
+        if the secondary indexes of the table are not exact (see
+        getall_exact)."""
+        if not self.has_exact_indexes(tablename):
+            return None
+        return self.count(tablename, hints=hints)
+
+    def iter_all(self, tablename, batch_size=1000):
+        """Iterate over the objects of a table, in no particular order. Drivers
+        that can fetch objects by batches should override this method, so that
+        the memory used while scanning a table is bounded by the size of a
+        batch: such scans may return an object twice."""
+        for obj in self.getall(tablename):
+            yield obj
+
+    def iter_by_range_index(self, tablename, attribute, descending=False, batch_size=1000, first_batch_size=None):
+        """Iterate over the objects of a table, sorted by the value of a range
+        indexed attribute. It returns None when the driver cannot read the
+        objects in this order (for instance, when some objects are not in the
+        range index), in which case objects have to be sorted by the caller.
+        Objects are read by batches whose size doubles from first_batch_size
+        (batch_size by default) to batch_size."""
+        return None
+
+    def get_many(self, items):
+        """Fetch several objects, given as a list of (tablename, key) pairs."""
+        return map(lambda item: self.get(item[0], item[1]), items)
+
+    def put_many(self, items):
+        """Store several objects, given as a list of (tablename, key, value,
+        secondary_indexes) tuples."""
+        return map(lambda item: self.put(item[0], item[1], item[2], secondary_indexes=item[3]), items)
+
+    def put_if_version(self, tablename, key, value, expected_version, secondary_indexes=[]):
+        """Store value only if the version ("rome_version_number") of the
+        stored object is expected_version (-1 if there is no stored object).
+        It returns True if the value has been stored, False in case of
+        conflict. Drivers should override this method to compare and set
+        atomically: this implementation is not atomic."""
+        if get_version(self.get(tablename, key)) != expected_version:
+            return False
+        self.put(tablename, key, value, secondary_indexes=secondary_indexes)
+        return True
+
 
 driver = None
+key_allocator = None
 
 def build_driver():
     config = get_config()
@@ -47,4 +180,15 @@ def get_driver():
     global driver
     if driver is None:
         driver = build_driver()
+        config = get_config()
+        if config.cache_enabled():
+            from lib.rome.driver.cache import CachedDriver
+            driver = CachedDriver(driver, config.cache_memory_budget(), invalidation=config.cache_invalidation())
     return driver
+
+def get_key_allocator():
+    global key_allocator
+    if key_allocator is None:
+        from lib.rome.driver.key_allocator import KeyAllocator
+        key_allocator = KeyAllocator(get_driver(), get_config().id_block_size())
+    return key_allocator
@@ -0,0 +1,45 @@
+"""Key allocator module.
+
+This module contains an allocator of keys that reserves blocks of keys from
+the database (see DatabaseDriverInterface.next_keys) and hands them out
+locally, so that creating an object does not require a request to the
+database each time. Keys that have been reserved but not used (for instance
+when the process stops) are lost: keys of a table remain unique, but they are
+not necessarily consecutive.
+
+"""
+
+import threading
+
+
+class KeyAllocator(object):
+
+    def __init__(self, driver, block_size=1):
+        self.driver = driver
+        self.block_size = max(1, block_size)
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def next_key(self, tablename):
+        """Return a new key for the given table."""
+        if self.block_size == 1:
+            return self.driver.next_key(tablename)
+        with self.lock:
+            block = self.blocks.get(tablename, [])
+            if len(block) == 0:
+                block = list(self.driver.next_keys(tablename, self.block_size))
+                block.reverse()
+                self.blocks[tablename] = block
+            return block.pop()
+
+    def next_keys(self, tablename, count):
+        """Return count new keys for the given table: the keys of the current
+        block are used first, the remaining keys are reserved at once."""
+        with self.lock:
+            block = self.blocks.get(tablename, [])
+            result = []
+            while len(block) > 0 and len(result) < count:
+                result += [block.pop()]
+            if len(result) < count:
+                result += list(self.driver.next_keys(tablename, count - len(result)))
+            return result
@@ -1,21 +1,345 @@
+import collections
+import json
+import logging
+import threading
+import time
+import uuid
+
 import lib.rome.driver.database_driver
 import redis
-# import json
 import rediscluster
 from lib.rome.conf.Configuration import get_config
+from lib.rome.driver.codec import build_codec
 # from redlock import RedLock as RedLock
 # import redis_lock
 from redlock import Redlock as Redlock
-import time
 
 from lib.rome.driver.redis.lock import ClusterLock as ClusterLock
 
+# KEYS = [table, rebuilding marker, rebuilt marker, secondary index keys...]
+# ARGV = [groups count, descriptor of each group..., has id filter (0|1), allowed keys...]
+# The scripts return false while the indexes of the table are being rebuilt
+# (see RedisDriver.rebuild_indexes), as they may miss objects. Otherwise, their
+# result ends with 1 if the indexes are exact (the rebuilt marker exists).
+# A group is either a set of secondary index keys (its descriptor is its size),
+# whose members are unioned, or a single range index key (its descriptor is
+# "range:<min> <max>", bounds being given as for ZRANGEBYSCORE). Groups are
+# intersected, and the result is filtered with allowed keys. GETALL_SCRIPT
+# returns matching keys and values, COUNT_SCRIPT the number of matching objects.
+# Index sets are unioned by chunks of 1000 keys, as unpack cannot handle more
+# than a few thousand values.
+SELECT_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return false
+end
+local exact = redis.call('EXISTS', KEYS[3])
+local groups_count = tonumber(ARGV[1])
+local candidates = nil
+local key_index = 4
+for group = 1, groups_count do
+    local descriptor = ARGV[1 + group]
+    local group_candidates = {}
+    local function add_members(members)
+        for _, member in ipairs(members) do
+            if candidates == nil or candidates[member] then
+                group_candidates[member] = true
+            end
+        end
+    end
+    if string.sub(descriptor, 1, 6) == 'range:' then
+        local separator = string.find(descriptor, ' ', 7, true)
+        add_members(redis.call('ZRANGEBYSCORE', KEYS[key_index], string.sub(descriptor, 7, separator - 1),
+                               string.sub(descriptor, separator + 1)))
+        key_index = key_index + 1
+    else
+        local last_index = key_index + tonumber(descriptor) - 1
+        for i = key_index, last_index, 1000 do
+            add_members(redis.call('SUNION', unpack(KEYS, i, math.min(i + 999, last_index))))
+        end
+        key_index = last_index + 1
+    end
+    candidates = group_candidates
+end
+if ARGV[2 + groups_count] == '1' then
+    local allowed = {}
+    for i = 3 + groups_count, #ARGV do
+        if candidates == nil or candidates[ARGV[i]] then
+            allowed[ARGV[i]] = true
+        end
+    end
+    candidates = allowed
+end
+local keys = {}
+for member, _ in pairs(candidates or {}) do
+    keys[#keys + 1] = member
+end
+"""
+
+GETALL_SCRIPT = SELECT_SCRIPT + """
+local values = {}
+for i = 1, #keys, 1000 do
+    local chunk = redis.call('HMGET', KEYS[1], unpack(keys, i, math.min(i + 999, #keys)))
+    for _, value in ipairs(chunk) do
+        values[#values + 1] = value
+    end
+end
+return {keys, values, exact}
+"""
+
+# Allowed keys may not exist, contrary to the members of indexes.
+COUNT_SCRIPT = SELECT_SCRIPT + """
+if ARGV[2 + groups_count] == '1' then
+    local count = 0
+    for _, key in ipairs(keys) do
+        count = count + redis.call('HEXISTS', KEYS[1], key)
+    end
+    return {count, exact}
+end
+return {#keys, exact}
+"""
+
+# KEYS = [table, reverse index (optional), index keys...]
+# ARGV = [object key, encoded value, expected version ('' to store the value
+#         unconditionally), table name, channel, notification ('' for none),
+#         count of attributes indexed by equality, indexed attribute, indexed
+#         value..., range indexed attribute, score ('' for none)...]
+# When an expected version is given, the value is stored only if the version
+# of the stored object is the expected one (-1 when there is no stored object).
+# The reverse index associates each object with its indexed values and its
+# range indexed attributes (encoded in JSON): when an indexed value changes,
+# the object is moved from the old index set to the new one. Range indexes are
+# sorted sets, whose scores are the indexed values. It returns the status (1:
+# stored, 0: conflict, -1: the stored value cannot be decoded by the script)
+# and the version of the stored object (-1 if it has not been read).
+# The index keys that the script modifies must be declared in KEYS: the keys
+# of the index sets that the object leaves are only known once its reverse
+# index entry has been read. When some of them are not declared, nothing is
+# modified and the script returns {-2, version, undeclared keys...}: the
+# client runs it again with these keys (see RedisDriver._run_put_script).
+PUT_SCRIPT = """
+local version = -1
+if ARGV[3] ~= '' then
+    local current = redis.call('HGET', KEYS[1], ARGV[1])
+    if current then
+        local header = string.sub(current, 1, 1)
+        local decoder = nil
+        if header == '\\1' then
+            decoder = cjson.decode
+        elseif header == '\\2' then
+            decoder = cmsgpack.unpack
+        else
+            return {-1, -1}
+        end
+        local decoded, value = pcall(decoder, string.sub(current, 2))
+        if not decoded or type(value) ~= 'table' then
+            return {-1, -1}
+        end
+        version = tonumber(value['rome_version_number']) or -1
+    end
+    if version ~= tonumber(ARGV[3]) then
+        return {0, version}
+    end
+end
+if #KEYS > 1 then
+    local old_values = {}
+    local old_ranges = {}
+    local encoded_old_values = redis.call('HGET', KEYS[2], ARGV[1])
+    if encoded_old_values then
+        local old_indexes = cjson.decode(encoded_old_values)
+        old_values = old_indexes['values'] or {}
+        old_ranges = old_indexes['ranges'] or {}
+    end
+    local new_values = {}
+    local new_ranges = {}
+    local scores = {}
+    local indexed = false
+    local values_end = 7 + 2 * tonumber(ARGV[7])
+    for i = 8, values_end - 1, 2 do
+        new_values[ARGV[i]] = ARGV[i + 1]
+        indexed = true
+    end
+    for i = values_end + 1, #ARGV, 2 do
+        if ARGV[i + 1] ~= '' then
+            scores[ARGV[i]] = ARGV[i + 1]
+            new_ranges[ARGV[i]] = true
+            indexed = true
+        end
+    end
+    local removed_members = {}
+    local removed_ranges = {}
+    local touched = {}
+    for attribute, old_value in pairs(old_values) do
+        if new_values[attribute] ~= old_value then
+            local key = 'sec_index:' .. ARGV[4] .. ':' .. attribute .. ':' .. old_value
+            table.insert(removed_members, key)
+            table.insert(touched, key)
+        end
+    end
+    for attribute, _ in pairs(old_ranges) do
+        if not new_ranges[attribute] then
+            local key = 'range_index:' .. ARGV[4] .. ':' .. attribute
+            table.insert(removed_ranges, key)
+            table.insert(touched, key)
+        end
+    end
+    for attribute, new_value in pairs(new_values) do
+        table.insert(touched, 'sec_index:' .. ARGV[4] .. ':' .. attribute .. ':' .. new_value)
+    end
+    for attribute, _ in pairs(scores) do
+        table.insert(touched, 'range_index:' .. ARGV[4] .. ':' .. attribute)
+    end
+    local declared = {}
+    for i = 3, #KEYS do
+        declared[KEYS[i]] = true
+    end
+    local result = {-2, version}
+    for _, key in ipairs(touched) do
+        if not declared[key] then
+            table.insert(result, key)
+        end
+    end
+    if #result > 2 then
+        return result
+    end
+    for attribute, score in pairs(scores) do
+        redis.call('ZADD', 'range_index:' .. ARGV[4] .. ':' .. attribute, score, ARGV[1])
+    end
+    for _, key in ipairs(removed_members) do
+        redis.call('SREM', key, ARGV[1])
+    end
+    for _, key in ipairs(removed_ranges) do
+        redis.call('ZREM', key, ARGV[1])
+    end
+    for attribute, new_value in pairs(new_values) do
+        redis.call('SADD', 'sec_index:' .. ARGV[4] .. ':' .. attribute .. ':' .. new_value, ARGV[1])
+    end
+    if indexed then
+        redis.call('HSET', KEYS[2], ARGV[1], cjson.encode({values = new_values, ranges = new_ranges}))
+    elseif encoded_old_values then
+        redis.call('HDEL', KEYS[2], ARGV[1])
+    end
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if ARGV[6] ~= '' then
+    redis.call('PUBLISH', ARGV[5], ARGV[6])
+end
+return {1, version}
+"""
+
+# KEYS = [table, reverse index, index keys...]
+# ARGV = [object key, table name, channel, notification ('' for none)]
+# Remove an object, and remove it from the secondary indexes it belongs to. As
+# PUT_SCRIPT, it returns {-2, undeclared keys...} without modifying anything
+# when the keys of these indexes are not declared, and {1} otherwise.
+REMOVE_SCRIPT = """
+local encoded_values = redis.call('HGET', KEYS[2], ARGV[1])
+if encoded_values then
+    local indexes = cjson.decode(encoded_values)
+    local touched = {}
+    for attribute, value in pairs(indexes['values'] or {}) do
+        table.insert(touched, {'SREM', 'sec_index:' .. ARGV[2] .. ':' .. attribute .. ':' .. value})
+    end
+    for attribute, _ in pairs(indexes['ranges'] or {}) do
+        table.insert(touched, {'ZREM', 'range_index:' .. ARGV[2] .. ':' .. attribute})
+    end
+    local declared = {}
+    for i = 3, #KEYS do
+        declared[KEYS[i]] = true
+    end
+    local result = {-2}
+    for _, command in ipairs(touched) do
+        if not declared[command[2]] then
+            table.insert(result, command[2])
+        end
+    end
+    if #result > 1 then
+        return result
+    end
+    for _, command in ipairs(touched) do
+        redis.call(command[1], command[2], ARGV[1])
+    end
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+if ARGV[4] ~= '' then
+    redis.call('PUBLISH', ARGV[3], ARGV[4])
+end
+return {1}
+"""
+
+class RangeGroup(collections.namedtuple("RangeGroup", ["key", "hint"])):
+    """Range index whose members matching a range hint are selected."""
+
+    def bounds(self):
+        """Return the bounds of the hint, as expected by ZRANGEBYSCORE."""
+        minimum = "-inf" if self.hint.minimum is None else repr(float(self.hint.minimum))
+        maximum = "+inf" if self.hint.maximum is None else repr(float(self.hint.maximum))
+        if self.hint.minimum is not None and self.hint.minimum_excluded:
+            minimum = "(" + minimum
+        if self.hint.maximum is not None and self.hint.maximum_excluded:
+            maximum = "(" + maximum
+        return (minimum, maximum)
+
+# Channel used to notify other processes that objects have been modified.
+# Messages have the form "<origin>:<tablename>:<key>".
+INVALIDATION_CHANNEL = "rome:invalidations"
+
+class InvalidationSubscription(threading.Thread):
+    """Thread that listens to the invalidation channel (see
+    RedisDriver.subscribe_invalidations) until it is stopped. "subscribed" is
+    set once the channel has been subscribed to."""
+
+    def __init__(self, driver, callback, poll_interval=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.driver = driver
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.subscribed = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            pubsub = None
+            try:
+                pubsub = self.driver.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                self.callback(None, None)
+                self.subscribed.set()
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=self.poll_interval)
+                    if message is None or message["type"] != "message":
+                        continue
+                    (origin, tablename, key) = message["data"].split(":", 2)
+                    if origin != self.driver.origin:
+                        self.callback(tablename, key)
+            except Exception as e:
+                logging.error("invalidation subscription failed: %s" % (e))
+                self.stopped.wait(1)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+    def stop(self, timeout=None):
+        """Unsubscribe, and wait for the thread to terminate."""
+        self.stopped.set()
+        self.join(timeout)
+
 class RedisDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
 
+    exact_secondary_indexes = True
+
     def __init__(self):
         config = get_config()
         self.redis_client = redis.StrictRedis(host=config.host(), port=config.port(), db=0)
         self.dlm = Redlock([{"host": "localhost", "port": 6379, "db": 0}, ], retry_count=10)
+        self.codec = build_codec()
+        self._getall_script = None
+        self._count_script = None
+        self._put_script = self.redis_client.register_script(PUT_SCRIPT)
+        self._remove_script = self.redis_client.register_script(REMOVE_SCRIPT)
+        self.publish_invalidations = config.cache_invalidation()
+        self.origin = uuid.uuid4().hex
         # self.dlm = ClusterLock()
 
     def add_key(self, tablename, key):
@@ -25,91 +349,405 @@ class RedisDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
     def remove_key(self, tablename, key):
         """"""
         redis_key = "%s:id:%s" % (tablename, key)
-        self.redis_client.hdel(tablename, redis_key)
-        pass
+        keys = [tablename, self._reverse_index(tablename)]
+        args = [redis_key, tablename, INVALIDATION_CHANNEL, self._notification(tablename, key)]
+        result = self._remove_script(keys=keys, args=args)
+        while result[0] == -2:
+            # the object belongs to indexes: remove it again, declaring them
+            keys = keys + result[1:]
+            result = self._remove_script(keys=keys, args=args)
 
     def next_key(self, tablename):
         """"""
         next_key = self.redis_client.incr("nextkey:%s" % (tablename), 1)
         return next_key
 
+    def next_keys(self, tablename, count):
+        """"""
+        last_key = self.redis_client.incr("nextkey:%s" % (tablename), count)
+        return range(last_key - count + 1, last_key + 1)
+
     def keys(self, tablename):
         """"""
         """Check if the current table contains keys."""
         keys = self.redis_client.hkeys(tablename)
         return sorted(keys)
 
+    def pipeline(self, transaction=True):
+        """Return a pipeline: queued commands are sent in a single round trip."""
+        return self.redis_client.pipeline(transaction=transaction)
+
+    def _execute(self, pipe):
+        """Execute a pipeline that modifies objects."""
+        return pipe.execute()
+
+    def _reverse_index(self, tablename):
+        """Hash that associates each object of a table with its indexed values."""
+        return "sec_index_values:%s" % (tablename)
+
+    def _rebuilt_marker(self, tablename):
+        """Key set once the indexes of a table have been rebuilt."""
+        return "sec_index_rebuilt:%s" % (tablename)
+
+    def _rebuilding_marker(self, tablename):
+        """Key set while the indexes of a table are being rebuilt."""
+        return "sec_index_rebuilding:%s" % (tablename)
+
+    def has_exact_indexes(self, tablename):
+        """Index sets written before objects were moved between them (and
+        before the reverse index existed) may still contain objects whose
+        value has changed since: indexes are only exact once they have been
+        rebuilt (see rebuild_indexes)."""
+        return self.exact_secondary_indexes and bool(self.redis_client.exists(self._rebuilt_marker(tablename)))
+
+    def rebuild_indexes(self, tablename, secondary_indexes):
+        """Delete the secondary indexes and the reverse index of a table, index
+        its objects again, then mark its indexes as exact. Objects are indexed
+        again with a compare and set on their version: objects modified during
+        the rebuild are indexed by their writers. While the indexes are being
+        rebuilt, hints are ignored by getall and count (if the rebuild does not
+        complete, they are ignored until the next rebuild)."""
+        pipe = self.pipeline()
+        pipe.delete(self._rebuilt_marker(tablename))
+        pipe.set(self._rebuilding_marker(tablename), 1)
+        pipe.execute()
+        index_keys = [self._reverse_index(tablename)]
+        for pattern in ["sec_index:%s:*", "range_index:%s:*"]:
+            index_keys += list(self.redis_client.scan_iter(match=pattern % (tablename)))
+        for i in range(0, len(index_keys), 1000):
+            self.redis_client.delete(*index_keys[i:i + 1000])
+        for value in self.iter_all(tablename):
+            if isinstance(value, dict) and "id" in value:
+                self.put_if_version(tablename, value["id"], value,
+                                    lib.rome.driver.database_driver.get_version(value), secondary_indexes)
+        pipe = self.pipeline()
+        pipe.delete(self._rebuilding_marker(tablename))
+        pipe.set(self._rebuilt_marker(tablename), 1)
+        pipe.execute()
+
+    def _indexed_values(self, value, secondary_indexes):
+        """Return the values of the attributes indexed by equality, and the
+        scores of the range indexed attributes (None if a value cannot be
+        indexed)."""
+        (attributes, range_attributes) = lib.rome.driver.database_driver.split_indexes(secondary_indexes)
+        values = dict(map(lambda x: (x, "%s" % (value[x])), attributes))
+        scores = dict(map(lambda x: (x, lib.rome.driver.database_driver.index_score(value.get(x, None))),
+                          range_attributes))
+        return (values, scores)
+
+    def _index_keys(self, tablename, values, range_attributes):
+        """Keys of the index sets of the given indexed values, and of the range
+        indexes of the given attributes."""
+        keys = map(lambda x: "sec_index:%s:%s:%s" % (tablename, x[0], x[1]), values.iteritems())
+        return keys + map(lambda x: "range_index:%s:%s" % (tablename, x), range_attributes)
+
+    def _put_arguments(self, tablename, key, value, secondary_indexes, expected_version=None):
+        """Keys and arguments of PUT_SCRIPT. The index keys of the new indexed
+        values are declared: the keys of the index sets that the object leaves
+        are declared by _run_put_script."""
+        redis_key = "%s:id:%s" % (tablename, key)
+        (values, scores) = self._indexed_values(value, secondary_indexes)
+        keys = [tablename, self._reverse_index(tablename)] + self._index_keys(tablename, values, scores.keys())
+        args = [redis_key, self.codec.encode(value), "" if expected_version is None else expected_version,
+                tablename, INVALIDATION_CHANNEL, self._notification(tablename, key), len(values)]
+        for (attribute, indexed_value) in values.iteritems():
+            args += [attribute, indexed_value]
+        for (attribute, score) in scores.iteritems():
+            args += [attribute, repr(score) if score is not None else ""]
+        return (keys, args)
+
+    def _run_put_script(self, keys, args, result=None):
+        """Run PUT_SCRIPT (unless its result is given) until the keys of the
+        index sets that the object leaves are declared. It returns the status
+        and the version of the stored object."""
+        if result is None:
+            result = self._put_script(keys=keys, args=args)
+        while result[0] == -2:
+            keys = keys + result[2:]
+            result = self._put_script(keys=keys, args=args)
+        return (result[0], result[1])
+
+    def _queue_put(self, pipe, tablename, key, value, secondary_indexes, old_index_keys=[]):
+        """Queue the storage of an object: the object and its secondary indexes
+        are updated atomically by a script. The script does not store objects
+        that leave index sets whose keys are not in old_index_keys (see
+        PUT_SCRIPT)."""
+        (keys, args) = self._put_arguments(tablename, key, value, secondary_indexes)
+        self._put_script(keys=keys + old_index_keys, args=args, client=pipe)
+
+    def _queue_invalidation(self, pipe, tablename, key):
+        if self.publish_invalidations:
+            pipe.publish(INVALIDATION_CHANNEL, self._invalidation_message(tablename, key))
+
+    def _invalidation_message(self, tablename, key):
+        return "%s:%s:%s" % (self.origin, tablename, key)
+
+    def _notification(self, tablename, key):
+        """Notification published by scripts ("" if notifications are disabled)."""
+        return self._invalidation_message(tablename, key) if self.publish_invalidations else ""
+
+    def subscribe_invalidations(self, callback):
+        """Start a thread that calls callback(tablename, key) each time another
+        process modifies an object. callback(None, None) is called each time
+        the subscription is (re)established, as notifications may have been
+        missed in the meantime. It returns the thread (an
+        InvalidationSubscription), whose stop method ends the subscription."""
+        subscription = InvalidationSubscription(self, callback)
+        subscription.start()
+        return subscription
+
     def put(self, tablename, key, value, secondary_indexes=[]):
         """"""
-        # lockname = "lock-%s" % (tablename)
-        # my_lock = None
-        # try_to_lock = True
-        # while try_to_lock:
-        #     # my_lock = self.dlm.lock(lockname,1000)
-        #     my_lock = self.dlm.lock(lockname, 200)
-        #     if my_lock is not False:
-        #         try_to_lock = False
-        #     else:
-        #         time.sleep(0.2)
-        # json_value = json.dumps(value)
-        json_value = value
-        fetched = self.redis_client.hset(tablename, "%s:id:%s" % (tablename, key), json_value)
-        for secondary_index in secondary_indexes:
-            secondary_value = value[secondary_index]
-            fetched = self.redis_client.sadd("sec_index:%s:%s:%s" % (tablename, secondary_index, secondary_value), "%s:id:%s" % (tablename, key))
-            # fetched = self.redis_client.hset("sec_index:%s" % (tablename), "%s:%s:%s" % (tablename, secondary_index, secondary_value), "%s:id:%s" % (tablename, key))
-        result = value if fetched else None
-        # self.dlm.unlock(lockname)
-        # self.dlm.unlock(my_lock)
+        (keys, args) = self._put_arguments(tablename, key, value, secondary_indexes)
+        (status, version) = self._run_put_script(keys, args)
+        result = value if status == 1 else None
         return result
 
+    def put_many(self, items):
+        """"""
+        pipe = self.pipeline()
+        for (tablename, key, value, secondary_indexes) in items:
+            self._queue_put(pipe, tablename, key, value, secondary_indexes)
+        results = self._execute(pipe)
+        # objects that leave index sets have not been stored: they are stored
+        # again (in order, with the later values of the same objects)
+        retried = set()
+        for ((tablename, key, value, secondary_indexes), result) in zip(items, results):
+            if result[0] == -2 or (tablename, key) in retried:
+                retried.add((tablename, key))
+                (keys, args) = self._put_arguments(tablename, key, value, secondary_indexes)
+                self._run_put_script(keys, args, result=result if result[0] == -2 else None)
+        return map(lambda item: item[2], items)
+
+    def put_if_version(self, tablename, key, value, expected_version, secondary_indexes=[]):
+        """Compare and set, in a single server side call. Values written with
+        a format that the script cannot decode (legacy values) are compared
+        in an optimistic transaction (WATCH/MULTI) instead."""
+        (keys, args) = self._put_arguments(tablename, key, value, secondary_indexes,
+                                           expected_version=expected_version)
+        (status, version) = self._run_put_script(keys, args)
+        if status == -1:
+            return self._put_if_version_watched(tablename, key, value, expected_version, secondary_indexes)
+        return status == 1
+
+    def _put_if_version_watched(self, tablename, key, value, expected_version, secondary_indexes):
+        redis_key = "%s:id:%s" % (tablename, key)
+        with self.redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(tablename, self._reverse_index(tablename))
+                current_value = self.codec.decode(pipe.hget(tablename, redis_key))
+                if lib.rome.driver.database_driver.get_version(current_value) != expected_version:
+                    return False
+                encoded_indexes = pipe.hget(self._reverse_index(tablename), redis_key)
+                indexes = json.loads(encoded_indexes) if encoded_indexes is not None else {}
+                old_index_keys = self._index_keys(tablename, indexes.get("values", {}),
+                                                  indexes.get("ranges", {}).keys())
+                pipe.multi()
+                self._queue_put(pipe, tablename, key, value, secondary_indexes, old_index_keys)
+                self._execute(pipe)
+                return True
+            except redis.WatchError:
+                return False
+
     def get(self, tablename, key, hint=None):
         """"""
         redis_key = "%s:id:%s" % (tablename, key)
         if hint is not None:
             redis_keys = self.redis_client.smembers("sec_index:%s:%s:%s" % (tablename, hint[0], hint[1]))
-            redis_key = redis_keys[0]
-            # redis_key = self.redis_client.hget("sec_index:%s" % (tablename), "%s:%s:%s" % (tablename, hint[0], hint[1]))
+            redis_key = next(iter(redis_keys), None)
+            if redis_key is None:
+                return None
         fetched = self.redis_client.hget(tablename, redis_key)
-        # result = json.loads(fetched) if fetched is not None else None
-        result = eval(fetched) if fetched is not None else None
+        result = self.codec.decode(fetched)
         return result
 
+    def iter_all(self, tablename, batch_size=1000):
+        """Iterate over the objects of a table with HSCAN, so that the memory
+        used does not depend on the size of the table. Objects are not
+        sorted, and an object may be returned twice if the table is resized
+        during the iteration (see lib.rome.core.utils.unique_objects)."""
+        cursor = 0
+        while True:
+            (cursor, fetched) = self.redis_client.hscan(tablename, cursor=cursor, count=batch_size)
+            for value in fetched.values():
+                yield self.codec.decode(value)
+            if int(cursor) == 0:
+                break
+
+    def iter_by_range_index(self, tablename, attribute, descending=False, batch_size=1000, first_batch_size=None):
+        """Objects are read by batches, following the order of the sorted set
+        of the range index. Objects whose attribute is NULL are not indexed:
+        the index is only used when it contains all the objects of the table."""
+        if attribute not in self._complete_range_indexes(tablename, [attribute]):
+            return None
+        index_key = "range_index:%s:%s" % (tablename, attribute)
+        return self._iter_sorted_set(tablename, index_key, descending, batch_size, first_batch_size)
+
+    def _complete_range_indexes(self, tablename, attributes):
+        """Return the given range indexed attributes whose range index contains
+        all the objects of the table. Objects written before a range index was
+        declared, and objects whose value is NULL, are not in the index (nor
+        are objects that have not been indexed again by a rebuild)."""
+        pipe = self.pipeline(transaction=False)
+        pipe.exists(self._rebuilding_marker(tablename))
+        pipe.hlen(tablename)
+        for attribute in attributes:
+            pipe.zcard("range_index:%s:%s" % (tablename, attribute))
+        results = pipe.execute()
+        if results[0]:
+            return set()
+        return set(attribute for (attribute, indexed_count) in zip(attributes, results[2:])
+                   if indexed_count == results[1])
+
+    def _usable_hints(self, tablename, hints):
+        """Range hints are ignored when their range index does not contain
+        all the objects of the table, as the objects that are not in the index
+        would be lost."""
+        range_attributes = list(set(x[0] for x in hints
+                                    if isinstance(x[1], lib.rome.driver.database_driver.RangeHint)))
+        if len(range_attributes) == 0:
+            return hints
+        complete = self._complete_range_indexes(tablename, range_attributes)
+        return filter(lambda x: not isinstance(x[1], lib.rome.driver.database_driver.RangeHint) or x[0] in complete,
+                      hints)
+
+    def _iter_sorted_set(self, tablename, index_key, descending, batch_size, first_batch_size=None):
+        """Objects modified during the iteration may be skipped or returned
+        twice, as their rank in the sorted set may change. Batches grow
+        geometrically, so that callers that filter the objects do not read
+        them one by one when the first batch is small."""
+        start = 0
+        size = min(first_batch_size, batch_size) if first_batch_size is not None else batch_size
+        while True:
+            if descending:
+                keys = self.redis_client.zrevrange(index_key, start, start + size - 1)
+            else:
+                keys = self.redis_client.zrange(index_key, start, start + size - 1)
+            if len(keys) == 0:
+                break
+            for value in self.redis_client.hmget(tablename, keys):
+                if value is not None:
+                    yield self.codec.decode(value)
+            start += size
+            size = min(2 * size, batch_size)
+
+    def get_many(self, items):
+        """"""
+        pipe = self.pipeline(transaction=False)
+        for (tablename, key) in items:
+            pipe.hget(tablename, "%s:id:%s" % (tablename, key))
+        return map(lambda x: self.codec.decode(x), pipe.execute())
+
+    def _hints_to_keys(self, tablename, hints):
+        """Convert hints to index keys: hints are combined with a logical AND,
+        and a hint whose value is a list matches any of the values (IN). It
+        returns a list of groups of secondary index keys (each group being
+        unioned, groups being intersected) and the set of keys allowed by id
+        hints (None if there is no id hint). Hints on range indexed attributes
+        are converted into groups of a single range index (see
+        _usable_hints)."""
+        index_groups = []
+        id_keys = None
+        for (attribute, value) in hints:
+            if isinstance(value, lib.rome.driver.database_driver.RangeHint):
+                index_groups += [RangeGroup("range_index:%s:%s" % (tablename, attribute), value)]
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            if attribute == "id":
+                keys = set(map(lambda x: "%s:id:%s" % (tablename, x), values))
+                id_keys = keys if id_keys is None else id_keys & keys
+            else:
+                index_groups += [map(lambda x: "sec_index:%s:%s:%s" % (tablename, attribute, x), values)]
+        return (index_groups, id_keys)
+
+    def _select_arguments(self, tablename, index_groups, id_keys):
+        """Keys and arguments of the scripts based on SELECT_SCRIPT."""
+        keys = [tablename, self._rebuilding_marker(tablename), self._rebuilt_marker(tablename)]
+        args = [len(index_groups)]
+        for index_group in index_groups:
+            if isinstance(index_group, RangeGroup):
+                keys += [index_group.key]
+                args += ["range:%s %s" % index_group.bounds()]
+            else:
+                keys += index_group
+                args += [len(index_group)]
+        args += [0] if id_keys is None else [1] + list(id_keys)
+        return (keys, args)
+
+    def _getall_with_hints(self, tablename, index_groups, id_keys):
+        """Select and fetch objects matching hints in a single server side call.
+        It returns their keys, their values and the exactness of the indexes,
+        or None while the indexes of the table are being rebuilt."""
+        if self._getall_script is None:
+            self._getall_script = self.redis_client.register_script(GETALL_SCRIPT)
+        (keys, args) = self._select_arguments(tablename, index_groups, id_keys)
+        result = self._getall_script(keys=keys, args=args)
+        if result is None:
+            return None
+        return (result[0], result[1], self.exact_secondary_indexes and result[2] == 1)
+
+    def _count_with_hints(self, tablename, index_groups, id_keys):
+        if self._count_script is None:
+            self._count_script = self.redis_client.register_script(COUNT_SCRIPT)
+        (keys, args) = self._select_arguments(tablename, index_groups, id_keys)
+        result = self._count_script(keys=keys, args=args)
+        if result is None:
+            return None
+        return (result[0], self.exact_secondary_indexes and result[1] == 1)
+
+    def count(self, tablename, hints=[]):
+        """Count objects without fetching them: with HLEN when there is no
+        hint, and with a server side selection otherwise."""
+        return self._count(tablename, hints)[0]
+
+    def count_exact(self, tablename, hints=[]):
+        """The exactness of indexes is checked by the call that counts objects."""
+        (count, exact) = self._count(tablename, hints)
+        return count if exact else None
+
+    def _count(self, tablename, hints):
+        usable_hints = self._usable_hints(tablename, hints)
+        if len(usable_hints) == 0:
+            return (self.redis_client.hlen(tablename), len(hints) == 0)
+        (index_groups, id_keys) = self._hints_to_keys(tablename, usable_hints)
+        if (id_keys is not None and len(id_keys) == 0) or [] in index_groups:
+            return (0, len(usable_hints) == len(hints))
+        result = self._count_with_hints(tablename, index_groups, id_keys)
+        if result is None:
+            # indexes are being rebuilt: hints are ignored
+            return (self.redis_client.hlen(tablename), False)
+        return (result[0], result[1] and len(usable_hints) == len(hints))
+
     def getall(self, tablename, hints=[]):
         """"""
+        return self.getall_exact(tablename, hints=hints)[0]
+
+    def getall_exact(self, tablename, hints=[]):
+        """The exactness of indexes is checked by the call that selects
+        objects."""
+        hints = self._usable_hints(tablename, hints)
+        exact = False
         if len(hints) == 0:
             keys = self.keys(tablename)
+            str_result = self.redis_client.hmget(tablename, keys) if len(keys) > 0 else []
         else:
-            id_hints = filter(lambda x:x[0] == "id", hints)
-            non_id_hints = filter(lambda x:x[0] != "id", hints)
-            sec_keys = map(lambda h: "sec_index:%s:%s:%s" % (tablename, h[0], h[1]), non_id_hints)
-            keys = map(lambda x: "%s:id:%s" % (tablename, x[1]), id_hints)
-            for sec_key in sec_keys:
-                keys += self.redis_client.smembers(sec_key)
-            # if len(sec_keys) > 0:
-            #     # keys += filter(None, self.redis_client.smembers("sec_index:%s" % (tablename), sec_keys))
-            #     keys += filter(None, self.redis_client.hmget("sec_index:%s" % (tablename), sec_keys))
-            # # keys = filter(None, keys) + id_hints
-        result = []
-        keys = list(set(keys))
-        if len(keys) > 0:
-            str_result = self.redis_client.hmget(tablename, sorted(keys, key=lambda x: int(x.split(":")[-1])))
-            # result = map(lambda x: json.loads(x), str_result)
-            # toto = """{"virtual_interface": null, "pid": "0x10e70eb90", "updated_at": {"timezone": "None", "simplify_strategy": "datetime", "value": "Jun 01 2015 14:49:31"}, "session": null, "reserved": null, "allocated": null, "deleted_at": null, "id": 2001, "network": {"pid": "0x10e783758", "simplify_strategy": "novabase", "tablename": "networks", "id": 1, "novabase_classname": "Network"}, "virtual_interface_id": null, "floating_ips": [], "instance": null, "rome_version_number": 0, "rid": "68b90a35-086d-11e5-830e-b8e8563ae48c", "deleted": null, "leased": null, "host": null, "address": "172.1.0.1", "nova_classname": "fixed_ips", "instance_uuid": null, "network_id": 1, "created_at": {"timezone": "None", "simplify_strategy": "datetime", "value": "Jun 01 2015 14:49:31"}, "metadata_novabase_classname": "FixedIp"}"""
-            python_toto = """{u'reserved': None, u'pid': u'%s', u'updated_at': {u'timezone': u'None', u'simplify_strategy': u'datetime', u'value': u'Jun 01 2015 14:49:31'}, u'session': None, u'virtual_interface': None, u'allocated': None, u'deleted_at': None, u'id': 2001, u'network': {u'tablename': u'networks', u'simplify_strategy': u'novabase', u'pid': u'0x10e783758', u'id': 1, u'novabase_classname': u'Network'}, u'virtual_interface_id': None, u'floating_ips': [], u'instance': None, u'metadata_novabase_classname': u'FixedIp', u'rid': u'68b90a35-086d-11e5-830e-b8e8563ae48c', u'deleted': None, u'leased': None, u'host': None, u'address': u'172.1.0.1', u'nova_classname': u'fixed_ips', u'instance_uuid': None, u'network_id': 1, u'created_at': {u'timezone': u'None', u'simplify_strategy': u'datetime', u'value': u'Jun 01 2015 14:49:31'}, u'rome_version_number': 0}"""
-            # print(json.loads(toto))
-            # for x in str_result:
-            #     result += [eval(x)]
-            #     pass
-                # result.append(eval(python_toto % ("cuicui")))
-            result = map(lambda x: eval(x), str_result)
-            # result = map(lambda x: eval(python_toto), str_result)
-            # result_str = "[%s]" %(",".join(str_result))
-            # result = eval(result_str)
-            # result = json.loads(result_str)
-        return result
+            (index_groups, id_keys) = self._hints_to_keys(tablename, hints)
+            if (id_keys is not None and len(id_keys) == 0) or [] in index_groups:
+                return ([], False)
+            selection = self._getall_with_hints(tablename, index_groups, id_keys)
+            if selection is None:
+                # indexes are being rebuilt: hints are ignored
+                return (self.getall(tablename), False)
+            (keys, str_result, exact) = selection
+        fetched = sorted(filter(lambda x: x[1] is not None, zip(keys, str_result)),
+                         key=lambda x: int(x[0].split(":")[-1]))
+        result = map(lambda x: self.codec.decode(x[1]), fetched)
+        return (result, exact)
 
-class RedisClusterDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
+class RedisClusterDriver(RedisDriver):
+
+    # objects and their indexes are not modified atomically (see below)
+    exact_secondary_indexes = False
 
     def __init__(self):
         config = get_config()
@@ -117,83 +755,141 @@ class RedisClusterDriver(lib.rome.driver.database_driver.DatabaseDriverInterface
         startup_nodes = map(lambda x: {"host": x, "port": "%s" % (config.port())}, config.cluster_nodes())
         self.redis_client = rediscluster.StrictRedisCluster(startup_nodes=startup_nodes, decode_responses=True)
         self.dlm = Redlock([{"host": "localhost", "port": 6379, "db": 0}, ], retry_count=10)
+        # responses are decoded as unicode strings, binary codecs cannot be used.
+        self.codec = build_codec(allow_binary=False)
+        self._put_script = self.redis_client.register_script(PUT_SCRIPT)
+        self.publish_invalidations = config.cache_invalidation()
+        self.origin = uuid.uuid4().hex
         # self.dlm = ClusterLock()
 
-    def add_key(self, tablename, key):
-        """"""
-        pass
+    def pipeline(self, transaction=True):
+        """Return a pipeline: transactions (MULTI) are not supported by redis
+        cluster, commands are only batched."""
+        return self.redis_client.pipeline()
 
-    def remove_key(self, tablename, key):
-        """"""
-        redis_key = "%s:id:%s" % (tablename, key)
-        self.redis_client.hdel(tablename, redis_key)
-        pass
+    def _queue_invalidation(self, pipe, tablename, key):
+        """PUBLISH cannot be pipelined with redis cluster: notifications are
+        sent once the pipeline has been executed."""
+        if self.publish_invalidations:
+            pipe.rome_invalidations = getattr(pipe, "rome_invalidations", []) + [(tablename, key)]
 
-    def next_key(self, tablename):
-        """"""
-        next_key = self.redis_client.incr("nextkey:%s" % (tablename), 1)
-        return next_key
+    def _execute(self, pipe):
+        result = pipe.execute()
+        for (tablename, key) in getattr(pipe, "rome_invalidations", []):
+            self.redis_client.publish(INVALIDATION_CHANNEL, self._invalidation_message(tablename, key))
+        return result
 
-    def keys(self, tablename):
+    # Scripts cannot access keys located on several nodes: secondary indexes
+    # are maintained by the client, which fetches the indexed values of objects
+    # before modifying them. Contrary to the scripts of RedisDriver, objects and
+    # their indexes are not modified atomically.
+
+    def _get_indexed_values(self, items):
+        """Return the indexed values and the range indexed attributes of the
+        given objects, as stored in the reverse index."""
+        pipe = self.redis_client.pipeline()
+        for (tablename, key) in items:
+            pipe.hget(self._reverse_index(tablename), "%s:id:%s" % (tablename, key))
+        result = []
+        for encoded_indexes in pipe.execute():
+            indexes = json.loads(encoded_indexes) if encoded_indexes is not None else {}
+            result += [(indexes.get("values", {}), indexes.get("ranges", {}).keys())]
+        return result
+
+    def _queue_index_update(self, pipe, tablename, redis_key, old_indexes, new_indexes):
+        (old_values, old_ranges) = old_indexes
+        (new_values, scores) = new_indexes
+        new_ranges = [attribute for (attribute, score) in scores.iteritems() if score is not None]
+        for (attribute, old_value) in old_values.iteritems():
+            if new_values.get(attribute, None) != old_value:
+                pipe.srem("sec_index:%s:%s:%s" % (tablename, attribute, old_value), redis_key)
+        for attribute in old_ranges:
+            if attribute not in new_ranges:
+                pipe.zrem("range_index:%s:%s" % (tablename, attribute), redis_key)
+        for (attribute, new_value) in new_values.iteritems():
+            pipe.sadd("sec_index:%s:%s:%s" % (tablename, attribute, new_value), redis_key)
+        for attribute in new_ranges:
+            pipe.zadd("range_index:%s:%s" % (tablename, attribute), scores[attribute], redis_key)
+        if len(new_values) > 0 or len(new_ranges) > 0:
+            reverse_entry = {"values": new_values, "ranges": dict(map(lambda x: (x, True), new_ranges))}
+            pipe.hset(self._reverse_index(tablename), redis_key, json.dumps(reverse_entry))
+        elif len(old_values) > 0 or len(old_ranges) > 0:
+            pipe.hdel(self._reverse_index(tablename), redis_key)
+
+    def remove_key(self, tablename, key):
         """"""
-        """Check if the current table contains keys."""
-        keys = self.redis_client.hkeys(tablename)
-        return sorted(keys)
+        redis_key = "%s:id:%s" % (tablename, key)
+        old_values = self._get_indexed_values([(tablename, key)])[0]
+        pipe = self.pipeline()
+        self._queue_index_update(pipe, tablename, redis_key, old_values, ({}, {}))
+        pipe.hdel(tablename, redis_key)
+        self._queue_invalidation(pipe, tablename, key)
+        self._execute(pipe)
 
     def put(self, tablename, key, value, secondary_indexes=[]):
         """"""
-        # lockname = "lock-%s" % (tablename)
-        # my_lock = None
-        # try_to_lock = True
-        # while try_to_lock:
-        #     my_lock = self.dlm.lock(lockname, 50)
-        #     if my_lock is not False:
-        #         try_to_lock = False
-        #     else:
-        #         time.sleep(0.020)
-        # json_value = json.dumps(value)
-        json_value = value
-        fetched = self.redis_client.hset(tablename, "%s:id:%s" % (tablename, key), json_value)
-        for secondary_index in secondary_indexes:
-            secondary_value = value[secondary_index]
-            fetched = self.redis_client.sadd("sec_index:%s:%s:%s" % (tablename, secondary_index, secondary_value), "%s:id:%s" % (tablename, key))
-            # fetched = self.redis_client.hset("sec_index:%s" % (tablename), "%s:%s:%s" % (tablename, secondary_index, secondary_value), "%s:id:%s" % (tablename, key))
-        result = value if fetched else None
-        # self.dlm.unlock(my_lock)
-        # self.dlm.unlock(lockname)
-        return result
+        self.put_many([(tablename, key, value, secondary_indexes)])
+        return value
 
-    def get(self, tablename, key, hint=None):
+    def put_many(self, items):
         """"""
+        indexed_values = self._get_indexed_values(map(lambda x: (x[0], x[1]), items))
+        pipe = self.pipeline()
+        for ((tablename, key, value, secondary_indexes), old_values) in zip(items, indexed_values):
+            redis_key = "%s:id:%s" % (tablename, key)
+            pipe.hset(tablename, redis_key, self.codec.encode(value))
+            self._queue_index_update(pipe, tablename, redis_key, old_values,
+                                     self._indexed_values(value, secondary_indexes))
+            self._queue_invalidation(pipe, tablename, key)
+        self._execute(pipe)
+        return map(lambda item: item[2], items)
+
+    def put_if_version(self, tablename, key, value, expected_version, secondary_indexes=[]):
+        """Only the object is compared and set by the script, secondary indexes
+        are then updated (and notifications sent) by the client."""
         redis_key = "%s:id:%s" % (tablename, key)
-        if hint is not None:
-            redis_keys = self.redis_client.smembers("sec_index:%s:%s:%s" % (tablename, hint[0], hint[1]))
-            redis_key = redis_keys[0]
-            # redis_key = self.redis_client.hget("sec_index:%s" % (tablename), "%s:%s:%s" % (tablename, hint[0], hint[1]))
-        fetched = self.redis_client.hget(tablename, redis_key)
-        # result = json.loads(fetched) if fetched is not None else None
-        result = eval(fetched) if fetched is not None else None
-        return result
+        (status, version) = self._put_script(
+            keys=[tablename], args=[redis_key, self.codec.encode(value), expected_version, tablename,
+                                    INVALIDATION_CHANNEL, ""])
+        if status == -1:
+            return lib.rome.driver.database_driver.DatabaseDriverInterface.put_if_version(
+                self, tablename, key, value, expected_version, secondary_indexes=secondary_indexes)
+        if status == 1:
+            old_values = self._get_indexed_values([(tablename, key)])[0]
+            pipe = self.pipeline()
+            self._queue_index_update(pipe, tablename, redis_key, old_values,
+                                     self._indexed_values(value, secondary_indexes))
+            self._queue_invalidation(pipe, tablename, key)
+            self._execute(pipe)
+        return status == 1
 
-    def getall(self, tablename, hints=[]):
-        """"""
-        if len(hints) == 0:
-            keys = self.keys(tablename)
-        else:
-            id_hints = filter(lambda x:x[0] == "id", hints)
-            non_id_hints = filter(lambda x:x[0] != "id", hints)
-            sec_keys = map(lambda h: "sec_index:%s:%s:%s" % (tablename, h[0], h[1]), non_id_hints)
-            keys = map(lambda x: "%s:id:%s" % (tablename, x[1]), id_hints)
-            for sec_key in sec_keys:
-                keys += self.redis_client.smembers(sec_key)
-            # if len(sec_keys) > 0:
-            #     # keys += filter(None, self.redis_client.smembers("sec_index:%s" % (tablename), sec_keys))
-            #     keys += filter(None, self.redis_client.hmget("sec_index:%s" % (tablename), sec_keys))
-            # # keys = filter(None, keys) + id_hints
-        result = []
-        keys = list(set(keys))
-        if len(keys) > 0:
-            str_result = self.redis_client.hmget(tablename, sorted(keys, key=lambda x:int(x.split(":")[-1])))
-            # result = map(lambda x: json.loads(x), str_result)
-            result = map(lambda x: eval(x), str_result)
-        return result
+    def _select_keys(self, index_groups, id_keys):
+        """Scripts cannot access keys located on several nodes: the selection
+        is computed on client side."""
+        candidates = id_keys
+        for index_group in index_groups:
+            if isinstance(index_group, RangeGroup):
+                (minimum, maximum) = index_group.bounds()
+                members = set(self.redis_client.zrangebyscore(index_group.key, minimum, maximum))
+            else:
+                members = self.redis_client.sunion(index_group)
+            candidates = members if candidates is None else candidates & members
+        return list(candidates)
+
+    def _getall_with_hints(self, tablename, index_groups, id_keys):
+        if self.redis_client.exists(self._rebuilding_marker(tablename)):
+            return None
+        keys = self._select_keys(index_groups, id_keys)
+        str_result = self.redis_client.hmget(tablename, keys) if len(keys) > 0 else []
+        return (keys, str_result, False)
+
+    def _count_with_hints(self, tablename, index_groups, id_keys):
+        if self.redis_client.exists(self._rebuilding_marker(tablename)):
+            return None
+        keys = self._select_keys(index_groups, id_keys)
+        if id_keys is None or len(keys) == 0:
+            return (len(keys), False)
+        pipe = self.redis_client.pipeline()
+        for key in keys:
+            pipe.hexists(tablename, key)
+        return (len(filter(lambda x: x, pipe.execute())), False)
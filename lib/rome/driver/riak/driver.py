@@ -5,6 +5,18 @@ from multiprocessing import Pool
 import json
 from lib.rome.conf.Configuration import get_config
 
+
+def increment_counter(riak_client, tablename, count):
+    """Increment the counter of the keys of a table, and return its new value.
+    The value is returned by the update itself (return_body): a value read by
+    a separate request could include the increments of other clients."""
+    bucket = riak_client.bucket_type('counters').bucket(tablename)
+    counter = Counter(bucket, "next_key")
+    counter.increment(count)
+    counter.store(return_body=True)
+    return counter.value
+
+
 class RiakDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
 
     def __init__(self):
@@ -22,12 +34,12 @@ class RiakDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
 
     def next_key(self, tablename):
         """"""
-        bucket = self.riak_client.bucket_type('counters').bucket(tablename)
-        counter = Counter(bucket, "next_key")
-        counter.increment()
-        counter.store()
-        counter.reload()
-        return counter.value
+        return increment_counter(self.riak_client, tablename, 1)
+
+    def next_keys(self, tablename, count):
+        """"""
+        last_key = increment_counter(self.riak_client, tablename, count)
+        return range(last_key - count + 1, last_key + 1)
 
     def keys(self, tablename):
         """"""
@@ -54,6 +66,14 @@ class RiakDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
         result = map(lambda x:x.data, bucket.multiget(keys))
         return result
 
+    def iter_all(self, tablename, batch_size=1000):
+        """"""
+        keys = map(lambda x:str(x), self.keys(tablename))
+        bucket = self.riak_client.bucket(tablename)
+        for i in range(0, len(keys), batch_size):
+            for fetched in bucket.multiget(keys[i:i + batch_size]):
+                yield fetched.data
+
 class MapReduceRiakDriver(lib.rome.driver.database_driver.DatabaseDriverInterface):
 
     def __init__(self):
@@ -71,12 +91,12 @@ class MapReduceRiakDriver(lib.rome.driver.database_driver.DatabaseDriverInterfac
 
     def next_key(self, tablename):
         """"""
-        bucket = self.riak_client.bucket_type('counters').bucket(tablename)
-        counter = Counter(bucket, "next_key")
-        counter.increment()
-        counter.store()
-        counter.reload()
-        return counter.value
+        return increment_counter(self.riak_client, tablename, 1)
+
+    def next_keys(self, tablename, count):
+        """"""
+        last_key = increment_counter(self.riak_client, tablename, count)
+        return range(last_key - count + 1, last_key + 1)
 
     def keys(self, tablename):
         """"""
@@ -110,4 +130,14 @@ class MapReduceRiakDriver(lib.rome.driver.database_driver.DatabaseDriverInterfac
             result = map(lambda x: json.loads(x), mapReduce.run())
         else:
             result = []
-        return result
\ No newline at end of file
+        return result
+
+    def iter_all(self, tablename, batch_size=1000):
+        """"""
+        keys = map(lambda x:str(x), self.keys(tablename))
+        for i in range(0, len(keys), batch_size):
+            mapReduce = riak.RiakMapReduce(self.riak_client)
+            mapReduce.add(tablename, keys[i:i + batch_size])
+            mapReduce.map("function(v) {return [v.values[0].data]}")
+            for fetched in mapReduce.run() or []:
+                yield json.loads(fetched)
\ No newline at end of file
@@ -0,0 +1,177 @@
+__author__ = 'jonathan'
+
+import threading
+import weakref
+from collections import OrderedDict
+
+
+def approximate_size(obj):
+    """Cheap estimation of the memory used by a decoded value, in bytes."""
+    if isinstance(obj, dict):
+        return 64 + sum(approximate_size(k) + approximate_size(v) for (k, v) in obj.iteritems())
+    if isinstance(obj, (list, tuple, set)):
+        return 64 + sum(approximate_size(x) for x in obj)
+    if isinstance(obj, basestring):
+        return 40 + len(obj)
+    return 16
+
+
+class LRUCache(object):
+    """Thread-safe cache that evicts the least recently used entries once the
+    sum of the sizes of its entries exceeds a budget. The size of an entry is
+    given by the "sizer" function (1 by default: the budget is then a number
+    of entries). When entries are mutable containers that grow after their
+    insertion, "dynamic_sizes" makes the cache recompute their sizes after as
+    many insertions as there were entries when sizes were last recomputed (so
+    that insertions remain cheap). Entries are then evicted until 90% of the
+    budget is used.
+
+    Pinned entries (for instance the caches of requests that are being
+    processed) are never evicted. When they exceed the budget on their own,
+    entries are not scanned again before the next resize (or unpin)."""
+
+    def __init__(self, budget, sizer=None, dynamic_sizes=False):
+        self.budget = budget
+        self.sizer = sizer if sizer is not None else (lambda value: 1)
+        self.dynamic_sizes = dynamic_sizes
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.pins = {}
+        self.owners = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # insertions before the sizes of entries are recomputed (and before
+        # entries are scanned again when pinned entries exceed the budget)
+        self.insertions_before_resize = 0
+        # True when pinned entries prevented the last eviction
+        self.pinned_over_budget = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._remove(key)
+            entry_size = self.sizer(value)
+            self.entries[key] = value
+            self.sizes[key] = entry_size
+            self.size += entry_size
+            self._evict()
+
+    def put_if(self, key, value, predicate):
+        """Associate value with key if predicate(cached value) is true (the
+        cached value being None if the key is not in the cache). The predicate
+        is called while the cache is locked. It returns True if the value has
+        been put in the cache."""
+        with self.lock:
+            if not predicate(self.entries.get(key, None)):
+                return False
+            self.put(key, value)
+            return True
+
+    def setdefault(self, key, default):
+        """Return the value associated with key, after having associated it
+        with default if the key was not in the cache."""
+        with self.lock:
+            if key in self.entries:
+                return self.get(key)
+            self.misses += 1
+            self.put(key, default)
+            return default
+
+    def pin(self, key):
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+
+    def unpin(self, key):
+        with self.lock:
+            count = self.pins.get(key, 0) - 1
+            if count > 0:
+                self.pins[key] = count
+            else:
+                self.pins.pop(key, None)
+                self.pinned_over_budget = False
+
+    def pin_while_alive(self, key, owner):
+        """Pin an entry until the given object is garbage collected. A weak
+        reference is used rather than __del__, which would prevent the owner
+        from being collected if it belongs to a reference cycle. References
+        are indexed by their id, as hashing them would hash their owner."""
+        def release(reference):
+            with self.lock:
+                self.owners.pop(id(reference), None)
+                self.unpin(key)
+        with self.lock:
+            self.pin(key)
+            reference = weakref.ref(owner, release)
+            self.owners[id(reference)] = reference
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries[key]
+            self._remove(key)
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.size = 0
+            self.pinned_over_budget = False
+
+    def stats(self):
+        return {"entries": len(self.entries), "size": self.size, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _remove(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self.size -= self.sizes.pop(key)
+
+    def _resize(self):
+        self.insertions_before_resize = max(1, len(self.entries))
+        self.pinned_over_budget = False
+        if not self.dynamic_sizes:
+            return
+        for key in self.entries:
+            self.sizes[key] = self.sizer(self.entries[key])
+        self.size = sum(self.sizes.values())
+
+    def _evict(self):
+        target = self.budget * 9 / 10 if self.dynamic_sizes else self.budget
+        self.insertions_before_resize -= 1
+        if self.insertions_before_resize <= 0:
+            self._resize()
+        if self.size <= self.budget or self.pinned_over_budget:
+            return
+        evicted_keys = []
+        size = self.size
+        for key in self.entries:
+            if size <= target:
+                break
+            if key in self.pins:
+                continue
+            evicted_keys += [key]
+            size -= self.sizes[key]
+        for key in evicted_keys:
+            self._remove(key)
+            self.evictions += 1
+        self.pinned_over_budget = self.size > target
@@ -0,0 +1,51 @@
+__author__ = 'jonathan'
+
+
+class PersistentList(object):
+    """Immutable list: appending an item returns a new list that shares the
+    items of the former one, in constant time. Lists are linked to the list
+    they were appended to, and the python list of their items is only built
+    when they are iterated (once)."""
+
+    __slots__ = ["last", "previous", "length", "items"]
+
+    def __init__(self, last=None, previous=None):
+        self.last = last
+        self.previous = previous
+        self.length = previous.length + 1 if previous is not None else 0
+        self.items = [] if previous is None else None
+
+    def append(self, item):
+        return PersistentList(item, self)
+
+    def extend(self, items):
+        result = self
+        for item in items:
+            result = result.append(item)
+        return result
+
+    def to_list(self):
+        """Return the items of this list (the returned list must not be
+        modified)."""
+        if self.items is None:
+            # items are collected up to the closest list whose items are known
+            reversed_items = []
+            current = self
+            while current.items is None:
+                reversed_items.append(current.last)
+                current = current.previous
+            reversed_items.reverse()
+            self.items = current.items + reversed_items
+        return self.items
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __repr__(self):
+        return repr(self.to_list())
+
+
+EMPTY_LIST = PersistentList()
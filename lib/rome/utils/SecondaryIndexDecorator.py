@@ -1,17 +1,28 @@
 __author__ = 'jonathan'
 
+from lib.rome.core.utils import invalidate_model_metadata
+
 class SecondaryIndexDecorator(object):
+    """Index an attribute of a model. Indexes of kind "set" find the objects
+    whose attribute equals a value, indexes of kind "range" keep the objects
+    sorted by the value of their attribute (a number or a date), in order to
+    find the objects whose attribute is in a range (<, <=, >, >=)."""
 
-    def __init__(self, attribute):
+    def __init__(self, attribute, kind="set"):
+        if kind not in ["set", "range"]:
+            raise ValueError("unknown kind of secondary index: %s" % (kind))
         self.attribute = attribute
+        self.kind = kind
 
     def __call__(self, model_class):
-        current_secondary_indexes = getattr(model_class, "_secondary_indexes", [])
-        setattr(model_class, "_secondary_indexes", current_secondary_indexes + [self.attribute])
+        class_attribute = "_range_indexes" if self.kind == "range" else "_secondary_indexes"
+        current_indexes = getattr(model_class, class_attribute, [])
+        setattr(model_class, class_attribute, current_indexes + [self.attribute])
+        invalidate_model_metadata(model_class)
         return model_class
 
-def secondary_index_decorator(attribute):
-    return SecondaryIndexDecorator(attribute)
+def secondary_index_decorator(attribute, kind="set"):
+    return SecondaryIndexDecorator(attribute, kind=kind)
 
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -1,6 +1,7 @@
 import lib.rome.driver.database_driver as database_driver
 from lib.rome.core.models import Entity as NovaBase
 from lib.rome.core.models import global_scope
+from lib.rome.utils.SecondaryIndexDecorator import secondary_index_decorator
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Index, Integer, BigInteger, Enum, String, schema
 from sqlalchemy.dialects.mysql import MEDIUMTEXT
@@ -96,6 +97,43 @@ class ComputeNode(BASE, NovaBase):
     # nova.virt.hardware.VirtNUMAHostTopology.to_json()
     numa_topology = Column(Text)
 
+
+@global_scope
+class Gauge(BASE, NovaBase):
+    """Represents a gauge."""
+
+    __tablename__ = 'gauges'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255))
+    amount = Column(Integer)
+
+
+@global_scope
+@secondary_index_decorator("color")
+class Marble(BASE, NovaBase):
+    """Represents a marble."""
+
+    __tablename__ = 'marbles'
+
+    id = Column(Integer, primary_key=True)
+    color = Column(String(255))
+
+
+@secondary_index_decorator("measured_at", kind="range")
+@secondary_index_decorator("amount", kind="range")
+@global_scope
+class Reading(BASE, NovaBase):
+    """Represents a reading of a sensor."""
+
+    __tablename__ = 'readings'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255))
+    amount = Column(Integer)
+    measured_at = Column(DateTime)
+
+
 def erase_fixture_data():
     print("erase data stored in database")
     tablenames = ["services", "compute_nodes"]
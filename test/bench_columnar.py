@@ -0,0 +1,85 @@
+"""Compare the default mode and the columnar mode on analytic queries.
+
+The columnar mode keeps its tables across queries when the cache is enabled
+with invalidation, which this benchmark enables. Usage (from the root of the
+repository, with a redis server configured in /etc/rome/rome.conf):
+
+    python -m test.bench_columnar [number of fixed ips]
+
+"""
+
+import sys
+import time
+
+from sqlalchemy import func
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.conf.Configuration import get_config
+from lib.rome.core.models import bulk_save
+from lib.rome.core.orm.query import Query
+from test.nova._fixtures import FixedIp, Network
+
+
+def configure():
+    config = get_config().config
+    if not config.has_section("Cache"):
+        config.add_section("Cache")
+    config.set("Cache", "enabled", "true")
+    config.set("Cache", "invalidation", "true")
+
+
+def clean():
+    driver = database_driver.get_driver()
+    driver.redis_client.delete("fixed_ips", "networks", "nextkey:fixed_ips", "nextkey:networks")
+
+
+def create_data(fixed_ip_count, network_count=50):
+    networks = []
+    for i in range(network_count):
+        network = Network()
+        network.label = "net_%s" % (i)
+        networks += [network]
+    bulk_save(networks)
+    fixed_ips = []
+    for i in range(fixed_ip_count):
+        fixed_ip = FixedIp()
+        fixed_ip.network_id = networks[i % network_count].id
+        fixed_ip.host = "host_%s" % (i % 100)
+        fixed_ip.address = "172.16.%d.%d" % (i / 255, i % 255)
+        fixed_ips += [fixed_ip]
+    bulk_save(fixed_ips)
+
+
+queries = [
+    ("count per host", lambda: Query(FixedIp).filter(FixedIp.host == "host_3").count()),
+    ("sum", lambda: Query(func.sum(FixedIp.network_id), base_model=FixedIp).filter(
+        FixedIp.host.in_(["host_1", "host_2"])).all()),
+    ("join", lambda: len(Query(FixedIp.id, Network.label).filter(FixedIp.network_id == Network.id).filter(
+        FixedIp.host == "host_4").all())),
+]
+
+
+def run(mode, repetitions=3):
+    for (name, query) in queries:
+        durations = []
+        for i in range(repetitions):
+            start = time.time()
+            result = query()
+            durations += [time.time() - start]
+        print("%-9s %-15s first: %.3fs, next: %.3fs (result: %s)" % (mode, name, durations[0],
+                                                                     min(durations[1:]), result))
+
+
+if __name__ == '__main__':
+    fixed_ip_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    configure()
+    clean()
+    try:
+        create_data(fixed_ip_count)
+        get_config().config.set("Rome", "columnar", "false")
+        run("rows")
+        get_config().config.set("Rome", "columnar", "true")
+        run("columnar")
+    finally:
+        clean()
+        database_driver.get_driver().close()
@@ -5,6 +5,7 @@ import test.nova._fixtures as models
 from sqlalchemy.util._collections import KeyedTuple
 from lib.rome.core.orm.query import or_
 from lib.rome.core.orm.query import and_
+from sqlalchemy import not_
 
 BASE = declarative_base()
 
@@ -152,5 +153,20 @@ class TestLock(unittest.TestCase):
         value = expression.evaluate(KeyedTuple([{"label": "network_2", "multi_host": False}], ["networks"]))
         self.assertFalse(value, "complex expression (3)")
 
+    def test_expression_not(self):
+        """Checks on a specified attribute with operators "NOT IN" and "NOT"."""
+
+        expression = BooleanExpression("NORMAL", models.Network.id.notin_([1, 3, 4]))
+        value = expression.evaluate(KeyedTuple([{"id": 2}], ["networks"]))
+        self.assertTrue(value, "models.Network.id not in [1, 3, 4] with models.Network.id=2")
+
+        expression = BooleanExpression("NORMAL", not_(models.Network.label.op("REGEXP")("network_3")))
+        value = expression.evaluate(KeyedTuple([{"label": "network_3"}], ["networks"]))
+        self.assertFalse(value, """not(models.Network.label REGEXP /pattern/) with models.Network.label="network_3" """)
+
+        expression = BooleanExpression("NORMAL", models.Network.label == "network_1")
+        value = expression.evaluate(KeyedTuple([{"id": 1}], ["networks"]))
+        self.assertFalse(value, """models.Network.label=="network_1" with a missing attribute""")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,67 @@
+__author__ = 'jonathan'
+
+import unittest
+
+from sqlalchemy import func
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.models import bulk_save, rebuild_indexes
+from lib.rome.core.orm.query import Query
+from test._fixtures import Marble
+from test._fixtures import Gauge
+
+
+class TestAggregation(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = database_driver.get_driver()
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        for key in self.driver.keys("marbles"):
+            self.driver.remove_key("marbles", key.split(":")[-1])
+        self.driver.redis_client.delete("gauges", "sec_index_rebuilt:marbles")
+
+    def test_count_with_indexes(self):
+        marbles = []
+        for i in range(30):
+            marble = Marble()
+            marble.color = ["red", "blue", "green"][i % 3]
+            marbles += [marble]
+        bulk_save(marbles)
+        rebuild_indexes(Marble)
+
+        driver_class = self.driver.__class__
+        original_getall = driver_class.getall
+        driver_class.getall = lambda *args, **kwargs: self.fail("objects should not be loaded")
+        try:
+            self.assertEqual(30, Query(Marble).count())
+            self.assertEqual(10, Query(Marble).filter_by(color="red").count())
+            self.assertEqual(20, Query(Marble).filter(Marble.color.in_(["red", "blue"])).count())
+            self.assertEqual(0, Query(Marble).filter_by(color="purple").count())
+            self.assertEqual(4, Query(Marble).filter_by(color="red").offset(6).limit(5).count())
+        finally:
+            driver_class.getall = original_getall
+        self.assertEqual(1, Query(Marble).filter_by(color="red").filter(Marble.id == marbles[0].id).count())
+
+    def test_streaming_aggregates(self):
+        for (name, amount) in [("a", 1), ("b", 2), ("a", 3), ("c", None), ("a", 5)]:
+            gauge = Gauge()
+            gauge.name = name
+            gauge.amount = amount
+            gauge.save()
+        self.assertEqual(3, Query(Gauge).filter_by(name="a").count())
+        self.assertEqual(2, Query(Gauge).filter(Gauge.amount > 1).limit(2).count())
+        self.assertEqual([11], Query(func.sum(Gauge.amount), base_model=Gauge).all()[0])
+        self.assertEqual([9], Query(func.sum(Gauge.amount), base_model=Gauge).filter_by(name="a").all()[0])
+
+        rows = Query(Gauge.name, func.count(Gauge.id), func.sum(Gauge.amount)).group_by(Gauge.name).all()
+        self.assertEqual([["a", 3, 9], ["b", 1, 2], ["c", 1, 0]],
+                         sorted(map(lambda x: [x[0].wrapped_dict, x[1], x[2]], rows)))
+
+
+if __name__ == '__main__':
+    unittest.main()
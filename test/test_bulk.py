@@ -0,0 +1,71 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.models import bulk_save
+from lib.rome.core.orm.query import Query
+from lib.rome.core.session.session import Session
+from test._fixtures import Marble
+
+
+class TestBulk(unittest.TestCase):
+
+    def setUp(self):
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        driver = database_driver.get_driver()
+        for key in driver.keys("marbles"):
+            driver.remove_key("marbles", key.split(":")[-1])
+
+    def test_next_keys(self):
+        driver = database_driver.get_driver()
+        keys = driver.next_keys("marbles", 5)
+        self.assertEqual(5, len(keys))
+        self.assertEqual(range(keys[0], keys[0] + 5), keys)
+        self.assertEqual(keys[-1] + 1, driver.next_key("marbles"))
+
+    def test_bulk_save(self):
+        marbles = []
+        for i in range(250):
+            marble = Marble()
+            marble.color = "red" if i % 5 == 0 else "blue"
+            marbles += [marble]
+        bulk_save(marbles, batch_size=100)
+        self.assertEqual(250, len(set(map(lambda x: x.id, marbles))))
+        self.assertEqual(250, len(Query(Marble).all()))
+        red_marbles = Query(Marble).filter(Marble.color == "red").all()
+        self.assertEqual(sorted(map(lambda x: x.id, marbles[::5])), sorted(map(lambda x: x.id, red_marbles)))
+
+    def test_existing_objects(self):
+        marble = Marble()
+        marble.color = "red"
+        bulk_save([marble])
+        self.assertEqual(0, marble.rome_version_number)
+        self.assertEqual(set(), marble.dirty_fields())
+
+        other_marble = Query(Marble).filter_by(id=marble.id).first()
+        other_marble.color = "green"
+        other_marble.save()
+        # the object is saved with a compare and set: its version is not reset
+        marble.color = "blue"
+        new_marble = Marble()
+        new_marble.color = "yellow"
+        bulk_save([marble, new_marble])
+        stored_marble = Query(Marble).filter_by(id=marble.id).first()
+        self.assertEqual(2, stored_marble.rome_version_number)
+        self.assertEqual("blue", stored_marble.color)
+        self.assertEqual(0, Query(Marble).filter_by(id=new_marble.id).first().rome_version_number)
+
+    def test_bulk_insert_mappings(self):
+        session = Session()
+        session.bulk_insert_mappings(Marble, [{"color": "green"}, {"color": "yellow"}])
+        self.assertEqual(["green", "yellow"], sorted(map(lambda x: x.color, Query(Marble).all())))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,199 @@
+__author__ = 'jonathan'
+
+import time
+import unittest
+
+from lib.rome.driver.cache import CachedDriver
+from lib.rome.driver.database_driver import DatabaseDriverInterface
+from lib.rome.driver.redis.driver import RedisDriver
+from lib.rome.utils.LRUCache import LRUCache
+
+
+class DictDriver(DatabaseDriverInterface):
+    """Driver that stores objects in a dict, and counts the reads."""
+
+    def __init__(self):
+        self.data = {}
+        self.reads = 0
+
+    def put(self, tablename, key, value, secondary_indexes=[]):
+        self.data[(tablename, "%s" % (key))] = dict(value)
+        return value
+
+    def get(self, tablename, key, hint=None):
+        self.reads += 1
+        return self.data.get((tablename, "%s" % (key)), None)
+
+    def getall(self, tablename, hints=[]):
+        self.reads += 1
+        return [v for (k, v) in sorted(self.data.items()) if k[0] == tablename]
+
+    def remove_key(self, tablename, key):
+        self.data.pop((tablename, "%s" % (key)), None)
+
+
+class TestCache(unittest.TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(3, sizer=lambda value: len(value))
+        cache.put("a", "x")
+        cache.put("b", "yy")
+        self.assertEqual("x", cache.get("a"))
+        cache.put("c", "z")
+        self.assertEqual(None, cache.get("b"))
+        self.assertEqual(["a", "c"], list(cache.entries))
+        self.assertEqual(2, cache.size)
+        self.assertEqual({"entries": 2, "size": 2, "budget": 3, "hits": 1, "misses": 1, "evictions": 1},
+                         cache.stats())
+        self.assertFalse(cache.put_if("a", "xx", lambda cached_value: cached_value is None))
+        self.assertTrue(cache.put_if("d", "w", lambda cached_value: cached_value is None))
+        self.assertEqual(["a", "c", "d"], list(cache.entries))
+
+    def test_pinned_request_caches(self):
+        class Owner(object):
+            pass
+        caches = LRUCache(4, sizer=lambda value: 1 + len(value), dynamic_sizes=True)
+        owner = Owner()
+        caches.pin_while_alive("request_1", owner)
+        request_cache = caches.setdefault("request_1", {})
+        request_cache.update({"a": 1, "b": 2, "c": 3, "d": 4})
+        caches.setdefault("request_2", {})
+        self.assertTrue("request_1" in caches)
+        self.assertFalse("request_2" in caches)
+
+        del owner
+        caches.setdefault("request_3", {})
+        self.assertFalse("request_1" in caches)
+        self.assertEqual({}, caches.pins)
+
+    def test_dynamic_sizes_are_amortized(self):
+        calls = [0]
+
+        def sizer(value):
+            calls[0] += 1
+            return 1 + len(value)
+        caches = LRUCache(100000, sizer=sizer, dynamic_sizes=True)
+        for i in range(2000):
+            caches.setdefault(i, {})
+        self.assertTrue(calls[0] < 10 * 2000)
+
+    def test_pinned_entries_over_budget(self):
+        class Owner(object):
+            pass
+        calls = [0]
+
+        def sizer(value):
+            calls[0] += 1
+            return 1 + len(value)
+        caches = LRUCache(10, sizer=sizer, dynamic_sizes=True)
+        owners = [Owner() for i in range(5)]
+        for (i, owner) in enumerate(owners):
+            caches.pin_while_alive(i, owner)
+            caches.setdefault(i, {}).update(dict((j, j) for j in range(10)))
+        # pinned entries alone exceed the budget: sizes are not recomputed at
+        # each insertion
+        calls[0] = 0
+        for i in range(5, 2005):
+            caches.setdefault(i, {})
+        self.assertTrue(calls[0] < 3 * 2000)
+        self.assertTrue(all(i in caches for i in range(5)))
+        self.assertEqual(5, len(caches.owners))
+
+        del owners[:], owner
+        caches.setdefault("last", {})
+        self.assertEqual({}, caches.pins)
+        self.assertEqual({}, caches.owners)
+        self.assertTrue(caches.size <= 10)
+
+    def test_cached_driver(self):
+        backend = DictDriver()
+        driver = CachedDriver(backend, 1024 * 1024)
+        driver.put("services", 1, {"id": 1, "host": "host_1", "rome_version_number": 0})
+        self.assertEqual("host_1", driver.get("services", 1)["host"])
+        self.assertEqual(0, backend.reads)
+
+        # another process updates the object: a scan refreshes the cache
+        backend.put("services", 1, {"id": 1, "host": "host_2", "rome_version_number": 1})
+        self.assertEqual("host_1", driver.get_many([("services", 1)])[0]["host"])
+        driver.getall("services")
+        self.assertEqual("host_2", driver.get("services", 1)["host"])
+
+        # an older version does not replace a more recent one
+        driver.store("services", 1, {"id": 1, "host": "host_3", "rome_version_number": 0})
+        self.assertEqual("host_2", driver.get("services", 1)["host"])
+
+        driver.remove_key("services", 1)
+        self.assertEqual(None, driver.get("services", 1))
+
+    def test_id_hints(self):
+        backend = DictDriver()
+        driver = CachedDriver(backend, 1024 * 1024)
+        for i in range(1, 4):
+            driver.put("services", i, {"id": i, "host": "host_%s" % (i), "rome_version_number": 0})
+        self.assertEqual([1, 3], map(lambda x: x["id"], driver.getall("services", [("id", ["3", "1", "4"])])))
+        self.assertEqual([2], map(lambda x: x["id"], driver.getall("services", [("id", [1, 2]), ("id", "2")])))
+        # only the missing object is read from the backend
+        self.assertEqual(1, backend.reads)
+        self.assertEqual(3, len(driver.getall("services", [("host", "host_1")])))
+        self.assertEqual(2, backend.reads)
+
+    def test_copies(self):
+        driver = CachedDriver(DictDriver(), 1024 * 1024)
+        value = {"id": 1, "tags": ["a"], "metadata": {"zone": "a"}, "rome_version_number": 0}
+        driver.put("services", 1, value)
+        value["tags"].append("b")
+        driver.get("services", 1)["metadata"]["zone"] = "b"
+        driver.get_many([("services", 1)])[0]["tags"].append("c")
+        self.assertEqual({"id": 1, "tags": ["a"], "metadata": {"zone": "a"}, "rome_version_number": 0},
+                         driver.get("services", 1))
+
+
+
+def wait_until(condition, timeout=5):
+    """Poll condition until it is satisfied, or until timeout (in seconds)."""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestInvalidation(unittest.TestCase):
+
+    def setUp(self):
+        self.local_backend = RedisDriver()
+        self.remote_backend = RedisDriver()
+        self.remote_backend.publish_invalidations = True
+        self.driver = CachedDriver(self.local_backend, 1024 * 1024, invalidation=True)
+
+    def tearDown(self):
+        self.driver.close()
+        self.local_backend.redis_client.delete("cache_tests", "nextkey:cache_tests",
+                                               "sec_index:cache_tests:host:host_1",
+                                               "sec_index:cache_tests:host:host_2",
+                                               "sec_index_values:cache_tests")
+
+    def test_invalidation(self):
+        driver = self.driver
+        self.assertTrue(driver.subscription.subscribed.wait(5))
+        self.remote_backend.put("cache_tests", 1, {"id": 1, "host": "host_1", "rome_version_number": 0}, ["host"])
+        self.assertEqual([1], map(lambda x: x["id"], driver.getall("cache_tests", [("host", "host_1")])))
+        self.assertEqual("host_1", driver.get("cache_tests", 1)["host"])
+
+        self.remote_backend.put("cache_tests", 2, {"id": 2, "host": "host_1", "rome_version_number": 0}, ["host"])
+        self.remote_backend.put("cache_tests", 1, {"id": 1, "host": "host_2", "rome_version_number": 1}, ["host"])
+        self.assertTrue(wait_until(lambda: driver.get("cache_tests", 1)["host"] == "host_2"))
+        self.assertEqual([2], map(lambda x: x["id"], filter(lambda x: x["host"] == "host_1",
+                                                            driver.getall("cache_tests", [("host", "host_1")]))))
+
+    def test_stop(self):
+        subscription = self.driver.subscription
+        self.assertTrue(subscription.subscribed.wait(5))
+        self.driver.close()
+        self.assertFalse(subscription.is_alive())
+        self.assertEqual(None, self.driver.subscription)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+__author__ = 'jonathan'
+
+import unittest
+
+from lib.rome.driver.codec import ValueCodec, JsonCodec, ReprCodec, JSON_HEADER
+
+
+class TestCodec(unittest.TestCase):
+
+    value = {
+        "id": 3,
+        "name": u"Bobby",
+        "deleted": None,
+        "disabled": False,
+        "floating_ips": [],
+        "updated_at": {"simplify_strategy": "datetime", "value": "Jun 01 2015 14:49:31", "timezone": "None"}
+    }
+
+    def test_json_round_trip(self):
+        codec = ValueCodec(JsonCodec())
+        payload = codec.encode(self.value)
+        self.assertEqual(JSON_HEADER, payload[0])
+        self.assertEqual(self.value, codec.decode(payload))
+
+    def test_legacy_values(self):
+        legacy_payload = ReprCodec().encode(self.value)
+        codec = ValueCodec(JsonCodec())
+        self.assertEqual(self.value, codec.decode(legacy_payload))
+
+        codec = ValueCodec(JsonCodec(), read_legacy_values=False)
+        self.assertRaises(ValueError, codec.decode, legacy_payload)
+
+    def test_legacy_values_are_not_evaluated(self):
+        codec = ValueCodec(JsonCodec())
+        self.assertRaises(ValueError, codec.decode, "__import__('os').getcwd()")
+
+    def test_none(self):
+        codec = ValueCodec(JsonCodec())
+        self.assertEqual(None, codec.decode(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
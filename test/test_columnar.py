@@ -0,0 +1,118 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import lib.rome.driver.database_driver as database_driver
+import test.nova._fixtures as models
+from lib.rome.core.expression.expression import BooleanExpression
+from lib.rome.core.rows.aggregation import aggregate_rows
+from lib.rome.core.rows.planner import build_plan, Predicate
+from lib.rome.core.rows.columnar import numpy, ColumnarTable, COLUMNAR_TABLES, aggregate, join_tuples, load_table
+from lib.rome.core.rows.rows_experimental import building_tuples, join_template
+from lib.rome.core.terms.terms import Function
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestColumnar(unittest.TestCase):
+
+    fixed_ips = [{"id": 1, "deleted": None, "network_id": 3, "host": "host_1", "nova_classname": "fixed_ips"},
+                 {"id": 2, "deleted": None, "network_id": 4, "host": None, "nova_classname": "fixed_ips"},
+                 {"id": 3, "deleted": 3, "network_id": 3, "host": "host_2", "nova_classname": "fixed_ips"},
+                 {"id": 4, "deleted": None, "network_id": 3, "nova_classname": "fixed_ips"}]
+
+    def test_mask(self):
+        criterions = [
+            BooleanExpression("NORMAL", models.FixedIp.deleted == None),
+            BooleanExpression("NORMAL", models.FixedIp.network_id.in_([3, 5]))
+        ]
+        plan = build_plan(["fixed_ips"], criterions)
+        table = ColumnarTable("fixed_ips", self.fixed_ips)
+        mask = table.mask(plan.predicates["fixed_ips"])
+        self.assertEqual([1, 4], [x["id"] for x in table.select(mask)])
+        self.assertEqual(list(plan.filter("fixed_ips", self.fixed_ips)), table.select(mask))
+
+        plan = build_plan(["fixed_ips"], [BooleanExpression("NORMAL", models.FixedIp.host == "host_2")])
+        mask = table.mask(plan.predicates["fixed_ips"])
+        self.assertEqual([3], [x["id"] for x in table.select(mask)])
+
+    def test_comparisons(self):
+        # columns are compared as rows are: 0 == False, 1 == 1.0, 3 != "3"
+        objects = self.fixed_ips + [{"id": 5, "deleted": 0, "network_id": 1, "host": True},
+                                    {"id": 6, "deleted": 1, "network_id": 0, "host": 0}]
+        table = ColumnarTable("fixed_ips", objects)
+        for value in [False, True, 0, 1, 3, 3.0, "3", None]:
+            for attribute in ["deleted", "network_id", "host"]:
+                predicates = [Predicate("fixed_ips", attribute, "eq", value)]
+                expected = filter(predicates[0].match, objects)
+                self.assertEqual(expected, table.select(table.mask(predicates)), (attribute, value))
+        for values in [[True], [3, "host_1"], [1.0], [None, False]]:
+            for attribute in ["deleted", "network_id", "host"]:
+                predicates = [Predicate("fixed_ips", attribute, "in", values)]
+                expected = filter(predicates[0].match, objects)
+                self.assertEqual(expected, table.select(table.mask(predicates)), (attribute, values))
+
+    def test_join(self):
+        networks = [{"id": 3, "label": "a"}, {"id": 4.0, "label": "b"}, {"id": 5, "label": "c"}]
+        objects = self.fixed_ips + [{"id": 5, "deleted": None, "network_id": 3}]
+        labels = ["fixed_ips", "networks"]
+        criterions = [BooleanExpression("NORMAL", models.FixedIp.network_id == models.Network.id)]
+        (edges, _) = join_template(labels, criterions)
+        tables = [ColumnarTable("fixed_ips", objects), ColumnarTable("networks", networks)]
+        masks = [numpy.ones(len(objects), dtype=bool), numpy.array([True, True, False])]
+        tuples = join_tuples(zip(tables, masks), edges[0])
+        expected = building_tuples([objects, networks[:2]], labels, criterions)
+        ids = lambda x: sorted(map(lambda y: (y[0]["id"], y[1]["id"]), x))
+        self.assertEqual([(1, 3), (2, 4), (3, 3), (4, 3), (5, 3)], ids(tuples))
+        self.assertEqual(ids(expected), ids(tuples))
+        # columns that are not numeric are joined on rows
+        criterions = [BooleanExpression("NORMAL", models.FixedIp.host == models.Network.label)]
+        (edges, _) = join_template(labels, criterions)
+        self.assertEqual(None, join_tuples(zip(tables, masks), edges[0]))
+
+    def test_kept_tables(self):
+        driver = database_driver.get_driver()
+        generation = [0]
+        loads = []
+
+        def load_objects():
+            loads.append(True)
+            return self.fixed_ips
+        driver.table_generation = lambda tablename: generation[0]
+        COLUMNAR_TABLES.clear()
+        try:
+            table = load_table("fixed_ips", load_objects)
+            self.assertTrue(load_table("fixed_ips", load_objects) is table)
+            self.assertEqual(1, len(loads))
+            # kept objects are copied when they are selected
+            selected = table.select(numpy.ones(len(table), dtype=bool))
+            selected[0]["host"] = "host_3"
+            self.assertEqual("host_1", table.objects[0]["host"])
+            generation[0] += 1
+            self.assertFalse(load_table("fixed_ips", load_objects) is table)
+            self.assertEqual(2, len(loads))
+            # tables loaded with hints are not kept
+            COLUMNAR_TABLES.clear()
+            load_table("fixed_ips", load_objects, complete=False)
+            load_table("fixed_ips", load_objects, complete=False)
+            self.assertEqual(4, len(loads))
+        finally:
+            del driver.table_generation
+            COLUMNAR_TABLES.clear()
+
+    def test_aggregate(self):
+        table = ColumnarTable("fixed_ips", self.fixed_ips)
+        plan = build_plan(["fixed_ips"], [BooleanExpression("NORMAL", models.FixedIp.network_id == 3)])
+        mask = table.mask(plan.predicates["fixed_ips"])
+        functions = [Function("count", "fixed_ips.id"), Function("sum", "fixed_ips.id"),
+                     Function("sum", "fixed_ips.deleted")]
+        # NULL values are ignored, in both modes
+        self.assertEqual([3, 8, 3], aggregate(table, mask, functions))
+        self.assertEqual([3, 8, 3], aggregate_rows(table.select(mask), functions))
+        functions = [Function("sum", "fixed_ips.host"), Function("sum", "fixed_ips.deleted")]
+        all_objects = numpy.ones(len(table), dtype=bool)
+        self.assertEqual(aggregate_rows(self.fixed_ips, functions), aggregate(table, all_objects, functions))
+        self.assertEqual(None, aggregate(table, mask, [Function("count", "networks.id")]))
+
+
+if __name__ == '__main__':
+    unittest.main()
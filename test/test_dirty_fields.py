@@ -0,0 +1,67 @@
+__author__ = 'jonathan'
+
+import unittest
+
+from lib.rome.core.orm.query import Query
+from lib.rome.driver.redis.driver import RedisDriver
+from test._fixtures import Gauge
+
+
+class TestDirtyFields(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = RedisDriver()
+        self.driver.redis_client.delete("gauges")
+
+    def tearDown(self):
+        self.driver.redis_client.delete("gauges")
+
+    def test_tracking(self):
+        gauge = Gauge()
+        gauge.name = "visits"
+        gauge.amount = 1
+        self.assertEqual(set(["name", "amount"]), gauge.dirty_fields())
+        gauge.save()
+        self.assertEqual(set(), gauge.dirty_fields())
+
+        gauge.amount = 1
+        self.assertEqual(set(), gauge.dirty_fields())
+        gauge.update({"amount": 2})
+        self.assertTrue("amount" in gauge.dirty_fields())
+
+    def test_save_dirty_fields(self):
+        gauge = Gauge()
+        gauge.name = "visits"
+        gauge.amount = 1
+        gauge.save()
+
+        loaded_gauge = Query(Gauge).filter_by(id=gauge.id).first()
+        self.assertEqual(set(), loaded_gauge.dirty_fields())
+        loaded_gauge.save()
+        self.assertEqual(0, self.driver.get("gauges", gauge.id)["rome_version_number"])
+
+        loaded_gauge.amount = 5
+        self.assertEqual(set(["amount"]), loaded_gauge.dirty_fields())
+        loaded_gauge.save()
+        stored_gauge = self.driver.get("gauges", gauge.id)
+        self.assertEqual(5, stored_gauge["amount"])
+        self.assertEqual("visits", stored_gauge["name"])
+        self.assertEqual(1, stored_gauge["rome_version_number"])
+        self.assertEqual(set(), loaded_gauge.dirty_fields())
+
+    def test_mutated_containers(self):
+        gauge = Gauge()
+        gauge.name = ["visits"]
+        gauge.save()
+
+        loaded_gauge = Query(Gauge).filter_by(id=gauge.id).first()
+        loaded_gauge.name.append("clicks")
+        self.assertEqual(set(), loaded_gauge.dirty_fields())
+        loaded_gauge.save()
+        stored_gauge = self.driver.get("gauges", gauge.id)
+        self.assertEqual(["visits", "clicks"], stored_gauge["name"])
+        self.assertEqual(1, stored_gauge["rome_version_number"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.models import bulk_save
+from lib.rome.core.orm.query import Query
+from lib.rome.core.utils import get_objects, get_models_satisfying
+from test._fixtures import Gauge
+
+
+class TestIterAll(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = database_driver.get_driver()
+        self.driver.redis_client.delete("gauges")
+        gauges = []
+        for i in range(50):
+            gauge = Gauge()
+            gauge.name = "gauge_%s" % (i % 2)
+            gauge.amount = i
+            gauges += [gauge]
+        bulk_save(gauges)
+
+    def tearDown(self):
+        if "iter_all" in self.driver.__dict__:
+            del self.driver.iter_all
+        self.driver.redis_client.delete("gauges")
+
+    def test_batches(self):
+        # large hashes are scanned with several calls
+        bulk_save(map(lambda x: Gauge(), range(1000)))
+        # objects are not sorted
+        values = sorted(self.driver.iter_all("gauges", batch_size=7), key=lambda x: x["id"])
+        self.assertEqual(1050, len(set(map(lambda x: x["id"], values))))
+        self.assertEqual(self.driver.getall("gauges"), values)
+
+    def test_duplicates(self):
+        original_iter_all = self.driver.iter_all
+
+        def iter_all(tablename, batch_size=1000):
+            for value in original_iter_all(tablename, batch_size=batch_size):
+                yield value
+                yield value
+        self.driver.iter_all = iter_all
+
+        self.assertEqual(50, len(list(get_objects("gauges", batch_size=7))))
+        self.assertEqual(25, len(get_models_satisfying("gauges", "name", "gauge_0")))
+        self.assertEqual(50, len(Query(Gauge).all()))
+        self.assertEqual(25, Query(Gauge).filter_by(name="gauge_1").count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import test.nova._fixtures as models
+from lib.rome.core.expression.expression import BooleanExpression
+from lib.rome.core.rows.rows_experimental import building_tuples, join_template
+
+
+class TestJoin(unittest.TestCase):
+
+    instances = [{"id": 1, "uuid": "uuid_1"}, {"id": 2, "uuid": "uuid_2"}, {"id": 3, "uuid": None}]
+    instance_metadata = [{"id": 1, "instance_uuid": "uuid_1"}, {"id": 2, "instance_uuid": "uuid_1"},
+                         {"id": 3, "instance_uuid": "uuid_2"}, {"id": 4, "instance_uuid": None}]
+    instance_system_metadata = [{"id": 1, "instance_uuid": "uuid_1"}, {"id": 2, "instance_uuid": "uuid_3"}]
+
+    def ids(self, tuples):
+        return sorted(map(lambda x: tuple(map(lambda y: y["id"], x)), tuples))
+
+    def test_three_way_join(self):
+        labels = ["instance_metadata", "instances", "instance_system_metadata"]
+        criterions = [
+            BooleanExpression("NORMAL", models.InstanceMetadata.instance_uuid == models.Instance.uuid),
+            BooleanExpression("NORMAL", models.InstanceSystemMetadata.instance_uuid == models.Instance.uuid)
+        ]
+        tuples = building_tuples([self.instance_metadata, self.instances, self.instance_system_metadata],
+                                 labels, criterions)
+        self.assertEqual([(1, 1, 1), (2, 1, 1)], self.ids(tuples))
+
+    def test_join_templates(self):
+        labels = ["instance_metadata", "instances"]
+        criterions = [BooleanExpression("NORMAL", models.InstanceMetadata.instance_uuid == models.Instance.uuid),
+                      BooleanExpression("NORMAL", models.Instance.id == 1)]
+        (edges, components) = join_template(labels, criterions)
+        self.assertEqual([["instance_metadata", "instances"]], components)
+        self.assertEqual(1, len(edges))
+        # criterions of the same shapes share their joining conditions
+        other_criterions = [criterions[0], BooleanExpression("NORMAL", models.Instance.id == 2)]
+        self.assertTrue(join_template(labels, other_criterions)[0] is edges)
+        other_labels = ["instance_metadata", "instances", "networks"]
+        self.assertEqual([["instance_metadata", "instances"], ["networks"]],
+                         join_template(other_labels, other_criterions)[1])
+        # criterions that do not join tables are evaluated on the tuples
+        tuples = building_tuples([self.instance_metadata, self.instances], labels, criterions)
+        self.assertEqual([(1, 1), (2, 1), (3, 2)], self.ids(tuples))
+
+    def test_join_with_relationship(self):
+        labels = ["instances", "instance_metadata"]
+        tuples = building_tuples([self.instances, self.instance_metadata + self.instance_metadata[:1]], labels, [])
+        self.assertEqual([(1, 1), (1, 2), (2, 3)], self.ids(tuples))
+
+    def test_cartesian_product(self):
+        labels = ["networks", "instances"]
+        tuples = building_tuples([[{"id": 1}, {"id": 2}], self.instances[:2]], labels, [])
+        self.assertEqual([(1, 1), (1, 2), (2, 1), (2, 2)], self.ids(tuples))
+
+
+if __name__ == '__main__':
+    unittest.main()
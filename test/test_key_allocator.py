@@ -0,0 +1,57 @@
+__author__ = 'jonathan'
+
+import threading
+import unittest
+
+from lib.rome.driver.database_driver import DatabaseDriverInterface
+from lib.rome.driver.key_allocator import KeyAllocator
+
+
+class CounterDriver(DatabaseDriverInterface):
+    """Driver that only counts keys, and the requests made to reserve them."""
+
+    def __init__(self):
+        self.counters = {}
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def next_key(self, tablename):
+        return self.next_keys(tablename, 1)[0]
+
+    def next_keys(self, tablename, count):
+        with self.lock:
+            self.requests += 1
+            last_key = self.counters.get(tablename, 0) + count
+            self.counters[tablename] = last_key
+            return range(last_key - count + 1, last_key + 1)
+
+
+class TestKeyAllocator(unittest.TestCase):
+
+    def test_blocks(self):
+        driver = CounterDriver()
+        allocator = KeyAllocator(driver, block_size=10)
+        self.assertEqual([1, 2, 3], map(lambda i: allocator.next_key("dogs"), range(3)))
+        self.assertEqual(1, allocator.next_key("cats"))
+        self.assertEqual(2, driver.requests)
+        self.assertEqual([4, 5, 6, 7, 8, 9, 10, 11, 12], allocator.next_keys("dogs", 9))
+        self.assertEqual(13, allocator.next_key("dogs"))
+        self.assertEqual(4, driver.requests)
+
+    def test_threads(self):
+        driver = CounterDriver()
+        allocator = KeyAllocator(driver, block_size=7)
+        keys = []
+
+        def allocate():
+            keys.extend(map(lambda i: allocator.next_key("dogs"), range(100)))
+        threads = map(lambda i: threading.Thread(target=allocate), range(8))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(range(1, 801), sorted(keys))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import test.nova._fixtures as models
+from lib.rome.core.utils import get_model_metadata
+
+
+class TestModelMetadata(unittest.TestCase):
+
+    def test_relationships(self):
+        metadata = get_model_metadata(models.InstanceMetadata)
+        relationships = dict(map(lambda x: (x.local_object_field, x), metadata.relationships))
+        self.assertTrue("instance" in relationships)
+        self.assertEqual("instance_uuid", relationships["instance"].local_fk_field)
+        self.assertEqual("instances", relationships["instance"].remote_object_tablename)
+        self.assertEqual("uuid", relationships["instance"].remote_object_field)
+        self.assertFalse(relationships["instance"].is_list)
+        self.assertTrue(get_model_metadata(models.InstanceMetadata) is metadata)
+
+    def test_foreign_keys_and_default_values(self):
+        self.assertEqual([("instance_uuid", "instances", "uuid")],
+                         get_model_metadata(models.InstanceMetadata).foreign_keys)
+        metadata = get_model_metadata(models.FixedIp)
+        self.assertEqual(("deleted", 0), metadata.default_values["deleted"])
+        self.assertFalse("created_at" in metadata.default_values)
+
+
+if __name__ == '__main__':
+    unittest.main()
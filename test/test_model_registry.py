@@ -0,0 +1,38 @@
+__author__ = 'jonathan'
+
+import unittest
+
+from sqlalchemy import Column, Integer
+from sqlalchemy.ext.declarative import declarative_base
+
+import test.nova._fixtures as models
+from lib.rome.core.models import Entity, global_scope
+from lib.rome.core.models import get_model_class_from_name, get_model_classname_from_tablename
+
+BASE = declarative_base()
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def test_lookups(self):
+        self.assertEqual("FixedIp", get_model_classname_from_tablename("fixed_ips"))
+        self.assertEqual(models.FixedIp, get_model_class_from_name("FixedIp"))
+        self.assertEqual(models.Network, get_model_class_from_name("networks"))
+        self.assertEqual(models.InstanceActionEvent, get_model_class_from_name("instanceActionsEvents"))
+        self.assertEqual(None, get_model_classname_from_tablename("unknown_table"))
+
+    def test_registration(self):
+        self.assertEqual(None, get_model_class_from_name("Cat"))
+        self.assertEqual(None, get_model_classname_from_tablename("cats"))
+
+        @global_scope
+        class Cat(BASE, Entity):
+            __tablename__ = "cats"
+            id = Column(Integer, primary_key=True)
+
+        self.assertEqual(Cat, get_model_class_from_name("Cat"))
+        self.assertEqual("Cat", get_model_classname_from_tablename("cats"))
+
+
+if __name__ == '__main__':
+    unittest.main()
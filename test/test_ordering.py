@@ -0,0 +1,85 @@
+__author__ = 'jonathan'
+
+import datetime
+import random
+import unittest
+
+from lib.rome.core.orm.query import Query
+from lib.rome.core.rows.ordering import sort_rows
+from lib.rome.driver.redis.driver import RedisDriver
+from test._fixtures import Gauge
+from test._fixtures import Reading
+
+
+class TestOrdering(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = RedisDriver()
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        self.driver.redis_client.delete("gauges", "readings", "sec_index_values:readings",
+                                        "range_index:readings:amount", "range_index:readings:measured_at")
+
+    def test_sort_rows(self):
+        rows = [{"name": "b", "amount": 1}, {"name": "a", "amount": 1}, {"name": "c", "amount": None},
+                {"name": "d", "amount": 2}]
+        ordering = [("gauges", "amount", True), ("gauges", "name", False)]
+        self.assertEqual(["d", "a", "b", "c"], map(lambda x: x["name"], sort_rows(rows, ["gauges"], ordering)))
+        self.assertEqual(["a", "b"], map(lambda x: x["name"], sort_rows(iter(rows), ["gauges"], ordering,
+                                                                         offset=1, limit=2)))
+        self.assertEqual(["c", "b"], map(lambda x: x["name"], sort_rows(rows, ["gauges"], [("gauges", "amount", False)],
+                                                                         limit=2)))
+
+    def test_queries(self):
+        amounts = range(20)
+        random.shuffle(amounts)
+        for amount in amounts:
+            gauge = Gauge()
+            gauge.name = "gauge_%s" % (amount)
+            gauge.amount = amount
+            gauge.save()
+        self.assertEqual(range(20), map(lambda x: x.amount, Query(Gauge).order_by(Gauge.amount).all()))
+        query = Query(Gauge).order_by(Gauge.amount.desc()).offset(2).limit(3)
+        self.assertEqual([17, 16, 15], map(lambda x: x.amount, query.all()))
+        self.assertEqual(4, len(Query(Gauge).limit(4).all()))
+        self.assertEqual(20, len(Query(Gauge).order_by(Gauge.amount).order_by(None).all()))
+
+    def test_range_index_order(self):
+        start = datetime.datetime(2016, 1, 1)
+        for i in range(10):
+            reading = Reading()
+            reading.amount = i % 3
+            reading.measured_at = start + datetime.timedelta(hours=(i * 7) % 10)
+            reading.save()
+        query = Query(Reading).filter(Reading.amount == 1).order_by(Reading.measured_at.desc()).limit(2)
+        self.assertEqual([start + datetime.timedelta(hours=h) for h in [9, 8]],
+                         map(lambda x: x.measured_at, query.all()))
+        self.assertIsNotNone(self.driver.iter_by_range_index("readings", "measured_at"))
+        # the first batch holds the requested rows, and batches then double
+        ranges = []
+        original_zrevrange = self.driver.redis_client.zrevrange
+
+        def zrevrange(name, start, end):
+            ranges.append((start, end))
+            return original_zrevrange(name, start, end)
+        self.driver.redis_client.zrevrange = zrevrange
+        values = self.driver.iter_by_range_index("readings", "measured_at", descending=True, batch_size=4,
+                                                 first_batch_size=1)
+        self.assertEqual(10, len(list(values)))
+        self.assertEqual([(0, 0), (1, 2), (3, 6), (7, 10), (11, 14)], ranges)
+
+        # objects whose value is NULL are not indexed: rows are sorted in memory
+        reading = Reading()
+        reading.amount = 1
+        reading.save()
+        self.assertIsNone(self.driver.iter_by_range_index("readings", "measured_at"))
+        query = Query(Reading).filter(Reading.amount == 1).order_by(Reading.measured_at).limit(2)
+        self.assertEqual([None, start + datetime.timedelta(hours=7)], map(lambda x: x.measured_at, query.all()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import test.nova._fixtures as models
+from lib.rome.core.orm.query import or_
+from lib.rome.core.orm.query import and_
+from sqlalchemy import func
+from sqlalchemy.util._collections import KeyedTuple
+
+from lib.rome.core.expression.expression import BooleanExpression, COMPILED_SHAPES
+from lib.rome.core.rows.planner import build_plan
+
+
+class TestPlanner(unittest.TestCase):
+
+    def test_pushdown(self):
+        criterions = [
+            BooleanExpression("NORMAL", models.FixedIp.deleted == None),
+            BooleanExpression("NORMAL", models.FixedIp.network_id == 3),
+            and_(models.Network.label == "network_1", models.Network.id.in_([1, 2]))
+        ]
+        plan = build_plan(["fixed_ips", "networks"], criterions)
+        self.assertEqual([], plan.residual_criterions)
+        self.assertEqual(2, len(plan.predicates["fixed_ips"]))
+        self.assertEqual(2, len(plan.predicates["networks"]))
+
+        fixed_ips = [{"id": 1, "deleted": None, "network_id": 3},
+                     {"id": 2, "deleted": None, "network_id": 4},
+                     {"id": 3, "deleted": 3, "network_id": 3}]
+        self.assertEqual([1], [x["id"] for x in plan.filter("fixed_ips", fixed_ips)])
+
+        self.assertEqual([("id", ["1", "2"])], plan.hints("networks", []))
+        self.assertEqual([("label", "network_1"), ("id", ["1", "2"])], plan.hints("networks", ["label"]))
+
+    def test_residual_criterions(self):
+        join_criterion = BooleanExpression("NORMAL", models.FixedIp.network_id == models.Network.id)
+        or_criterion = or_(models.Network.label == "network_1", models.Network.host == "host_1")
+        other_table_criterion = BooleanExpression("NORMAL", models.Instance.host == "host_1")
+        range_criterion = BooleanExpression("NORMAL", models.Network.id > 3)
+        criterions = [join_criterion, or_criterion, other_table_criterion, range_criterion]
+        plan = build_plan(["fixed_ips", "networks"], criterions)
+        self.assertEqual(criterions, plan.residual_criterions)
+
+    def test_shapes(self):
+        network_1 = BooleanExpression("NORMAL", models.Network.label == "network_1")
+        network_2 = BooleanExpression("NORMAL", models.Network.label == "network_2")
+        self.assertEqual(network_1.shape, network_2.shape)
+        self.assertEqual(["network_1"], network_1.parameters)
+        self.assertEqual(["network_2"], network_2.parameters)
+        self.assertEqual(1, sum(1 for x in COMPILED_SHAPES.entries if x == network_1.shape))
+        row = KeyedTuple([{"label": "network_2"}], ["networks"])
+        self.assertFalse(network_1.evaluate(row))
+        self.assertTrue(network_2.evaluate(row))
+
+        criterions = [and_(models.Network.id.in_([1, 2, 3]), models.Network.label.op("REGEXP")("^net"))]
+        other_criterions = [and_(models.Network.id.in_([4]), models.Network.label.op("REGEXP")("^host"))]
+        self.assertEqual(criterions[0].shape, other_criterions[0].shape)
+        self.assertEqual([[1, 2, 3], "^net"], criterions[0].parameters)
+        self.assertEqual(criterions, build_plan(["networks"], criterions).residual_criterions)
+        plan = build_plan(["networks"], [BooleanExpression("NORMAL", models.Network.id.in_([1, 2, 3]))])
+        other_plan = build_plan(["networks"], [BooleanExpression("NORMAL", models.Network.id.in_([4]))])
+        self.assertEqual([("id", ["1", "2", "3"])], plan.hints("networks", []))
+        self.assertEqual([("id", ["4"])], other_plan.hints("networks", []))
+        row = KeyedTuple([{"id": 4, "label": "host_4"}], ["networks"])
+        self.assertFalse(criterions[0].evaluate(row))
+        self.assertTrue(other_criterions[0].evaluate(row))
+
+        # the shape of a criterion that cannot be compiled is specific to this criterion
+        criterion = and_(func.lower(models.Network.label) == "network_1", models.Network.id == 3)
+        self.assertFalse(criterion.cacheable)
+        self.assertEqual(["fixed_ips"], build_plan(["fixed_ips"], [criterion]).predicates.keys())
+        self.assertEqual([criterion], build_plan(["networks"], [criterion]).residual_criterions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.models import SAVE_CONFLICT_RETRIES
+from lib.rome.core.orm.query import Query
+from lib.rome.driver.redis.driver import RedisDriver
+from test._fixtures import Gauge
+
+
+class TestPutIfVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = RedisDriver()
+        self.clean()
+
+    def tearDown(self):
+        driver = database_driver.get_driver()
+        if "put_if_version" in driver.__dict__:
+            del driver.put_if_version
+        self.clean()
+
+    def clean(self):
+        self.driver.redis_client.delete("gauges", "version_tests", "sec_index:version_tests:name:a",
+                                        "sec_index_values:version_tests")
+
+    def test_compare_and_set(self):
+        self.assertTrue(self.driver.put_if_version("version_tests", 1, {"id": 1, "name": "a", "rome_version_number": 0},
+                                                   -1, ["name"]))
+        self.assertFalse(self.driver.put_if_version("version_tests", 1, {"id": 1, "rome_version_number": 0}, -1))
+        self.assertFalse(self.driver.put_if_version("version_tests", 1, {"id": 1, "rome_version_number": 2}, 1))
+        self.assertTrue(self.driver.put_if_version("version_tests", 1, {"id": 1, "name": "a", "rome_version_number": 1},
+                                                   0, ["name"]))
+        self.assertEqual(1, self.driver.get("version_tests", 1)["rome_version_number"])
+        self.assertEqual(set(["version_tests:id:1"]),
+                         self.driver.redis_client.smembers("sec_index:version_tests:name:a"))
+
+    def test_legacy_values(self):
+        self.driver.redis_client.hset("version_tests", "version_tests:id:1", "%s" % ({"id": 1, "rome_version_number": 3}))
+        self.assertFalse(self.driver.put_if_version("version_tests", 1, {"id": 1, "rome_version_number": 1}, 0))
+        self.assertTrue(self.driver.put_if_version("version_tests", 1, {"id": 1, "rome_version_number": 4}, 3))
+        self.assertEqual(4, self.driver.get("version_tests", 1)["rome_version_number"])
+
+    def test_save_conflict(self):
+        gauge = Gauge()
+        gauge.name = "visits"
+        gauge.amount = 1
+        gauge.save()
+        self.assertEqual(0, gauge.rome_version_number)
+
+        other_gauge = Query(Gauge).filter_by(id=gauge.id).first()
+        other_gauge.amount = 2
+        other_gauge.save()
+        self.assertEqual(1, other_gauge.rome_version_number)
+
+        gauge.name = "hits"
+        gauge.save()
+        stored_gauge = self.driver.get("gauges", gauge.id)
+        self.assertEqual("hits", stored_gauge["name"])
+        self.assertEqual(2, stored_gauge["rome_version_number"])
+
+    def test_repeated_conflicts(self):
+        gauge = Gauge()
+        gauge.name = "visits"
+        gauge.amount = 1
+        gauge.save()
+        driver = database_driver.get_driver()
+        original_put_if_version = driver.put_if_version
+        calls = []
+
+        def put_if_version(tablename, key, value, expected_version, secondary_indexes=[]):
+            """Another process modifies the gauge before each of the first
+            three writes."""
+            calls.append(expected_version)
+            if len(calls) <= 3:
+                stored_gauge = driver.get("gauges", key)
+                stored_gauge["amount"] += 1
+                stored_gauge["rome_version_number"] += 1
+                driver.put("gauges", key, stored_gauge)
+            return original_put_if_version(tablename, key, value, expected_version,
+                                           secondary_indexes=secondary_indexes)
+        driver.put_if_version = put_if_version
+
+        gauge.name = "hits"
+        gauge.save()
+        stored_gauge = self.driver.get("gauges", gauge.id)
+        # the dirty fields are written first, then the whole object
+        self.assertEqual([0, 0, 2, 3], calls)
+        self.assertEqual("hits", stored_gauge["name"])
+        self.assertEqual(4, stored_gauge["rome_version_number"])
+        self.assertEqual(4, gauge.rome_version_number)
+
+        driver.put_if_version = lambda *args, **kwargs: calls.append(None) and False
+        gauge.name = "clicks"
+        gauge.save()
+        self.assertEqual(4 + 2 + SAVE_CONFLICT_RETRIES, len(calls))
+        self.assertEqual("hits", self.driver.get("gauges", gauge.id)["name"])
+        self.assertEqual(4, gauge.rome_version_number)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+__author__ = 'jonathan'
+
+import unittest
+
+from sqlalchemy import func
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.orm.query import Query
+from lib.rome.utils.PersistentList import EMPTY_LIST
+from test._fixtures import Gauge
+
+
+class TestQueryBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = database_driver.get_driver()
+        self.driver.redis_client.delete("gauges")
+
+    def tearDown(self):
+        self.driver.redis_client.delete("gauges")
+
+    def test_persistent_list(self):
+        first = EMPTY_LIST.extend([1, 2])
+        second = first.append(3)
+        third = first.append(4)
+        self.assertEqual([1, 2, 3], second.to_list())
+        self.assertEqual([1, 2, 4], list(third))
+        self.assertEqual([1, 2], first.to_list())
+        self.assertEqual(3, len(third))
+
+    def test_chaining(self):
+        for i in range(20):
+            gauge = Gauge()
+            gauge.name = "gauge_%s" % (i % 2)
+            gauge.amount = i
+            gauge.save()
+        query = Query(Gauge).filter_by(name="gauge_0")
+        chained_query = query
+        for i in range(12):
+            chained_query = chained_query.filter(Gauge.amount > i)
+        other_query = query.filter(Gauge.amount < 5).order_by(Gauge.amount)
+
+        self.assertEqual(10, len(query.all()))
+        self.assertEqual([12, 14, 16, 18], sorted(map(lambda x: x.amount, chained_query.all())))
+        self.assertEqual([0, 2, 4], map(lambda x: x.amount, other_query.all()))
+        self.assertEqual(13, len(chained_query._criterions))
+        self.assertEqual(1, len(query._criterions))
+        self.assertEqual([], query._ordering)
+
+        self.assertEqual([[90]], Query(func.sum(Gauge.amount), base_model=Gauge).filter_by(name="gauge_0").all())
+        self.assertEqual([[10]], Query(func.count(Gauge.id).label("n"), base_model=Gauge).filter_by(name="gauge_1").all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+__author__ = 'jonathan'
+
+import datetime
+import unittest
+
+from lib.rome.core.orm.query import Query
+from lib.rome.driver.database_driver import RangeHint, RangeIndex
+from lib.rome.driver.redis.driver import RedisDriver
+from test._fixtures import Reading
+
+
+class TestRangeIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = RedisDriver()
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        self.driver.redis_client.delete("readings", "sec_index_values:readings", "range_index:readings:amount",
+                                        "range_index:readings:measured_at", "range_tests",
+                                        "sec_index_values:range_tests", "range_index:range_tests:amount")
+
+    def test_scores(self):
+        indexes = [RangeIndex("amount")]
+        self.driver.put("range_tests", 1, {"id": 1, "amount": 3}, indexes)
+        self.driver.put_many([("range_tests", 2, {"id": 2, "amount": 5}, indexes),
+                              ("range_tests", 1, {"id": 1, "amount": 8}, indexes)])
+        self.assertEqual([("range_tests:id:2", 5.0), ("range_tests:id:1", 8.0)],
+                         self.driver.redis_client.zrange("range_index:range_tests:amount", 0, -1, withscores=True))
+        self.assertEqual([1], map(lambda x: x["id"],
+                                  self.driver.getall("range_tests", [("amount", RangeHint(5, None, True, False))])))
+        self.assertEqual([2], map(lambda x: x["id"],
+                                  self.driver.getall("range_tests", [("amount", RangeHint(None, 8, False, True))])))
+        # objects whose value is NULL are not indexed: hints are ignored
+        self.driver.put("range_tests", 3, {"id": 3, "amount": None}, indexes)
+        self.assertEqual(2, self.driver.redis_client.zcard("range_index:range_tests:amount"))
+        self.assertEqual([1, 2, 3], map(lambda x: x["id"],
+                                        self.driver.getall("range_tests", [("amount", RangeHint(5, None, True, False))])))
+        self.driver.remove_key("range_tests", 1)
+        self.assertEqual(["range_tests:id:2"],
+                         self.driver.redis_client.zrange("range_index:range_tests:amount", 0, -1))
+
+    def test_queries(self):
+        start = datetime.datetime(2016, 1, 1)
+        for i in range(10):
+            reading = Reading()
+            reading.name = "reading_%s" % (i)
+            reading.amount = i
+            reading.measured_at = start + datetime.timedelta(hours=i)
+            reading.save()
+        self.assertEqual(10, self.driver.redis_client.zcard("range_index:readings:amount"))
+
+        query = Query(Reading).filter(Reading.amount > 6)
+        self.assertEqual([7, 8, 9], sorted(map(lambda x: x.amount, query.all())))
+        query = Query(Reading).filter(Reading.amount >= 2).filter(Reading.amount < 4)
+        self.assertEqual([2, 3], sorted(map(lambda x: x.amount, query.all())))
+        query = Query(Reading).filter(Reading.measured_at >= start + datetime.timedelta(hours=8))
+        self.assertEqual(["reading_8", "reading_9"], sorted(map(lambda x: x.name, query.all())))
+
+    def test_objects_missing_from_index(self):
+        for i in range(3):
+            reading = Reading()
+            reading.amount = i
+            reading.save()
+        # objects written before the range index was declared
+        self.driver.redis_client.delete("range_index:readings:amount")
+        self.assertEqual(3, len(Query(Reading).filter(Reading.amount >= 0).all()))
+        self.assertEqual(2, Query(Reading).filter(Reading.amount >= 1).count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+__author__ = 'jonathan'
+
+import unittest
+
+from lib.rome.core.orm.query import Query
+from lib.rome.driver.redis.driver import RedisDriver, RedisClusterDriver
+from test._fixtures import Gauge
+
+
+class TestRedisDriver(unittest.TestCase):
+
+    marbles = [{"id": 1, "color": "red", "size": "big"},
+               {"id": 2, "color": "red", "size": "small"},
+               {"id": 3, "color": "blue", "size": "big"},
+               {"id": 4, "color": "green", "size": "big"},
+               {"id": 5, "color": "blue", "size": "small"}]
+
+    def setUp(self):
+        self.driver = RedisDriver()
+        self.clean()
+        self.driver.put_many(map(lambda x: ("driver_tests", x["id"], x, ["color", "size"]), self.marbles))
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        keys = ["driver_tests", "other_driver_tests", "sec_index_values:driver_tests",
+                "sec_index_values:other_driver_tests"]
+        keys += list(self.driver.redis_client.scan_iter(match="sec_index:*driver_tests:*"))
+        self.driver.redis_client.delete(*keys)
+
+    def ids(self, hints):
+        return map(lambda x: x["id"], self.driver.getall("driver_tests", hints))
+
+    def selected_ids(self, hints):
+        """Ids selected on client side, as RedisClusterDriver does."""
+        (index_groups, id_keys) = self.driver._hints_to_keys("driver_tests", hints)
+        keys = RedisClusterDriver._select_keys.__func__(self.driver, index_groups, id_keys)
+        return sorted(map(lambda x: int(x.split(":")[-1]), keys))
+
+    def test_put_many_get_many(self):
+        self.driver.put_many([("other_driver_tests", 1, {"id": 1, "color": "red"}, ["color"]),
+                              ("driver_tests", 2, {"id": 2, "color": "blue", "size": "small"}, ["color", "size"])])
+        self.assertEqual([{"id": 1, "color": "red"}, self.marbles[0], {"id": 2, "color": "blue", "size": "small"},
+                          None],
+                         self.driver.get_many([("other_driver_tests", 1), ("driver_tests", 1), ("driver_tests", 2),
+                                               ("driver_tests", 6)]))
+        self.assertEqual(set(["driver_tests:id:3", "driver_tests:id:5", "driver_tests:id:2"]),
+                         self.driver.redis_client.smembers("sec_index:driver_tests:color:blue"))
+        self.assertEqual(set(["driver_tests:id:1"]),
+                         self.driver.redis_client.smembers("sec_index:driver_tests:color:red"))
+        self.assertEqual(set(["other_driver_tests:id:1"]),
+                         self.driver.redis_client.smembers("sec_index:other_driver_tests:color:red"))
+
+    def test_round_trips(self):
+        pipelines = []
+        original_pipeline = self.driver.pipeline
+
+        def pipeline(*args, **kwargs):
+            pipelines.append(args)
+            return original_pipeline(*args, **kwargs)
+        self.driver.pipeline = pipeline
+        self.driver.put_many(map(lambda x: ("driver_tests", x["id"] + 5, dict(x, id=x["id"] + 5), ["color"]),
+                                 self.marbles))
+        self.assertEqual(1, len(pipelines))
+        self.assertEqual(self.marbles[1:3], self.driver.get_many([("driver_tests", 2), ("driver_tests", 3)]))
+        self.assertEqual(2, len(pipelines))
+        self.assertEqual(4, len(self.driver.redis_client.smembers("sec_index:driver_tests:color:red")))
+
+    def test_multi_attribute_hints(self):
+        hints = [("color", "red"), ("size", "big")]
+        self.assertEqual([1], self.ids(hints))
+        self.assertEqual([1], self.selected_ids(hints))
+        self.assertEqual(1, self.driver.count("driver_tests", hints))
+        self.assertEqual([], self.ids([("color", "red"), ("size", "medium")]))
+        self.assertEqual(0, self.driver.count("driver_tests", [("color", "green"), ("size", "small")]))
+
+    def test_in_hints(self):
+        hints = [("color", ["red", "green"]), ("size", "big")]
+        self.assertEqual([1, 4], self.ids(hints))
+        self.assertEqual([1, 4], self.selected_ids(hints))
+        self.assertEqual([1, 2, 3, 4, 5], self.ids([("color", ["red", "green", "blue", "yellow"])]))
+        self.assertEqual([], self.ids([("color", [])]))
+        self.assertEqual(0, self.driver.count("driver_tests", [("color", [])]))
+
+    def test_large_in_hints(self):
+        # more values than unpack can handle in a script
+        colors = map(lambda x: "color_%s" % (x), range(10000)) + ["green", "red"]
+        hints = [("color", colors), ("size", "big")]
+        self.assertEqual([1, 4], self.ids(hints))
+        self.assertEqual(2, self.driver.count("driver_tests", hints))
+        self.assertEqual([1, 2, 4], self.ids([("color", colors)]))
+
+    def test_id_hints(self):
+        hints = [("id", ["1", "3", "4", "6"]), ("size", "big"), ("color", ["blue", "green"])]
+        self.assertEqual([3, 4], self.ids(hints))
+        self.assertEqual([3, 4], self.selected_ids(hints))
+        self.assertEqual(2, self.driver.count("driver_tests", hints))
+        # ids that do not exist are not counted
+        self.assertEqual([2, 5], self.ids([("id", ["2", "5", "6"])]))
+        self.assertEqual(2, self.driver.count("driver_tests", [("id", ["2", "5", "6"])]))
+        # several id hints are intersected
+        self.assertEqual([5], self.ids([("id", ["2", "5"]), ("id", ["5", "6"])]))
+        self.assertEqual([], self.ids([("id", "1"), ("id", "2")]))
+
+    def test_getall_script(self):
+        driver = RedisDriver()
+        self.assertEqual(self.marbles, driver.getall("driver_tests"))
+        self.assertEqual(None, driver._getall_script)
+        self.assertEqual([self.marbles[2], self.marbles[4]], driver.getall("driver_tests", [("color", "blue")]))
+        self.assertNotEqual(None, driver._getall_script)
+
+    def test_equality_hints(self):
+        query = Query(Gauge)
+        self.assertEqual(1, len(query._extract_hint(Gauge.name == "visits")))
+        self.assertEqual([], query._extract_hint(Gauge.name != "visits"))
+        self.assertEqual([], query._extract_hint(Gauge.amount > 3))
+        filtered_query = query.filter(Gauge.name == "visits")
+        query.filter_by(name="hits")
+        self.assertEqual(1, len(filtered_query._hints))
+        self.assertEqual(0, len(query._hints))
+
+
+if __name__ == '__main__':
+    unittest.main()
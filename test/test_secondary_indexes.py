@@ -0,0 +1,127 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.models import rebuild_indexes
+from lib.rome.core.orm.query import Query
+from lib.rome.driver.redis.driver import RedisDriver
+from test._fixtures import Marble
+
+
+class TestSecondaryIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = RedisDriver()
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        self.driver.redis_client.delete("index_tests", "sec_index_values:index_tests",
+                                        "sec_index:index_tests:color:red", "sec_index:index_tests:color:blue",
+                                        "marbles", "sec_index_values:marbles", "sec_index_rebuilt:marbles",
+                                        "sec_index_rebuilding:marbles",
+                                        "sec_index:marbles:color:red", "sec_index:marbles:color:blue")
+
+    def test_moved_values(self):
+        self.driver.put("index_tests", 1, {"id": 1, "color": "red"}, ["color"])
+        self.driver.put_many([("index_tests", 2, {"id": 2, "color": "red"}, ["color"]),
+                              ("index_tests", 1, {"id": 1, "color": "blue"}, ["color"])])
+        self.assertEqual(set(["index_tests:id:2"]),
+                         self.driver.redis_client.smembers("sec_index:index_tests:color:red"))
+        self.assertEqual(set(["index_tests:id:1"]),
+                         self.driver.redis_client.smembers("sec_index:index_tests:color:blue"))
+        self.assertEqual([2], map(lambda x: x["id"], self.driver.getall("index_tests", [("color", "red")])))
+
+    def test_declared_index_keys(self):
+        self.driver.put("index_tests", 1, {"id": 1, "color": "red"}, ["color"])
+        (keys, args) = self.driver._put_arguments("index_tests", 1, {"id": 1, "color": "blue"}, ["color"])
+        self.assertEqual(["index_tests", "sec_index_values:index_tests", "sec_index:index_tests:color:blue"], keys)
+        # the set that the object leaves is not declared: nothing is modified
+        self.assertEqual([-2, -1, "sec_index:index_tests:color:red"], self.driver._put_script(keys=keys, args=args))
+        self.assertEqual(set(["index_tests:id:1"]),
+                         self.driver.redis_client.smembers("sec_index:index_tests:color:red"))
+        self.assertEqual([-2, "sec_index:index_tests:color:red"],
+                         self.driver._remove_script(keys=keys[:2], args=["index_tests:id:1", "index_tests", "", ""]))
+        self.assertEqual(1, len(self.driver.getall("index_tests")))
+        self.assertEqual((1, -1), self.driver._run_put_script(keys, args))
+        self.assertEqual(set(), self.driver.redis_client.smembers("sec_index:index_tests:color:red"))
+        self.assertEqual([1], map(lambda x: x["id"], self.driver.getall("index_tests", [("color", "blue")])))
+
+    def test_removed_objects(self):
+        self.driver.put("index_tests", 1, {"id": 1, "color": "red"}, ["color"])
+        self.driver.remove_key("index_tests", 1)
+        self.assertEqual(set(), self.driver.redis_client.smembers("sec_index:index_tests:color:red"))
+        self.assertEqual({}, self.driver.redis_client.hgetall("sec_index_values:index_tests"))
+        self.assertEqual([], self.driver.getall("index_tests", [("color", "red")]))
+
+    def test_stale_indexes(self):
+        marble = Marble()
+        marble.color = "blue"
+        marble.save()
+        # membership left by a previous version of ROME
+        self.driver.redis_client.sadd("sec_index:marbles:color:red", "marbles:id:%s" % (marble.id))
+        self.assertFalse(database_driver.get_driver().has_exact_indexes("marbles"))
+        self.assertEqual([], Query(Marble).filter_by(color="red").all())
+        self.assertEqual(0, Query(Marble).filter_by(color="red").count())
+
+        rebuild_indexes(Marble)
+        self.assertTrue(database_driver.get_driver().has_exact_indexes("marbles"))
+        self.assertEqual(set(), self.driver.redis_client.smembers("sec_index:marbles:color:red"))
+        self.assertEqual([marble.id], map(lambda x: x.id, Query(Marble).filter_by(color="blue").all()))
+        self.assertEqual(1, Query(Marble).filter_by(color="blue").count())
+        self.assertEqual(0, Query(Marble).filter_by(color="red").count())
+
+    def test_queries_during_rebuild(self):
+        for color in ["blue", "blue", "red"]:
+            marble = Marble()
+            marble.color = color
+            marble.save()
+        driver = database_driver.get_driver()
+        original_put_if_version = driver.put_if_version
+        results = []
+
+        def put_if_version(*args, **kwargs):
+            """Query the marbles while they are indexed again."""
+            stored = original_put_if_version(*args, **kwargs)
+            results.append((len(Query(Marble).filter_by(color="blue").all()),
+                            Query(Marble).filter_by(color="blue").count(),
+                            driver.count("marbles", [("color", "blue")])))
+            return stored
+        driver.put_if_version = put_if_version
+        try:
+            rebuild_indexes(Marble)
+        finally:
+            del driver.put_if_version
+        # the driver ignores hints (and counts all the marbles) until the end
+        self.assertEqual([(2, 2, 3)] * 3, results)
+        self.assertEqual(2, driver.count("marbles", [("color", "blue")]))
+        self.assertFalse(self.driver.redis_client.exists("sec_index_rebuilding:marbles"))
+
+    def test_exactness_read_with_selection(self):
+        marble = Marble()
+        marble.color = "blue"
+        marble.save()
+        (objects, exact) = self.driver.getall_exact("marbles", [("color", "blue")])
+        self.assertEqual(([marble.id], False), (map(lambda x: x["id"], objects), exact))
+        self.assertEqual(None, self.driver.count_exact("marbles", [("color", "blue")]))
+        rebuild_indexes(Marble)
+        self.assertEqual(True, self.driver.getall_exact("marbles", [("color", "blue")])[1])
+        self.assertEqual(1, self.driver.count_exact("marbles", [("color", "blue")]))
+        self.assertEqual(False, self.driver.getall_exact("marbles", [])[1])
+        driver = database_driver.get_driver()
+
+        def has_exact_indexes(tablename):
+            raise AssertionError("exactness of indexes read by a separate call")
+        driver.has_exact_indexes = has_exact_indexes
+        try:
+            self.assertEqual([marble.id], map(lambda x: x.id, Query(Marble).filter_by(color="blue").all()))
+            self.assertEqual(1, Query(Marble).filter_by(color="blue").count())
+        finally:
+            del driver.has_exact_indexes
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+__author__ = 'jonathan'
+
+import unittest
+
+import lib.rome.driver.database_driver as database_driver
+from lib.rome.core.models import bulk_save
+from lib.rome.core.orm.query import Query
+from test._fixtures import Gauge
+
+
+class TestShortCircuit(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = database_driver.get_driver()
+        self.driver.redis_client.delete("gauges")
+        gauges = []
+        for i in range(3000):
+            gauge = Gauge()
+            gauge.name = "gauge_%s" % (i % 2)
+            gauge.amount = i
+            gauges += [gauge]
+        bulk_save(gauges)
+
+        self.fetched = 0
+        self.original_iter_all = self.driver.iter_all
+
+        def iter_all(tablename, batch_size=1000):
+            for value in self.original_iter_all(tablename, batch_size=batch_size):
+                self.fetched += 1
+                yield value
+        self.driver.iter_all = iter_all
+
+    def tearDown(self):
+        del self.driver.iter_all
+        self.driver.redis_client.delete("gauges")
+
+    def test_first(self):
+        gauge = Query(Gauge).filter_by(name="gauge_1").first()
+        self.assertEqual("gauge_1", gauge.name)
+        self.assertTrue(self.fetched <= 1000)
+
+    def test_exists(self):
+        self.assertTrue(Query(Gauge).filter(Gauge.amount >= 0).exists())
+        self.assertTrue(self.fetched <= 1000)
+        self.fetched = 0
+        self.assertFalse(Query(Gauge).filter_by(name="gauge_2").exists())
+        self.assertEqual(3000, self.fetched)
+
+    def test_iteration(self):
+        rows = iter(Query(Gauge))
+        first_row = next(rows)
+        self.assertTrue(self.fetched <= 1000)
+        other_rows = list(rows)
+        self.assertEqual(3000, 1 + len(other_rows))
+        self.assertEqual(3000, self.fetched)
+        request_uuids = set(map(lambda x: x.request_uuid, [first_row] + other_rows))
+        self.assertEqual(3, len(request_uuids))
+
+
+if __name__ == '__main__':
+    unittest.main()